@@ -1,52 +1,106 @@
 #!flask/bin/python
-from flask import (Flask, abort, jsonify, make_response, redirect,
+import json
+import logging
+import os
+import threading
+from functools import lru_cache
+
+from flask import (Flask, abort, current_app, jsonify, make_response, redirect,
                    render_template, request, session, url_for)
-from flask_wtf import FlaskForm
+from housing.modeling import batching as bt
+from housing.modeling import lite as lt
+from housing.modeling import prediction_cache as pc
+from housing.modeling import registry as rg
 from housing.modeling import score as sr
+from housing.preparation import instrumentation as im
 from housing.preparation import utils as ut
-from wtforms.fields import FloatField, SelectField, SubmitField
-
-score_cfg_path = "./flask_config.yml"
-score_cfg = ut.read_config(score_cfg_path)
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'secret!'
-
-
-class MedianHousingFeatures(FlaskForm):
-    longitude = FloatField("Longitude")
-    latitude = FloatField("Latitude")
-    housing_median_age = FloatField("Housing Median Age")
-    total_rooms = FloatField("Total Rooms")
-    total_bedrooms = FloatField("Total Bedrooms")
-    population = FloatField("Population")
-    households = FloatField("Households")
-    median_income = FloatField("Median Income")
-    ocean_proximity = SelectField("Ocean Proximity",
-                                  choices=[("<1H OCEAN", "<1H OCEAN"),
-                                           ("INLAND", "INLAND"),
-                                           ("ISLAND", "ISLAND"),
-                                           ("NEAR BAY", "NEAR BAY"),
-                                           ("NEAR OCEAN", "NEAR OCEAN")])
-    submit = SubmitField('Submit')
-
-
-@app.errorhandler(404)
+
+logger = logging.getLogger(__name__)
+
+FEATURES = ["longitude", "latitude", "housing_median_age", "total_rooms", "total_bedrooms",
+            "population", "households", "median_income", "ocean_proximity"]
+
+
+def get_observation(payload):
+    return {feature: payload.get(feature, "") for feature in FEATURES}
+
+
+@lru_cache(maxsize=None)
+def feature_form():
+    """Returns the form class of the prediction page.
+
+    Flask-WTF and WTForms are only imported when the form is first shown,
+    the JSON endpoints do not need them.
+    """
+    from flask_wtf import FlaskForm
+    from wtforms.fields import FloatField, SelectField, SubmitField
+
+    class MedianHousingFeatures(FlaskForm):
+        longitude = FloatField("Longitude")
+        latitude = FloatField("Latitude")
+        housing_median_age = FloatField("Housing Median Age")
+        total_rooms = FloatField("Total Rooms")
+        total_bedrooms = FloatField("Total Bedrooms")
+        population = FloatField("Population")
+        households = FloatField("Households")
+        median_income = FloatField("Median Income")
+        ocean_proximity = SelectField("Ocean Proximity",
+                                      choices=[("<1H OCEAN", "<1H OCEAN"),
+                                               ("INLAND", "INLAND"),
+                                               ("ISLAND", "ISLAND"),
+                                               ("NEAR BAY", "NEAR BAY"),
+                                               ("NEAR OCEAN", "NEAR OCEAN")])
+        submit = SubmitField('Submit')
+
+    return MedianHousingFeatures
+
+
+_batcher_lock = threading.Lock()
+
+
+def get_batcher():
+    """Returns the micro-batcher of this process.
+
+    The batcher thread does not survive a fork, so a worker forked from a
+    preloaded app starts its own batcher on its first request.
+    """
+    state = current_app.extensions["housing"]
+    with _batcher_lock:
+        if state.get("batcher_pid") != os.getpid():
+            score_cfg = state["score_cfg"]
+            state["batcher"] = bt.MicroBatcher(lambda observations: sr.score(score_cfg, observations),
+                                               max_batch_size=score_cfg.get("batch_max_size", 64),
+                                               max_wait_ms=score_cfg.get("batch_max_wait_ms", 5))
+            state["batcher_pid"] = os.getpid()
+        return state["batcher"]
+
+
+def predict_observation(observation):
+    """Returns a cached prediction when possible, otherwise scores the observation with the micro-batcher."""
+    prediction = sr.cached_prediction(current_app.extensions["housing"]["score_cfg"], observation)
+    if prediction is None:
+        prediction = get_batcher().predict(observation)
+    return prediction
+
+
 def not_found(error):
     return make_response(jsonify({'error': 'Not found'}), 404)
 
 
-@app.route('/')
+def too_large(error):
+    return make_response(jsonify({'error': 'Request body too large'}), 413)
+
+
 def index():
     session['predict'] = 0
     return render_template('index.html')
 
 
-@app.route('/predict', methods=['GET', 'POST'])
 def predict():
     if request.json is None:
         if 'predict' not in session:
             return redirect(url_for('index'))
-        form = MedianHousingFeatures()
+        form = feature_form()()
         if form.validate_on_submit():
             observation = {
                 "longitude": form.longitude.data,
@@ -60,7 +114,7 @@ def predict():
                 "ocean_proximity": form.ocean_proximity.data,
             }
             try:
-                prediction = sr.score(score_cfg, observation)[0]
+                prediction = predict_observation(observation)
                 return render_template('prediction.html', prediction=prediction)
             except Exception as error:
                 return render_template('error.html', error=error)
@@ -68,22 +122,128 @@ def predict():
     else:
         if not request.json:
             abort(400)
-        observation = {
-            "longitude": request.json.get("longitude", ""),
-            "latitude": request.json.get("latitude", ""),
-            "housing_median_age": request.json.get("housing_median_age", ""),
-            "total_rooms": request.json.get("total_rooms", ""),
-            "total_bedrooms": request.json.get("total_bedrooms", ""),
-            "population": request.json.get("population", ""),
-            "households": request.json.get("households", ""),
-            "median_income": request.json.get("median_income", ""),
-            "ocean_proximity": request.json.get("ocean_proximity", ""),
-        }
-        prediction = sr.score(score_cfg, observation)[0]
+        prediction = predict_observation(get_observation(request.json))
         return jsonify({'prediction': prediction}), 201
 
+
+def bad_request(message, status=400):
+    return make_response(jsonify({'error': message}), status)
+
+
+def read_ndjson(text, max_rows):
+    """Parses an NDJSON body, one observation per non empty line.
+
+    Return
+    ------
+        payload: list
+            parsed lines, None when the body has more than ``max_rows`` of them
+        error: str
+            the first malformed line and why, None when all lines parse
+    """
+    payload = []
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        if len(payload) == max_rows:
+            return None, None
+        try:
+            payload.append(json.loads(line))
+        except ValueError as error:
+            return None, "malformed JSON on line {}: {}".format(number, error)
+    return payload, None
+
+
+def predict_batch():
+    max_rows = current_app.extensions["housing"]["score_cfg"].get("batch_max_rows", 10000)
+    if request.mimetype == "application/x-ndjson":
+        payload, error = read_ndjson(request.get_data(as_text=True), max_rows)
+        if error is not None:
+            return bad_request(error)
+        if payload is None:
+            return bad_request("more than {} rows".format(max_rows), 413)
+    else:
+        payload = request.get_json(silent=True)
+    if not payload or type(payload) != list or not all(type(row) == dict for row in payload):
+        abort(400)
+    if len(payload) > max_rows:
+        return bad_request("more than {} rows".format(max_rows), 413)
+    predictions = sr.score(current_app.extensions["housing"]["score_cfg"], [get_observation(row) for row in payload])
+    return jsonify({'predictions': predictions.tolist()}), 201
+
+
+def metrics():
+    text = im.get_instrumentation().prometheus()
+    if current_app.extensions["housing"]["score_cfg"].get("prediction_cache", False):
+        text += pc.get_prediction_cache().prometheus()
+    return current_app.response_class(text, mimetype="text/plain; version=0.0.4")
+
+
+def ready():
+    score_cfg = current_app.extensions["housing"]["score_cfg"]
+    status = {"version": score_cfg["version"], "models_path": score_cfg["models_path"],
+              "flat_inference": score_cfg.get("flat_inference", False),
+              "lite_inference": score_cfg.get("lite_inference", False), "pid": os.getpid()}
+    try:
+        if score_cfg.get("lite_inference", False):
+            model = lt.load_lite_model(score_cfg).predictor
+        else:
+            model = rg.get_registry().entry(score_cfg).model
+    except Exception as error:
+        return jsonify(dict(status, ready=False, error=str(error))), 503
+    return jsonify(dict(status, ready=True, model=type(model).__name__)), 200
+
+
+def create_app(cfg_path=None, preload=True):
+    """Creates the scoring app.
+
+    With ``preload`` the model and pipeline are loaded and compiled here,
+    so a server that creates the app before forking (gunicorn
+    ``preload_app``) shares them copy-on-write between its workers.
+
+    Parameters
+    ----------
+        cfg_path: str, default None
+            scoring config, $HOUSING_FLASK_CONFIG or ./flask_config.yml when not given
+        preload: bool, default True
+            load the artifacts now instead of on the first request
+
+    Return
+    ------
+        app: flask.Flask
+            scoring app
+    """
+    cfg_path = cfg_path or os.environ.get("HOUSING_FLASK_CONFIG", "./flask_config.yml")
+    score_cfg = ut.read_config(cfg_path)
+    rg.configure_registry(score_cfg.get("registry_max_mb"), score_cfg.get("registry_verify_checksum", False),
+                          score_cfg.get("registry_mmap_mode"))
+    im.configure_instrumentation(**score_cfg.get("instrumentation", {}))
+    pc.configure_prediction_cache(score_cfg.get("prediction_cache_size", 100000), score_cfg.get("prediction_cache_ttl"))
+    if preload:
+        try:
+            sr.preload(score_cfg)
+        except (OSError, ValueError) as error:
+            # keep serving, /ready reports the failure until the artifacts can be loaded
+            logger.error("could not preload {}: {}".format(score_cfg["version"], error))
+
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.environ.get("HOUSING_SECRET_KEY", 'secret!')
+    # werkzeug rejects larger bodies before they are read, batch_max_rows is checked on the parsed ones
+    max_mb = score_cfg.get("request_max_mb", 16)
+    app.config['MAX_CONTENT_LENGTH'] = None if max_mb is None else int(max_mb * (1 << 20))
+    app.extensions["housing"] = {"score_cfg": score_cfg}
+    app.register_error_handler(404, not_found)
+    app.register_error_handler(413, too_large)
+    app.add_url_rule('/', 'index', index)
+    app.add_url_rule('/predict', 'predict', predict, methods=['GET', 'POST'])
+    app.add_url_rule('/predict/batch', 'predict_batch', predict_batch, methods=['POST'])
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    app.add_url_rule('/ready', 'ready', ready)
+    return app
+
+
 # curl -i -H "Content-Type: application/json" -X POST -d '{"longitude": -120.430000, "latitude": 34.870000, "housing_median_age": 21.000000, "total_rooms": 2131.000000, "total_bedrooms": 329.000000, "population": 1094.000000, "households": 353.000000, "median_income": 4.664800, "ocean_proximity": "<1H OCEAN"}' http://localhost:5000/predict
+# curl -i -H "Content-Type: application/json" -X POST -d '[{"longitude": -120.43, ...}, {"longitude": -118.2, ...}]' http://localhost:5000/predict/batch
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
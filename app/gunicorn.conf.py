@@ -0,0 +1,29 @@
+"""Gunicorn settings of the scoring app, read from the serve_* keys of flask_config.yml.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is created once in the master process (``preload_app``) so the
+workers forked from it share the loaded model and pipeline pages. Every
+worker serves ``serve_threads`` requests concurrently; their predictions
+are coalesced by the worker's micro-batcher thread.
+"""
+import gc
+import multiprocessing
+import os
+
+from housing.preparation import utils as ut
+
+_cfg = ut.read_config(os.environ.get("HOUSING_FLASK_CONFIG", "./flask_config.yml"))
+
+bind = _cfg.get("serve_bind", "127.0.0.1:5000")
+workers = _cfg.get("serve_workers") or multiprocessing.cpu_count()
+threads = _cfg.get("serve_threads", 4)
+worker_class = "gthread"
+timeout = _cfg.get("serve_timeout", 30)
+preload_app = True
+
+
+def pre_fork(server, worker):
+    # move the preloaded objects out of the collected generations, so the
+    # garbage collector of a worker does not touch and copy their pages
+    gc.freeze()
@@ -0,0 +1,4 @@
+"""WSGI entry point, e.g. ``gunicorn -c gunicorn.conf.py wsgi:app`` from the app directory."""
+from app import create_app
+
+app = create_app()
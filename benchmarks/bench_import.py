@@ -0,0 +1,130 @@
+"""Import time budgets of the package and the scoring app.
+
+Imports every module in a fresh interpreter under ``python -X importtime``,
+takes the fastest of --repeat runs and checks it against the module's
+budget in milliseconds. Modules on the scoring path must also not load the
+heavy dependencies listed for them, which catches an eager import long
+before it shows up as a slow cold start. Exits with status 1 when a budget
+is exceeded or a forbidden module is loaded. Budgets are machine specific,
+scale them with --scale on slower machines.
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --repeat 5 --scale 2 --top 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module: (budget ms, modules it must not load)
+BUDGETS = {
+    "housing": (50, ["numpy", "pandas", "sklearn", "scipy", "joblib"]),
+    "housing.modeling.lite": (250, ["pandas", "sklearn", "scipy", "joblib"]),
+    "housing.modeling.score": (400, ["pandas", "sklearn", "scipy"]),
+    "housing.preparation.data_utils": (300, ["pandas", "sklearn", "scipy"]),
+    "housing.processing.processing": (2500, []),
+    "app": (1000, ["pandas", "sklearn", "scipy", "flask_wtf", "wtforms"]),
+}
+
+MARKER = "-- bench_import --"
+
+SCRIPT = """import sys
+sys.stderr.write({marker!r} + "\\n")
+sys.stderr.flush()
+import {module}
+print(__import__("json").dumps(sorted(name for name in {forbidden!r} if name in sys.modules)))
+"""
+
+
+def parse_importtime(stderr):
+    """Parses the ``-X importtime`` lines written after the marker.
+
+    Return
+    ------
+        total_ms: float
+            cumulative milliseconds of the top level imports
+        self_ms: dict
+            module name to its own import milliseconds
+    """
+    lines = stderr.split(MARKER, 1)[-1].splitlines()
+    total_us, self_us = 0, {}
+    for line in lines:
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|", 2)
+        self_us[name.strip()] = int(own)
+        if not name[1:].startswith(" "):
+            total_us += int(cumulative)
+    return total_us / 1000, {name: us / 1000 for name, us in self_us.items()}
+
+
+def measure(module, forbidden, repeat):
+    """Imports ``module`` ``repeat`` times in fresh interpreters.
+
+    Return
+    ------
+        total_ms: float
+            fastest import time
+        self_ms: dict
+            own import time of every module of the fastest run
+        loaded: list
+            forbidden modules that were loaded
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([os.path.join(ROOT, "src"), os.path.join(ROOT, "app"),
+                                         env.get("PYTHONPATH", "")])
+    script = SCRIPT.format(marker=MARKER, module=module, forbidden=forbidden)
+    best = None
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", script], env=env, cwd=ROOT,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            raise RuntimeError("import {} failed:\n{}".format(module, proc.stderr[-2000:]))
+        total_ms, self_ms = parse_importtime(proc.stderr)
+        if best is None or total_ms < best[0]:
+            best = (total_ms, self_ms, json.loads(proc.stdout.strip().splitlines()[-1]))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modules", nargs="+", default=list(BUDGETS), help="modules to import")
+    parser.add_argument("--repeat", type=int, default=3, help="fresh interpreters per module, the fastest counts")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier of the budgets")
+    parser.add_argument("--top", type=int, default=5, help="slowest imported modules to print")
+    parser.add_argument("--output", help="JSON file with the results")
+    args = parser.parse_args()
+
+    results, violations = [], []
+    for module in args.modules:
+        budget, forbidden = BUDGETS.get(module, (None, []))
+        total_ms, self_ms, loaded = measure(module, forbidden, args.repeat)
+        budget_ms = None if budget is None else budget * args.scale
+        slowest = sorted(self_ms.items(), key=lambda item: -item[1])[:args.top]
+        print("{:<34} {:8.1f} ms  budget {}".format(
+            module, total_ms, "-" if budget_ms is None else "{:.0f} ms".format(budget_ms)))
+        for name, ms in slowest:
+            print("    {:<40} {:8.1f} ms".format(name, ms))
+        if budget_ms is not None and total_ms > budget_ms:
+            violations.append("{} imports in {:.1f} ms, budget {:.0f} ms".format(module, total_ms, budget_ms))
+        if loaded:
+            violations.append("{} loads {}".format(module, ", ".join(loaded)))
+        results.append({"module": module, "ms": total_ms, "budget_ms": budget_ms, "forbidden_loaded": loaded,
+                        "slowest": slowest})
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({"python": sys.version.split()[0], "results": results}, fp, indent=2)
+        print("results written to {}".format(args.output))
+    for violation in violations:
+        print("VIOLATION {}".format(violation))
+    if violations:
+        sys.exit(1)
+    print("all imports within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Memory and time profile of Imputer.transform.
+
+Compares the previous ColumnTransformer -> DataFrame -> astype transform with
+the column-wise fill, with and without copying the input.
+
+    python benchmarks/bench_imputer.py --rows 20000000
+    python benchmarks/bench_imputer.py --rows 20000000 --skip-legacy
+
+The legacy transform builds a 2-D object array of boxed values, several GB
+at 20M rows; --skip-legacy profiles only the column-wise fill on machines
+without that much memory.
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from housing.processing import processing as pr
+
+
+def housing_frame(n_rows, seed=0):
+    rng = np.random.RandomState(seed)
+    data = pd.DataFrame({
+        "longitude": rng.uniform(-124, -114, n_rows),
+        "latitude": rng.uniform(32, 42, n_rows),
+        "housing_median_age": rng.randint(1, 52, n_rows).astype(np.float64),
+        "total_rooms": rng.randint(2, 20000, n_rows).astype(np.float64),
+        "total_bedrooms": rng.randint(1, 4000, n_rows).astype(np.float64),
+        "population": rng.randint(3, 30000, n_rows).astype(np.float64),
+        "households": rng.randint(1, 5000, n_rows).astype(np.float64),
+        "median_income": rng.uniform(0.5, 15, n_rows),
+        "ocean_proximity": pd.Categorical.from_codes(
+            rng.randint(0, 5, n_rows), ["<1H OCEAN", "INLAND", "ISLAND", "NEAR BAY", "NEAR OCEAN"]),
+    })
+    data.loc[rng.rand(n_rows) < 0.01, "total_bedrooms"] = np.nan
+    return data
+
+
+def legacy_transform(imputer, X):
+    X = imputer.imputer_.transform(X)
+    X = pd.DataFrame(X, columns=imputer.num_cols_ + imputer.cat_cols_)
+    return X.astype(imputer.dtype_dict_)
+
+
+def profile(name, func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{:<24} {:>8.2f}s  peak {:>10.1f} MB".format(name, elapsed, peak / 2 ** 20))
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000000)
+    parser.add_argument("--skip-legacy", action="store_true", help="do not profile the legacy transform")
+    args = parser.parse_args()
+    data = housing_frame(args.rows)
+    print("input frame {:.1f} MB".format(data.memory_usage(deep=True).sum() / 2 ** 20))
+    imputer = pr.Imputer(num_impute="mean", cat_impute="most_frequent").fit(data.head(100000))
+    if not args.skip_legacy:
+        profile("legacy transform", legacy_transform, imputer, data)
+    profile("transform copy=True", imputer.transform, data)
+    profile("transform copy=False", lambda X: imputer.transform(X, copy=False), data)
+
+
+if __name__ == "__main__":
+    main()
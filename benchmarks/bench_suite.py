@@ -0,0 +1,214 @@
+"""Time and memory benchmark of the training and scoring hot paths.
+
+Synthesizes housing-shaped data at every size, runs each stage twice, once
+timed and once under tracemalloc so the tracing overhead does not inflate
+the timings, and writes the wall time, rows/s and peak traced memory to a
+JSON file. With a baseline file the results are compared stage by stage and
+the script exits with status 1 when a stage got slower or larger than the
+thresholds allow. Baselines are machine specific, record one with
+--save-baseline on the machine the comparison runs on.
+
+    python benchmarks/bench_suite.py --sizes 10k 1M --output bench.json
+    python benchmarks/bench_suite.py --sizes 10k 1M --baseline baseline.json --save-baseline
+    python benchmarks/bench_suite.py --sizes 10k 1M --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+import sklearn
+from bench_imputer import housing_frame
+from housing.modeling import eval as ev
+from housing.modeling import registry as rg
+from housing.modeling import score as sr
+from housing.modeling import train as tr
+from housing.preparation import data_utils as du
+from housing.preparation import utils as ut
+from housing.processing import processing as pr
+
+SIZES = {"k": 10 ** 3, "m": 10 ** 6}
+
+
+def parse_size(size):
+    """Parses 10000, 10k or 1M."""
+    size = size.strip().lower()
+    if size[-1] in SIZES:
+        return int(float(size[:-1]) * SIZES[size[-1]])
+    return int(size)
+
+
+def housing_data(n_rows, seed=0):
+    """Synthetic raw housing data with a median_house_value target that depends on the features."""
+    rng = np.random.RandomState(seed + 1)
+    data = housing_frame(n_rows, seed)
+    value = (40000 * data["median_income"] + 20 * data["total_rooms"] / data["households"]
+             - 2000 * (data["latitude"] - 32) + rng.normal(0, 30000, n_rows))
+    data["median_house_value"] = value.clip(14999, 500001).round()
+    return data
+
+
+def measure(stage, n_rows, func, *args, reset=None, **kwargs):
+    """Runs ``func`` twice and returns the result of the first run and a record with the seconds and peak memory.
+
+    The seconds come from the first, untraced run and the peak traced
+    memory from the second run; ``reset`` is called before each run to
+    restore the state the stage starts from, e.g. a cold registry.
+    """
+    if reset is not None:
+        reset()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    if reset is not None:
+        reset()
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    record = {"stage": stage, "rows": n_rows, "seconds": elapsed, "peak_mb": peak / 2 ** 20,
+              "rows_per_s": n_rows / max(elapsed, 1e-9)}
+    print("{:<36} {:>10} rows {:>9.3f}s {:>12.0f} rows/s  peak {:>9.1f} MB".format(
+        stage, n_rows, elapsed, record["rows_per_s"], record["peak_mb"]))
+    return result, record
+
+
+def score_rows(cfg, rows):
+    """Scores raw observations one request at a time."""
+    return [sr.score(cfg, row) for row in rows]
+
+
+def run_size(cfg, n_rows, algos, fit_rows, single_rows, work_dir):
+    """Benchmarks every stage on ``n_rows`` synthetic rows."""
+    records = []
+
+    def run(stage, rows, func, *args, reset=None, **kwargs):
+        result, record = measure(stage, rows, func, *args, reset=reset, **kwargs)
+        record["size"] = n_rows
+        records.append(record)
+        return result
+
+    cfg = dict(cfg, housing_url=None, housing_path=os.path.join(work_dir, "raw"),
+               model_data_path=os.path.join(work_dir, "processed"), models_path=os.path.join(work_dir, "models"),
+               model_data_cache_path=os.path.join(work_dir, "cache"), over_write_raw_data=False,
+               over_write_model_data=True, raw_data_format="csv", version="bench", tune=False,
+               export_flat_model=False, flat_inference=False)
+    for path in [cfg["housing_path"], cfg["model_data_path"], cfg["models_path"]]:
+        os.makedirs(path, exist_ok=True)
+    housing_data(n_rows).to_csv(du.raw_data_path(cfg["housing_path"]), index=False)
+
+    data = run("load_housing_data", n_rows, du.load_housing_data, cfg["housing_path"],
+               cfg.get("compact_dtypes", True))
+    train, test = run("get_train_test_split", n_rows, du.get_train_test_split, data, cfg["sampling_method"],
+                      cfg["seed"], cfg["test_size"])
+    train_x = train.drop("median_house_value", axis=1)
+    imputer = pr.Imputer(num_impute=cfg["num_impute"], cat_impute=cfg["cat_impute"],
+                         num_constant=cfg["num_constant"], cat_constant=cfg["cat_constant"])
+    run("Imputer.fit", len(train_x), imputer.fit, train_x)
+    train_x = run("Imputer.transform", len(train_x), imputer.transform, train_x)
+    adder = pr.CombinedAttributesAdder(cfg["add_bedrooms_per_room"], cfg.get("extra_features"))
+    run("CombinedAttributesAdder", len(train_x), adder.fit_transform, train_x)
+    del data, train, train_x
+
+    train, test = run("prepare_model_data", n_rows, du.prepare_model_data, cfg)
+    fit_x = train.drop("median_house_value", axis=1).iloc[:fit_rows]
+    fit_y = train["median_house_value"].iloc[:fit_rows]
+    raw_test = du.load_housing_data(cfg["housing_path"], cfg.get("compact_dtypes", True))
+    raw_test = du.get_train_test_split(raw_test, cfg["sampling_method"], cfg["seed"], cfg["test_size"])[1]
+    test_y = raw_test.pop("median_house_value").astype(np.float64)
+    single = raw_test.head(single_rows).to_dict("records")
+    del train, test
+
+    for algo in algos:
+        run("model_selection_fit[{}]".format(algo), len(fit_x), tr.model_selection_fit, dict(cfg, algo=algo),
+            fit_x, fit_y)
+        run("score_single[{}]".format(algo), len(single), score_rows, dict(cfg, algo=algo), single,
+            reset=lambda: rg.get_registry().evict(dict(cfg, algo=algo)))
+        y_hat = run("score_batch[{}]".format(algo), len(raw_test), sr.score, dict(cfg, algo=algo), raw_test)
+        run("get_performance[{}]".format(algo), len(test_y), ev.get_performance, test_y, y_hat)
+    return records
+
+
+def compare(results, baseline, time_threshold, memory_threshold, min_seconds=0.01, min_mb=1.0):
+    """Compares results against a baseline.
+
+    A stage regressed when it takes more than ``1 + time_threshold`` times the
+    baseline seconds, or more than ``1 + memory_threshold`` times the
+    baseline peak memory; differences below ``min_seconds`` and ``min_mb``
+    are treated as noise.
+
+    Return
+    ------
+        regressions: list
+            (stage, size, metric, baseline, current) of the regressed stages
+    """
+    previous = {(record["stage"], record["size"]): record for record in baseline["results"]}
+    regressions = []
+    for record in results["results"]:
+        base = previous.get((record["stage"], record["size"]))
+        if base is None:
+            continue
+        limits = [("seconds", time_threshold, min_seconds), ("peak_mb", memory_threshold, min_mb)]
+        for metric, threshold, floor in limits:
+            if record[metric] > base[metric] * (1 + threshold) and record[metric] - base[metric] > floor:
+                regressions.append((record["stage"], record["size"], metric, base[metric], record[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", default=["10k", "1M", "10M"], help="rows, e.g. 10000, 10k or 1M")
+    parser.add_argument("--config", default="config/config.yml", help="config with the preprocessing and model params")
+    parser.add_argument("--algos", nargs="+", default=list(tr.ALGOS))
+    parser.add_argument("--fit-rows", type=int, default=100000, help="max training rows of the model fits")
+    parser.add_argument("--single-rows", type=int, default=200, help="rows scored one request at a time")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="baseline results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to --baseline")
+    parser.add_argument("--time-threshold", type=float, default=0.2, help="allowed relative slowdown")
+    parser.add_argument("--memory-threshold", type=float, default=0.2, help="allowed relative peak memory growth")
+    args = parser.parse_args()
+
+    # sklearn feature name warnings would be printed once per scored chunk
+    warnings.simplefilter("ignore", UserWarning)
+    cfg = ut.read_config(args.config)
+    results = {
+        "meta": {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+                 "sklearn": sklearn.__version__, "platform": platform.platform(), "cpus": os.cpu_count(),
+                 "fit_rows": args.fit_rows, "single_rows": args.single_rows,
+                 "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": [],
+    }
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results["results"] += run_size(cfg, parse_size(size), args.algos, args.fit_rows, args.single_rows,
+                                           work_dir)
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=2)
+    print("results written to {}".format(args.output))
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as fp:
+            json.dump(results, fp, indent=2)
+        print("baseline written to {}".format(args.baseline))
+    elif args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.time_threshold, args.memory_threshold)
+        for stage, size, metric, before, after in regressions:
+            print("REGRESSION {} at {} rows: {} {:.3f} -> {:.3f} ({:+.0%})".format(
+                stage, size, metric, before, after, after / before - 1))
+        if regressions:
+            sys.exit(1)
+        print("no regressions against {}".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,27 @@
 import pandas as pd
+from housing.modeling import registry as rg
 from housing.modeling import score as sr
+from housing.preparation import instrumentation as im
 from housing.preparation import utils as ut
 
 ut.configure_logger()
 score_cfg_path = "./config/score_config.yml"
 score_cfg = ut.read_config(score_cfg_path)
-score_df = pd.read_csv(score_cfg["score_data_path"])
-if "median_house_value" in score_df.columns:
-    X = score_df.drop("median_house_value", axis=1)
-    y = score_df["median_house_value"]
+rg.configure_registry(mmap_mode=score_cfg.get("registry_mmap_mode"))
+im.configure_instrumentation(**score_cfg.get("instrumentation", {}))
+if score_cfg.get("output_path"):
+    summary = sr.score_stream(score_cfg, score_cfg["score_data_path"], score_cfg["output_path"],
+                              chunk_size=score_cfg.get("chunk_size", 100000), preproc=score_cfg["preproc"],
+                              n_workers=score_cfg.get("n_workers", 1))
 else:
-    X = score_df
-y_hat = sr.score(score_cfg, X, preproc=score_cfg["preproc"])
+    score_df = pd.read_csv(score_cfg["score_data_path"])
+    if "median_house_value" in score_df.columns:
+        X = score_df.drop("median_house_value", axis=1)
+        y = score_df["median_house_value"]
+    else:
+        X = score_df
+    if score_cfg.get("n_workers", 1) == 1:
+        y_hat = sr.score(score_cfg, X, preproc=score_cfg["preproc"])
+    else:
+        y_hat = sr.score_parallel(score_cfg, X, chunk_size=score_cfg.get("chunk_size", 100000),
+                                  n_workers=score_cfg["n_workers"], preproc=score_cfg["preproc"])
@@ -1,19 +1,34 @@
+import pandas as pd
 from housing.modeling import eval as ev
+from housing.modeling import incremental as inc
 from housing.modeling import score as sr
 from housing.modeling import train as tr
+from housing.modeling import tuning as tn
 from housing.preparation import data_utils as du
+from housing.preparation import instrumentation as im
 from housing.preparation import utils as ut
 
 ut.configure_logger()
 cfg_path = "./config/config.yml"
 cfg = ut.read_config(cfg_path)
+im.configure_instrumentation(**cfg.get("instrumentation", {}))
 
-train, test = du.prepare_model_data(cfg)
-X = train.drop("median_house_value", axis=1)
-y = train["median_house_value"]
-model = tr.model_selection_fit(cfg, X, y)
-y_train_hat = sr.score(cfg, X, preproc=True)
-y_test_hat = sr.score(cfg, test.drop("median_house_value", axis=1), preproc=True)
+if cfg.get("incremental", False):
+    batch = pd.read_csv(cfg["incremental_data_path"])
+    model = inc.incremental_fit(cfg, batch.drop("median_house_value", axis=1), batch["median_house_value"])
+    y_batch_hat = sr.score(cfg, batch.drop("median_house_value", axis=1))
+    batch_performance = ev.get_performance(batch["median_house_value"], y_batch_hat)
+else:
+    train, test = du.prepare_model_data(cfg)
+    X = train.drop("median_house_value", axis=1)
+    y = train["median_house_value"]
+    if cfg.get("tune", False):
+        leaderboard = tn.tune(cfg, X, y)
+        cfg = tn.best_config(cfg, leaderboard)
+    model = tr.model_selection_fit(cfg, X, y)
+    inc.init_state(cfg, X, y)
+    y_train_hat = sr.score(cfg, X, preproc=True)
+    y_test_hat = sr.score(cfg, test.drop("median_house_value", axis=1), preproc=True)
 
-train_performance = ev.get_performance(y, y_train_hat)
-test_performance = ev.get_performance(test["median_house_value"], y_test_hat)
+    train_performance = ev.get_performance(y, y_train_hat)
+    test_performance = ev.get_performance(test["median_house_value"], y_test_hat)
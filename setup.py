@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import find_packages, setup
 
 
 setup(
@@ -6,4 +6,6 @@ setup(
     version="0.1",
     description="Median Housing Value Prediction",
     package_dir={"": "src"},
+    packages=find_packages("src"),
+    entry_points={"console_scripts": ["housing=housing.cli:main"]},
 )
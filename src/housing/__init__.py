@@ -0,0 +1,18 @@
+"""Housing price modeling package.
+
+Submodules are imported on first attribute access, so ``import housing``
+does not load pandas or sklearn.
+"""
+import importlib
+
+_SUBMODULES = {"modeling", "preparation", "processing"}
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | _SUBMODULES)
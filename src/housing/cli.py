@@ -0,0 +1,554 @@
+"""Command line runner of the training pipeline.
+
+The workflow of ``notebook/model_train.py`` is modeled as a graph of stages,
+fetch, load, split, fit pipeline, transform test, train, score and evaluate,
+connected by the files they read and write. Every run records the config
+values, input digests and output digests of the executed stages in a state
+file, and the next run only re-executes the stages whose config keys,
+inputs or outputs changed. Stages whose inputs are ready run in parallel
+worker processes, e.g. the test transform next to the model fits and the
+fits of several algos next to each other.
+With ``tune`` set the hyperparameter search runs first and its best
+candidate is trained as the config version, like ``model_train.py``.
+
+    housing run --config config/config.yml
+    housing run --config config/config.yml --algos linear-ridge random_forest --jobs 4
+    housing run --config config/config.yml --force fit_pipeline
+    housing status --config config/config.yml
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+from housing.preparation import data_utils as du
+from housing.preparation import instrumentation as im
+from housing.preparation import storage as st
+from housing.preparation import utils as ut
+
+logger = logging.getLogger(__name__)
+
+TARGET = "median_house_value"
+
+FETCH_KEYS = ["housing_url", "housing_sha256", "raw_data_format"]
+LOAD_KEYS = ["compact_dtypes", "raw_data_columns", "raw_data_engine", "raw_data_format"]
+SPLIT_KEYS = ["sampling_method", "seed", "test_size"]
+FIT_KEYS = [
+    "num_impute",
+    "num_constant",
+    "cat_impute",
+    "cat_constant",
+    "add_bedrooms_per_room",
+    "extra_features",
+    "encoding",
+    "neighborhood_features",
+    "neighborhood_k",
+    "neighborhood_columns",
+    "neighborhood_target",
+    "neighborhood_folds",
+    "neighborhood_metric",
+    "seed",
+    "model_data_format",
+    "artifact_compress",
+]
+TRANSFORM_KEYS = ["model_data_format"]
+TUNE_KEYS = ["tune", "tuning", "seed"]
+TRAIN_KEYS = ["seed", "artifact_compress", "export_flat_model", "flat_model_dtype", "flat_model_prune"]
+TREE_ALGOS = ["decision_tree", "random_forest"]
+
+
+class Stage:
+    """A stage of the pipeline graph.
+
+    Parameters
+    ----------
+        name: str
+            stage name
+        func: callable
+            module level function ``func(cfg, paths)`` doing the work, it
+            gets the paths of the input and output artifacts by name
+        inputs: list
+            names of the artifacts the stage reads
+        outputs: list
+            names of the artifacts the stage writes
+        keys: list
+            config keys the outputs depend on
+        refresh: dict, default None
+            config overrides when a stage that ran before is re-executed,
+            e.g. to download the raw data again
+        params: dict, default None
+            extra config values of the stage, e.g. the algo of a train stage
+        optional: list, default None
+            outputs the stage may not write, e.g. the flat model of a tuned algo
+        local: bool, default False
+            always run in this process, for stages that start their own workers
+    """
+
+    def __init__(self, name, func, inputs, outputs, keys, refresh=None, params=None, optional=None, local=False):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.keys = list(keys)
+        self.refresh = refresh or {}
+        self.params = params or {}
+        self.optional = list(optional or [])
+        self.local = local
+
+    def config(self, cfg):
+        """Returns the JSON normalized config values the stage depends on."""
+        values = {key: cfg.get(key) for key in self.keys}
+        values.update(self.params)
+        return json.loads(json.dumps(values, sort_keys=True, default=str))
+
+
+def _json_value(value):
+    return value.item() if isinstance(value, np.generic) else str(value)
+
+
+def _frame_base(path):
+    return os.path.splitext(path)[0]
+
+
+def _load_model_data(path):
+    return st.load_frame(_frame_base(path), os.path.splitext(path)[1][1:])
+
+
+def _fetch(cfg, paths):
+    du.fetch_housing_data(**cfg)
+
+
+def _load(cfg, paths):
+    data = du.load_housing_data(cfg["housing_path"], cfg.get("compact_dtypes", True), cfg.get("raw_data_columns"),
+                                cfg.get("raw_data_engine"), cfg.get("raw_data_format", "csv"))
+    data.to_pickle(paths["data"])
+
+
+def _split(cfg, paths):
+    train, test = du.get_train_test_split(pd.read_pickle(paths["data"]), cfg["sampling_method"], cfg["seed"],
+                                          cfg["test_size"])
+    train.to_pickle(paths["train_split"])
+    test.to_pickle(paths["test_split"])
+
+
+def _fit_pipeline(cfg, paths):
+    from housing.modeling import artifacts as ar
+
+    train = pd.read_pickle(paths["train_split"])
+    X = train.drop(TARGET, axis=1)
+    y = train[TARGET].astype(np.float64)
+    pl = du.build_pipeline(cfg, list(X.select_dtypes(exclude=np.number).columns))
+    X = im.fit_transform_steps(pl, X, y)
+    st.save_frame(du.model_data(X, y, du.get_feature_names(pl)), _frame_base(paths["train"]),
+                  cfg.get("model_data_format", "csv"))
+    ar.save_artifact(pl, paths["pipeline"], cfg.get("artifact_compress", 0))
+
+
+def _transform_test(cfg, paths):
+    from housing.modeling import artifacts as ar
+
+    pl = ar.load_artifact(paths["pipeline"])
+    test = pd.read_pickle(paths["test_split"])
+    X = im.transform_steps(pl, test.drop(TARGET, axis=1))
+    st.save_frame(du.model_data(X, test[TARGET].astype(np.float64), du.get_feature_names(pl)),
+                  _frame_base(paths["test"]), cfg.get("model_data_format", "csv"))
+
+
+def _tune(cfg, paths):
+    from housing.modeling import tuning as tn
+
+    train = _load_model_data(paths["train"])
+    best = tn.best_config(cfg, tn.tune(cfg, train.drop(TARGET, axis=1), train[TARGET]))
+    with open(paths["tuned"], "w") as fp:
+        json.dump({"algo": best["algo"], "params": best[best["algo"]]}, fp, indent=2, default=_json_value)
+
+
+def _train(cfg, paths):
+    from housing.modeling import incremental as inc
+    from housing.modeling import train as tr
+
+    if "tuned" in paths:
+        with open(paths["tuned"], "r") as fp:
+            best = json.load(fp)
+        cfg = dict(cfg, algo=best["algo"], **{best["algo"]: best["params"]})
+    train = _load_model_data(paths["train"])
+    X = train.drop(TARGET, axis=1)
+    y = train[TARGET]
+    tr.model_selection_fit(cfg, X, y)
+    if cfg["primary"]:
+        inc.init_state(cfg, X, y)
+
+
+def _score(cfg, paths):
+    from housing.modeling import artifacts as ar
+
+    model = ar.load_artifact(paths["model_" + cfg["label"]])
+    y_hat = {}
+    for name in ["train", "test"]:
+        y_hat[name] = model.predict(_load_model_data(paths[name]).drop(TARGET, axis=1))
+    np.savez(paths["predictions_" + cfg["label"]], **y_hat)
+
+
+def _evaluate(cfg, paths):
+    from housing.modeling import eval as ev
+
+    y_true = {name: _load_model_data(paths[name])[TARGET] for name in ["train", "test"]}
+    report = {}
+    for label, version in cfg["versions"].items():
+        with np.load(paths["predictions_" + label]) as y_hat:
+            report[label] = {"version": version}
+            for name in ["train", "test"]:
+                report[label][name] = ev.get_performance(y_true[name], y_hat[name])
+        logger.info("{} test performance {}".format(label, report[label]["test"]))
+    with open(paths["metrics"], "w") as fp:
+        json.dump(report, fp, indent=2, default=float)
+
+
+def work_dir(cfg):
+    """Returns the directory of the intermediate data and the state file of a config."""
+    return cfg.get("pipeline_work_dir") or os.path.join(cfg["model_data_path"], "pipeline")
+
+
+def state_path(cfg):
+    """Returns the state file of a config."""
+    return os.path.join(work_dir(cfg), "state_{version}.json".format(**cfg))
+
+
+def algo_version(cfg, algo):
+    """Returns the model version of an algo, the config version for the config algo when not tuning."""
+    if algo == cfg["algo"] and not cfg.get("tune", False):
+        return cfg["version"]
+    return "{}_{}".format(cfg["version"], algo)
+
+
+def build_graph(cfg, algos=None):
+    """Builds the stages and artifact paths of a config.
+
+    The config algo is trained as the config version like ``model_train.py``
+    does, with the flat and lite exports and the incremental state. With
+    ``tune`` a tune stage searches the ``tuning`` spaces first and the best
+    candidate, labelled ``best``, is trained as the config version instead.
+    The given algos are trained as ``{version}_{algo}`` for comparison.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration dict
+        algos: list, default None
+            algos to train, the config algo when not given and not tuning
+
+    Return
+    ------
+        stages: list
+            stages in dependency order
+        artifacts: dict
+            artifact name to file path
+    """
+    from housing.modeling import incremental as inc
+    from housing.modeling import lite as lt
+    from housing.modeling import registry as rg
+
+    tune = cfg.get("tune", False)
+    algos = list(dict.fromkeys(algos or ([] if tune else [cfg["algo"]])))
+    fmt = cfg.get("model_data_format", "csv")
+    tmp_dir = work_dir(cfg)
+    artifacts = {
+        "raw": du.raw_data_path(cfg["housing_path"], cfg.get("raw_data_format", "csv")),
+        "data": os.path.join(tmp_dir, "data_{version}.pkl".format(**cfg)),
+        "train_split": os.path.join(tmp_dir, "train_split_{version}.pkl".format(**cfg)),
+        "test_split": os.path.join(tmp_dir, "test_split_{version}.pkl".format(**cfg)),
+        "pipeline": rg.artifact_paths(cfg)[1],
+        "train": st.frame_path(os.path.join(cfg["model_data_path"], "train_{version}".format(**cfg)), fmt),
+        "test": st.frame_path(os.path.join(cfg["model_data_path"], "test_{version}".format(**cfg)), fmt),
+        "state": inc.state_path(cfg),
+        "flat_model": rg.artifact_paths(dict(cfg, flat_inference=True))[0],
+        "lite_model": lt.lite_path(cfg),
+        "metrics": os.path.join(tmp_dir, "metrics_{version}.json".format(**cfg)),
+    }
+    stages = [
+        Stage("fetch", _fetch, [], ["raw"], FETCH_KEYS, refresh={"over_write_raw_data": True}),
+        Stage("load", _load, ["raw"], ["data"], LOAD_KEYS),
+        Stage("split", _split, ["data"], ["train_split", "test_split"], SPLIT_KEYS),
+        Stage("fit_pipeline", _fit_pipeline, ["train_split"], ["pipeline", "train"], FIT_KEYS),
+        Stage("transform_test", _transform_test, ["pipeline", "test_split"], ["test"], TRANSFORM_KEYS),
+    ]
+    labels = [(algo, algo, False) for algo in algos]
+    if tune:
+        artifacts["leaderboard"] = os.path.join(cfg["models_path"], "leaderboard_{version}.csv".format(**cfg))
+        artifacts["tuned"] = os.path.join(tmp_dir, "tuned_{version}.json".format(**cfg))
+        # the tuning runs its own worker processes
+        stages.append(Stage("tune", _tune, ["train"], ["leaderboard", "tuned"],
+                            TUNE_KEYS + sorted(cfg["tuning"]["spaces"]), local=True))
+        labels.insert(0, ("best", None, True))
+    elif cfg["algo"] in algos:
+        labels[algos.index(cfg["algo"])] = (cfg["algo"], cfg["algo"], True)
+
+    versions = {}
+    for label, algo, primary in labels:
+        version = versions[label] = cfg["version"] if primary else algo_version(cfg, algo)
+        artifacts["model_" + label] = rg.artifact_paths(dict(cfg, version=version, flat_inference=False))[0]
+        artifacts["predictions_" + label] = os.path.join(tmp_dir, "predictions_{}.npz".format(version))
+        inputs, outputs, optional = ["train", "pipeline"], ["model_" + label], []
+        keys = TRAIN_KEYS + ([] if algo is None else [algo])
+        params = {"label": label, "version": version, "primary": primary}
+        if algo is not None:
+            params["algo"] = algo
+        if primary:
+            keys += ["tune", "export_lite_model"]
+            outputs.append("state")
+            if cfg.get("export_lite_model", False):
+                outputs.append("lite_model")
+            if cfg.get("export_flat_model", False) and algo in TREE_ALGOS + [None]:
+                outputs.append("flat_model")
+                if algo is None:
+                    # only written when the best candidate is a tree model
+                    optional.append("flat_model")
+            if tune:
+                inputs.append("tuned")
+        else:
+            # the serving exports need the pipeline of the version, which only the config version has
+            params.update(export_flat_model=False, export_lite_model=False)
+        stages.append(Stage("train_" + label, _train, inputs, outputs, keys, params=params, optional=optional))
+        stages.append(Stage("score_" + label, _score, ["model_" + label, "train", "test"], ["predictions_" + label],
+                            [], params={"label": label}))
+    stages.append(Stage("evaluate", _evaluate, ["train", "test"] + ["predictions_" + label for label in versions],
+                        ["metrics"], [], params={"versions": versions}))
+    return stages, artifacts
+
+
+def file_digest(path, known=None):
+    """Returns the size, mtime and SHA-256 of a file, None when it does not exist.
+
+    The SHA-256 of ``known`` is reused when the size and mtime did not change.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return known
+    return [stat.st_size, stat.st_mtime_ns, ut.sha256_file(path)]
+
+
+def load_state(path):
+    """Returns the recorded stages of a state file, empty when it does not exist."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as fp:
+        return json.load(fp)
+
+
+def _save_state(path, state):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(state, fp, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _same_digest(current, recorded):
+    return current is not None and recorded is not None and current[2] == recorded[2]
+
+
+def stale_reason(stage, cfg, artifacts, record):
+    """Returns why a stage has to run, None when its recorded run is up to date.
+
+    Parameters
+    ----------
+        stage: Stage
+            stage to check
+        cfg: dict
+            configuration dict
+        artifacts: dict
+            artifact name to file path
+        record: dict
+            recorded run of the stage, None when it never ran
+
+    Return
+    ------
+        reason: str
+            never run, config changed, input changed or output changed; None when up to date
+    """
+    if record is None:
+        return "never run"
+    recorded = record["config"]
+    config = stage.config(cfg)
+    changed = sorted(key for key in set(config) | set(recorded) if config.get(key) != recorded.get(key))
+    if changed:
+        return "config changed: {}".format(", ".join(changed))
+    for name in stage.inputs:
+        path = artifacts[name]
+        if not _same_digest(file_digest(path, record["inputs"].get(path)), record["inputs"].get(path)):
+            return "input changed: {}".format(name)
+    for name in stage.outputs:
+        path = artifacts[name]
+        digest = file_digest(path, record["outputs"].get(path))
+        if name in stage.optional and digest is None and record["outputs"].get(path) is None:
+            continue
+        if not _same_digest(digest, record["outputs"].get(path)):
+            return "output changed: {}".format(name)
+    return None
+
+
+def _run_stage(func, cfg, paths):
+    start = time.perf_counter()
+    func(cfg, paths)
+    return time.perf_counter() - start
+
+
+def _submit(executor, func, cfg, paths):
+    """Runs a stage in a worker process, or right away in this one without an executor."""
+    if executor is not None:
+        return executor.submit(_run_stage, func, cfg, paths)
+    future = Future()
+    try:
+        future.set_result(_run_stage(func, cfg, paths))
+    except Exception as error:
+        future.set_exception(error)
+    return future
+
+
+def run_pipeline(cfg, algos=None, jobs=1, force=(), dry_run=False):
+    """Runs the stages of the pipeline that are not up to date.
+
+    A stage runs once the stages producing its inputs finished. Its
+    staleness is checked then, so a stage whose upstream stage re-ran but
+    wrote identical files is still skipped. The state file is written after
+    every finished stage, a failed run resumes after the last finished one.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration dict
+        algos: list, default None
+            algos to train, the config algo when not given
+        jobs: int, default 1
+            worker processes running independent stages, 1 to run them in this process
+        force: list, default ()
+            stages to run even if they are up to date
+        dry_run: bool, default False
+            only report what would run
+
+    Return
+    ------
+        status: dict
+            stage name to ``ran``, ``up to date`` or ``would run: <reason>``
+    """
+    stages, artifacts = build_graph(cfg, algos)
+    unknown = set(force) - {stage.name for stage in stages}
+    if unknown:
+        raise ValueError("unknown stages {}, expected some of {}".format(sorted(unknown), [s.name for s in stages]))
+    path = state_path(cfg)
+    state = load_state(path)
+    producers = {name: stage.name for stage in stages for name in stage.outputs}
+    upstream = {stage.name: {producers[name] for name in stage.inputs if name in producers} for stage in stages}
+    os.makedirs(work_dir(cfg), exist_ok=True)
+    for name in ["pipeline", "train", "test"]:
+        os.makedirs(os.path.dirname(os.path.abspath(artifacts[name])), exist_ok=True)
+
+    status, done, stale, running = {}, set(), set(), {}
+    pending = list(stages)
+    error = None
+    executor = ProcessPoolExecutor(jobs) if jobs > 1 and not dry_run else None
+    try:
+        while pending or running:
+            ready = [stage for stage in pending if upstream[stage.name] <= done] if error is None else []
+            for stage in ready:
+                pending.remove(stage)
+                record = state.get(stage.name)
+                reason = "forced" if stage.name in force else stale_reason(stage, cfg, artifacts, record)
+                if dry_run and reason is None and upstream[stage.name] & stale:
+                    reason = "upstream out of date"
+                if reason is None:
+                    status[stage.name] = "up to date"
+                    done.add(stage.name)
+                elif dry_run:
+                    status[stage.name] = "would run: {}".format(reason)
+                    stale.add(stage.name)
+                    done.add(stage.name)
+                else:
+                    logger.info("running stage {} ({})".format(stage.name, reason))
+                    stage_cfg = dict(cfg, **stage.params)
+                    if record is not None:
+                        stage_cfg.update(stage.refresh)
+                    paths = {name: artifacts[name] for name in stage.inputs + stage.outputs}
+                    inputs = {artifacts[name]: file_digest(artifacts[name]) for name in stage.inputs}
+                    running[_submit(None if stage.local else executor, stage.func, stage_cfg, paths)] = (stage, inputs)
+            if not running:
+                if ready:
+                    # skipped stages may have made others ready
+                    continue
+                break
+            completed, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in completed:
+                stage, inputs = running.pop(future)
+                try:
+                    seconds = future.result()
+                    missing = [name for name in stage.outputs
+                               if name not in stage.optional and not os.path.exists(artifacts[name])]
+                    if missing:
+                        raise RuntimeError("stage {} did not write {}".format(stage.name, ", ".join(missing)))
+                except Exception as stage_error:
+                    logger.error("stage {} failed: {}".format(stage.name, stage_error))
+                    status[stage.name] = "failed"
+                    error = error or stage_error
+                    continue
+                state[stage.name] = {
+                    "config": stage.config(cfg),
+                    "inputs": inputs,
+                    "outputs": {artifacts[name]: file_digest(artifacts[name]) for name in stage.outputs},
+                    "seconds": round(seconds, 3),
+                    "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                }
+                _save_state(path, state)
+                status[stage.name] = "ran"
+                done.add(stage.name)
+                logger.info("finished stage {} in {:.2f}s".format(stage.name, seconds))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if error is not None:
+        raise error
+    return status
+
+
+def main(argv=None):
+    """Entry point of the ``housing`` command."""
+    parser = argparse.ArgumentParser(prog="housing", description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    for command, description in [("run", "run the stages that are not up to date"),
+                          ("status", "show which stages would run and why")]:
+        sub = commands.add_parser(command, help=description)
+        sub.add_argument("--config", default="./config/config.yml", help="training config")
+        sub.add_argument("--algos", nargs="+", help="algos to train, the config algo when not given")
+        sub.add_argument("--force", nargs="+", default=[], help="stages to run even if they are up to date")
+        if command == "run":
+            sub.add_argument("--jobs", type=int, default=1, help="worker processes running independent stages")
+            sub.add_argument("--log-conf", default="./config/log.conf", help="logging config, empty for basic logging")
+    args = parser.parse_args(argv)
+
+    if args.command == "run" and args.log_conf:
+        ut.configure_logger(args.log_conf)
+    else:
+        logging.basicConfig(level=logging.INFO if args.command == "run" else logging.WARNING)
+    cfg = ut.read_config(args.config)
+    im.configure_instrumentation(**cfg.get("instrumentation", {}))
+    try:
+        status = run_pipeline(cfg, args.algos, args.jobs if args.command == "run" else 1, args.force,
+                              dry_run=args.command == "status")
+    except Exception as error:
+        logger.error("pipeline failed: {}".format(error))
+        return 1
+    for name, stage_status in status.items():
+        print("{:<28} {}".format(name, stage_status))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
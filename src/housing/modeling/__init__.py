@@ -0,0 +1,31 @@
+"""Training, scoring and model artifacts.
+
+Submodules are imported on first attribute access, so ``import housing.modeling``
+does not load sklearn, pandas or joblib.
+"""
+import importlib
+
+_SUBMODULES = {
+    "artifacts",
+    "batching",
+    "compiled",
+    "eval",
+    "incremental",
+    "lite",
+    "prediction_cache",
+    "registry",
+    "score",
+    "train",
+    "trees",
+    "tuning",
+}
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | _SUBMODULES)
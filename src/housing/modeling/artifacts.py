@@ -0,0 +1,54 @@
+import logging
+import os
+
+import joblib
+
+logger = logging.getLogger(__name__)
+
+
+def save_artifact(obj, path, compress=0):
+    """Saves a model, pipeline or state object.
+
+    Large numpy arrays inside the object are stored as separate raw buffers
+    by joblib, so an uncompressed artifact can be memory-mapped on load.
+
+    Parameters
+    ----------
+        obj: object
+            object to save
+        path: str
+            artifact path
+        compress: int or str, default 0
+            joblib compression level 0-9 or method such as 'zlib' or 'lz4';
+            compressed artifacts can not be memory-mapped
+
+    Return
+    ------
+        path: str
+            artifact path
+    """
+    tmp_path = path + ".tmp"
+    joblib.dump(obj, tmp_path, compress=compress)
+    # replace atomically so processes polling the registry never see a partial file
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_artifact(path, mmap_mode=None):
+    """Loads an artifact saved by ``save_artifact`` or a plain pickle.
+
+    Parameters
+    ----------
+        path: str
+            artifact path
+        mmap_mode: str, default None
+            'r' or 'c' to memory-map the numpy arrays of an uncompressed
+            artifact, shared through the page cache by all processes that
+            load it
+
+    Return
+    ------
+        obj: object
+            loaded object
+    """
+    return joblib.load(path, mmap_mode=mmap_mode)
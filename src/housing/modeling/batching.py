@@ -0,0 +1,124 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Coalesces concurrent single observation predictions into batches.
+
+    Callers submit one observation at a time from any thread. A background
+    thread waits at most ``max_wait_ms`` after the first pending observation
+    for others to arrive, then scores up to ``max_batch_size`` of them with a
+    single ``score_fn`` call, so the pipeline and model overhead is paid once
+    per batch instead of once per request. If a batch fails, its observations
+    are retried one by one so a bad observation only fails its own request.
+    A ``score_fn`` that returns a different number of predictions than it got
+    observations fails every request of the batch, the predictions can not be
+    matched to the requests.
+
+    Parameters
+    ----------
+        score_fn: callable
+            takes a list of observation dicts and returns one prediction per observation
+        max_batch_size: int, default 64
+            maximum number of observations scored together
+        max_wait_ms: float, default 5
+            maximum time to wait for a batch to fill up
+    """
+
+    def __init__(self, score_fn, max_batch_size=64, max_wait_ms=5):
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, observation):
+        """Queues an observation for scoring.
+
+        Parameters
+        ----------
+            observation: dict
+                feature name to value
+
+        Return
+        ------
+            future: concurrent.futures.Future
+                resolves to the prediction
+        """
+        if self._closed:
+            raise RuntimeError("batcher is closed")
+        future = Future()
+        self._queue.put((observation, future))
+        return future
+
+    def predict(self, observation, timeout=None):
+        """Scores an observation and waits for the prediction."""
+        return self.submit(observation).result(timeout=timeout)
+
+    def close(self):
+        """Stops the background thread after the pending observations are scored."""
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            batch = [(obs, future) for obs, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            logger.debug("scoring micro batch of {}".format(len(batch)))
+            try:
+                predictions = self.score_fn([obs for obs, _ in batch])
+            except Exception as error:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(error)
+                else:
+                    logger.warning("micro batch of {} failed, scoring one by one".format(len(batch)))
+                    self._score_each(batch)
+                continue
+            if len(predictions) != len(batch):
+                error = RuntimeError("score_fn returned {} predictions for {} observations".format(
+                    len(predictions), len(batch)))
+                logger.error(str(error))
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future), prediction in zip(batch, predictions):
+                future.set_result(prediction)
+
+    def _score_each(self, batch):
+        for obs, future in batch:
+            try:
+                future.set_result(self.score_fn([obs])[0])
+            except Exception as error:
+                future.set_exception(error)
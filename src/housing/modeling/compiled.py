@@ -0,0 +1,184 @@
+import logging
+
+import numpy as np
+from housing.processing import features as ft
+
+logger = logging.getLogger(__name__)
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+class CompiledPipeline:
+    """Flat NumPy inference plan for a pipeline fitted by ``prepare_model_data``.
+
+    The imputation fill values, derived feature specs and one-hot vocabulary
+    are read out of the fitted ``imputer``, ``attribs_adder`` and
+    ``label_endcode`` steps once, and ``transform`` applies them with plain
+    array operations, without building any DataFrame. An optional
+    ``neighborhood`` step is applied with its tree query on the imputed
+    coordinates. The output matches
+    ``pipeline.transform``, as a dense array for the sparse encoding.
+
+    Parameters
+    ----------
+        pipeline: sklearn.pipeline.Pipeline
+            fitted preprocessing pipeline
+    """
+
+    def __init__(self, pipeline):
+        imputer = pipeline.named_steps["imputer"]
+        adder = pipeline.named_steps["attribs_adder"]
+        encoder = pipeline.named_steps["label_endcode"]
+        self.neighborhood_ = pipeline.named_steps.get("neighborhood")
+
+        self.feature_names_ = list(imputer.dtype_dict_.index)
+        self.num_cols_ = list(imputer.num_cols_)
+        self.cat_cols_ = list(imputer.cat_cols_)
+        self.num_dtypes_ = [imputer.dtype_dict_[col] for col in self.num_cols_]
+        self.num_fill_ = np.asarray(imputer.imputer_.named_transformers_["num"].statistics_, dtype=np.float64)
+        self.cat_fill_ = list(imputer.imputer_.named_transformers_["cat"].statistics_) if self.cat_cols_ else []
+
+        self.feature_specs_ = list(adder.specs_)
+        inputs = {col for _, _, left, right in self.feature_specs_ for col in (left, right)}
+        if not inputs <= set(self.num_cols_):
+            raise ValueError("derived features on non numeric columns {} are not supported".format(
+                sorted(inputs - set(self.num_cols_))))
+        self.n_neighbor_features_ = 0
+        if self.neighborhood_ is not None:
+            if not set(self.neighborhood_.coords) <= set(self.num_cols_):
+                raise ValueError("neighborhood coordinates {} are not numeric columns".format(
+                    list(self.neighborhood_.coords)))
+            self.n_neighbor_features_ = len(self.neighborhood_.feature_names_)
+
+        ohe = encoder.named_transformers_["label_endcoder"]
+        encoded_cols = encoder.transformers_[0][2]
+        if list(encoded_cols) != self.cat_cols_:
+            raise ValueError("encoded columns {} do not match the categorical columns".format(encoded_cols))
+        self.handle_unknown_ = ohe.handle_unknown
+        self.ordinal_ = getattr(ohe, "mode", "onehot") == "ordinal"
+        self.vocabulary_ = [{cat: ix for ix, cat in enumerate(cats)} for cats in ohe.categories_]
+        offsets = np.cumsum([0] + [1 if self.ordinal_ else len(cats) for cats in ohe.categories_])
+        self.onehot_offsets_ = offsets[:-1]
+        self.n_onehot_ = int(offsets[-1])
+
+        # map the passthrough columns (num + cat + derived + neighbor layout) onto the numeric block
+        n_num, n_cat = len(self.num_cols_), len(self.cat_cols_)
+        remainder = encoder.transformers_[-1]
+        passthrough = list(remainder[2]) if remainder[0] == "remainder" and remainder[1] == "passthrough" else []
+        numeric_ix = []
+        for ix in passthrough:
+            if ix < n_num:
+                numeric_ix.append(ix)
+            elif ix >= n_num + n_cat:
+                numeric_ix.append(ix - n_cat)
+            else:
+                raise ValueError("categorical passthrough columns are not supported")
+        self.passthrough_ix_ = np.array(numeric_ix, dtype=np.intp)
+        self.n_features_out_ = self.n_onehot_ + len(numeric_ix)
+
+    def _columns(self, X):
+        """Splits the input into a float block of numeric columns and lists of categorical values."""
+        if isinstance(X, dict):
+            values = [X[col] for col in self.feature_names_]
+            if np.ndim(values[0]) == 0:
+                values = [[value] for value in values]
+            columns = dict(zip(self.feature_names_, values))
+        elif isinstance(X, list):
+            columns = {col: [row[col] for row in X] for col in self.feature_names_}
+        elif hasattr(X, "columns"):
+            columns = {col: X[col].to_numpy() for col in self.feature_names_}
+        else:
+            X = np.asarray(X)
+            if X.ndim != 2 or X.shape[1] != len(self.feature_names_):
+                raise ValueError("expected a 2-D array with columns {}".format(self.feature_names_))
+            columns = {col: X[:, ix] for ix, col in enumerate(self.feature_names_)}
+
+        n_rows = len(columns[self.feature_names_[0]])
+        num = np.empty((n_rows, len(self.num_cols_) + len(self.feature_specs_) + self.n_neighbor_features_),
+                       dtype=np.float64)
+        for ix, col in enumerate(self.num_cols_):
+            values = columns[col]
+            if isinstance(values, list):
+                values = [np.nan if value is None else value for value in values]
+            num[:, ix] = values
+        cats = [columns[col] for col in self.cat_cols_]
+        return num, cats
+
+    def transform(self, X):
+        """Applies the compiled plan.
+
+        Parameters
+        ----------
+            X: dict, list of dict, pd.DataFrame or np.array
+                raw observations; a 2-D array must follow the fitted column order
+
+        Return
+        ------
+            X: np.array
+                transformed data, same as ``pipeline.transform``
+        """
+        num, cats = self._columns(X)
+        n_num = len(self.num_cols_)
+        block = num[:, :n_num]
+        missing = np.isnan(block)
+        if missing.any():
+            block[missing] = np.take(self.num_fill_, np.nonzero(missing)[1])
+        for ix, dtype in enumerate(self.num_dtypes_):
+            if dtype != np.float64:
+                block[:, ix] = block[:, ix].astype(dtype)
+
+        columns = {col: block[:, ix] for ix, col in enumerate(self.num_cols_)}
+        n_derived = n_num + len(self.feature_specs_)
+        ft.compute_features(columns, self.feature_specs_, out=num[:, n_num:n_derived])
+        if self.neighborhood_ is not None:
+            num[:, n_derived:] = self.neighborhood_.neighbor_features(columns)
+
+        out = np.zeros((num.shape[0], self.n_features_out_), dtype=np.float64)
+        for col_ix, values in enumerate(cats):
+            vocabulary = self.vocabulary_[col_ix]
+            offset = self.onehot_offsets_[col_ix]
+            for row, value in enumerate(values):
+                if _is_missing(value):
+                    value = self.cat_fill_[col_ix]
+                code = vocabulary.get(value)
+                if code is None:
+                    if self.handle_unknown_ == "error":
+                        raise ValueError("Found unknown category {} in column {} during transform".format(
+                            value, self.cat_cols_[col_ix]))
+                    if self.ordinal_:
+                        out[row, offset] = -1.0
+                    continue
+                if self.ordinal_:
+                    out[row, offset] = code
+                else:
+                    out[row, offset + code] = 1.0
+        out[:, self.n_onehot_:] = num[:, self.passthrough_ix_]
+        return out
+
+
+def compile_pipeline(pipeline):
+    """Compiles a fitted pipeline into a NumPy inference plan.
+
+    Parameters
+    ----------
+        pipeline: sklearn.pipeline.Pipeline
+            fitted pipeline from ``prepare_model_data``
+
+    Return
+    ------
+        plan: CompiledPipeline
+            compiled inference plan
+    """
+    return CompiledPipeline(pipeline)
+
+
+def get_compiled(entry):
+    """Returns the compiled plan of a registry entry, compiling it on first use."""
+    plan = entry.extras.get("compiled")
+    if plan is None:
+        logger.info("compiling pipeline for fast inference")
+        plan = compile_pipeline(entry.pipeline)
+        entry.extras["compiled"] = plan
+    return plan
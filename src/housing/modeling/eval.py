@@ -1,6 +1,25 @@
 import numpy as np
 import pandas as pd
-from sklearn import metrics
+from housing.preparation import instrumentation as im
+
+# log-spaced absolute error bins for the streaming median, about 0.9% relative resolution
+_MAD_BINS_PER_DECADE = 256
+_MAD_MIN_EXP, _MAD_MAX_EXP = -6, 12
+_MAD_EDGES = np.concatenate([
+    [0.0], np.logspace(_MAD_MIN_EXP, _MAD_MAX_EXP, (_MAD_MAX_EXP - _MAD_MIN_EXP) * _MAD_BINS_PER_DECADE + 1)
+])
+
+# segment of the rows whose group is missing
+MISSING_GROUP = "missing"
+
+
+def _as_arrays(y_true, y_hat):
+    """Checks the lengths and returns both inputs as contiguous float64 arrays."""
+    if len(y_true) != len(y_hat):
+        raise ValueError("y_true & y_hat should be of equal length")
+    y_true = np.ascontiguousarray(y_true, dtype=np.float64).ravel()
+    y_hat = np.ascontiguousarray(y_hat, dtype=np.float64).ravel()
+    return y_true, y_hat
 
 
 def reg_metric_MAPE(y_true, y_hat):
@@ -20,9 +39,7 @@ def reg_metric_MAPE(y_true, y_hat):
         mape: float
             MAPE
     """
-    if len(y_true) != len(y_hat):
-        raise ValueError("y_true & y_hat should be of equal length")
-    y_true, y_hat = np.array(y_true), np.array(y_hat)
+    y_true, y_hat = _as_arrays(y_true, y_hat)
     mape = np.mean(np.abs((y_true-y_hat)/y_true))
     return mape
 
@@ -43,10 +60,8 @@ def reg_metric_WMAPE(y_true, y_hat):
         wmape: float
             WMAPE
     """
-    if len(y_true) != len(y_hat):
-        raise ValueError("y_true & y_hat should be of equal length")
-    y_true, y_hat = np.array(y_true), np.array(y_hat)
-    return np.sum(np.abs(y_true-y_hat))/sum(y_true)
+    y_true, y_hat = _as_arrays(y_true, y_hat)
+    return np.sum(np.abs(y_true-y_hat))/np.sum(y_true)
 
 
 def reg_metric_RMSE(y_true, y_hat):
@@ -65,16 +80,121 @@ def reg_metric_RMSE(y_true, y_hat):
             RMSE
 
     """
-    if len(y_true) != len(y_hat):
-        raise ValueError("y_true & y_hat should be of equal length")
-    y_true, y_hat = np.array(y_true), np.array(y_hat)
+    y_true, y_hat = _as_arrays(y_true, y_hat)
     return np.sqrt(np.mean(np.square(y_true-y_hat)))
 
 
+class RegressionMetrics:
+    """Mergeable accumulator of the regression metrics.
+
+    ``update`` folds a chunk of predictions into running sums (count, mean
+    and sum of squares of y_true, absolute, squared and absolute percent
+    errors) and a log-spaced histogram of absolute errors, so metrics over
+    any number of chunks can be computed without holding the predictions.
+    Accumulators of different chunks or processes can be combined with
+    ``merge``. MAD is approximated from the histogram to about 1%.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean_y = 0.0
+        self.m2_y = 0.0
+        self.sum_y = 0.0
+        self.sum_abs_err = 0.0
+        self.sum_sq_err = 0.0
+        self.sum_ape = 0.0
+        self.abs_err_hist = np.zeros(len(_MAD_EDGES), dtype=np.int64)
+
+    def update(self, y_true, y_hat):
+        """Adds a chunk of predictions.
+
+        Parameters
+        ----------
+            y_true: np.array
+                actual values
+            y_hat: np.array
+                predicted values
+        """
+        y_true, y_hat = _as_arrays(y_true, y_hat)
+        if len(y_true) == 0:
+            return self
+        abs_err = np.abs(y_hat - y_true)
+        other = RegressionMetrics()
+        other.n = len(y_true)
+        other.sum_y = y_true.sum()
+        other.mean_y = other.sum_y / other.n
+        other.m2_y = np.sum(np.square(y_true - other.mean_y))
+        other.sum_abs_err = abs_err.sum()
+        other.sum_sq_err = np.dot(abs_err, abs_err)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            other.sum_ape = np.sum(abs_err / np.abs(y_true))
+        bins = np.searchsorted(_MAD_EDGES, abs_err, side="right") - 1
+        other.abs_err_hist = np.bincount(bins, minlength=len(_MAD_EDGES))
+        return self.merge(other)
+
+    def merge(self, other):
+        """Adds the statistics of another accumulator."""
+        n = self.n + other.n
+        if n == 0:
+            return self
+        delta = other.mean_y - self.mean_y
+        self.m2_y += other.m2_y + delta * delta * self.n * other.n / n
+        self.mean_y += delta * other.n / n
+        self.n = n
+        self.sum_y += other.sum_y
+        self.sum_abs_err += other.sum_abs_err
+        self.sum_sq_err += other.sum_sq_err
+        self.sum_ape += other.sum_ape
+        self.abs_err_hist += other.abs_err_hist
+        return self
+
+    def median_abs_error(self):
+        """Approximate median absolute error from the histogram."""
+        if self.n == 0:
+            return np.nan
+        cum = np.cumsum(self.abs_err_hist)
+        ix = int(np.searchsorted(cum, (self.n + 1) / 2.0))
+        if ix == 0:
+            return 0.0
+        # geometric midpoint of the bin
+        return float(np.sqrt(_MAD_EDGES[ix] * _MAD_EDGES[min(ix + 1, len(_MAD_EDGES) - 1)]))
+
+    def result(self):
+        """Returns the metrics in the format of ``get_performance``.
+
+        Return
+        ------
+            out_metric: dict
+                performance metrics
+        """
+        return _metric_dict(self.n, self.m2_y, self.sum_y, self.sum_abs_err, self.sum_sq_err, self.sum_ape,
+                            self.median_abs_error())
+
+
+def _r2(sse, sst):
+    if sst == 0:
+        return 1.0 if sse == 0 else 0.0
+    return 1 - sse / sst
+
+
+def _metric_dict(n, sst, sum_y, sum_abs_err, sum_sq_err, sum_ape, mad):
+    out_metric = {}
+    out_metric['r2_score'] = _r2(sum_sq_err, sst)
+    out_metric['MAD'] = mad
+    out_metric['MAPE'] = sum_ape / n
+    out_metric['WMAPE'] = sum_abs_err / sum_y
+    out_metric['RMSE'] = np.sqrt(sum_sq_err / n)
+    return out_metric
+
+
+@im.instrumented("get_performance", rows="y_true")
 def get_performance(y_true, y_hat):
     """
     This function computes the evaluation metrics for regression.
 
+    All metrics are computed from one absolute error array over contiguous
+    float64 inputs, MAD exactly.
+
     Parameters
     ----------
         y_true: np.array
@@ -87,15 +207,92 @@ def get_performance(y_true, y_hat):
         out_metric: dict
             performance metrics
     """
-    if len(y_true) != len(y_hat):
-        raise ValueError("y_true & y_hat should be of equal length")
+    y_true, y_hat = _as_arrays(y_true, y_hat)
+    abs_err = np.abs(y_hat - y_true)
+    sst = np.sum(np.square(y_true - y_true.mean()))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sum_ape = np.sum(abs_err / np.abs(y_true))
+    return _metric_dict(len(y_true), sst, y_true.sum(), abs_err.sum(), np.dot(abs_err, abs_err), sum_ape,
+                        float(np.median(abs_err)))
 
-    df = pd.DataFrame.from_dict({'y': y_true, 'y_hat': y_hat})
-    out_metric = {}
-    out_metric['r2_score'] = metrics.r2_score(df['y'], df['y_hat'])
-    out_metric['MAD'] = metrics.median_absolute_error(df['y'],
-                                                      df['y_hat'])
-    out_metric['MAPE'] = reg_metric_MAPE(df['y'], df['y_hat'])
-    out_metric['WMAPE'] = reg_metric_WMAPE(df['y'], df['y_hat'])
-    out_metric['RMSE'] = reg_metric_RMSE(df['y'], df['y_hat'])
-    return out_metric
+
+def _group_codes(groups):
+    """Factorizes the segments, missing ones join the ``MISSING_GROUP`` segment."""
+    codes, uniques = pd.factorize(np.asarray(groups))
+    if (codes < 0).any():
+        uniques = list(uniques)
+        if MISSING_GROUP not in uniques:
+            uniques.append(MISSING_GROUP)
+        codes[codes < 0] = uniques.index(MISSING_GROUP)
+    return codes, uniques
+
+
+def get_performance_by_group(y_true, y_hat, groups):
+    """
+    This function computes the evaluation metrics for regression per segment.
+
+    Parameters
+    ----------
+        y_true: np.array
+            actual values
+        y_hat: np.array
+            predicted values
+        groups: np.array
+            segment of every row, e.g. ocean_proximity; missing segments
+            are reported as ``MISSING_GROUP``
+
+    Return
+    ------
+        out_metric: dict
+            segment to performance metrics
+    """
+    y_true, y_hat = _as_arrays(y_true, y_hat)
+    if len(groups) != len(y_true):
+        raise ValueError("groups should be of the same length as y_true")
+    codes, uniques = _group_codes(groups)
+    n_groups = len(uniques)
+    abs_err = np.abs(y_hat - y_true)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ape = abs_err / np.abs(y_true)
+    count = np.bincount(codes, minlength=n_groups)
+    sum_y = np.bincount(codes, weights=y_true, minlength=n_groups)
+    mean_y = sum_y / count
+    sst = np.bincount(codes, weights=np.square(y_true - mean_y[codes]), minlength=n_groups)
+    sum_abs_err = np.bincount(codes, weights=abs_err, minlength=n_groups)
+    sum_sq_err = np.bincount(codes, weights=np.square(abs_err), minlength=n_groups)
+    sum_ape = np.bincount(codes, weights=ape, minlength=n_groups)
+    # exact medians: sort by (group, abs error) and take the middle of each group
+    order = np.lexsort((abs_err, codes))
+    sorted_err = abs_err[order]
+    starts = np.concatenate([[0], np.cumsum(count)[:-1]])
+    mad = (sorted_err[starts + (count - 1) // 2] + sorted_err[starts + count // 2]) / 2
+    return {
+        group: _metric_dict(count[ix], sst[ix], sum_y[ix], sum_abs_err[ix], sum_sq_err[ix], sum_ape[ix], mad[ix])
+        for ix, group in enumerate(uniques)
+    }
+
+
+class GroupedRegressionMetrics:
+    """Streaming accumulator of the regression metrics per segment."""
+
+    def __init__(self):
+        self.groups = {}
+
+    def update(self, y_true, y_hat, groups):
+        """Adds a chunk of predictions with the segment of every row."""
+        y_true, y_hat = _as_arrays(y_true, y_hat)
+        codes, uniques = _group_codes(groups)
+        for ix, group in enumerate(uniques):
+            mask = codes == ix
+            self.groups.setdefault(group, RegressionMetrics()).update(y_true[mask], y_hat[mask])
+        return self
+
+    def merge(self, other):
+        """Adds the statistics of another accumulator."""
+        for group, acc in other.groups.items():
+            self.groups.setdefault(group, RegressionMetrics()).merge(acc)
+        return self
+
+    def result(self):
+        """Returns segment to performance metrics."""
+        return {group: acc.result() for group, acc in self.groups.items()}
@@ -0,0 +1,290 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from housing.modeling import artifacts as ar
+from housing.modeling import lite as lt
+from housing.modeling import registry as rg
+from housing.modeling import train as tr
+from housing.preparation import data_utils as du
+from scipy import sparse
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.linear_model import Lasso, Ridge
+
+logger = logging.getLogger(__name__)
+
+
+def state_path(cfg):
+    """Returns the path of the incremental training state for a config."""
+    return os.path.join(cfg["models_path"], "incremental_{version}.pkl".format(**cfg))
+
+
+class LinearStats:
+    """Sufficient statistics of a linear regression problem.
+
+    Ridge and lasso fits only depend on the data through the column means
+    and the centered co-moments ``(X - mean)'(X - mean)`` and
+    ``(X - mean)'(y - mean)``, which can be updated batch by batch. Each
+    batch is centered on its own mean and merged with the pairwise update
+    of Chan et al., so large feature values such as ``total_rooms`` over
+    millions of rows do not lose precision to the cancellation of
+    subtracting ``n * mean * mean`` from raw sums of squares. Solving from
+    them gives the same coefficients as fitting on all batches at once, at
+    a cost that depends on the batch size only.
+
+    Parameters
+    ----------
+        n_features: int
+            number of features
+    """
+
+    def __init__(self, n_features):
+        self.n_samples = 0
+        self.mean_x = np.zeros(n_features)
+        self.mean_y = 0.0
+        self.cxx = np.zeros((n_features, n_features))
+        self.cxy = np.zeros(n_features)
+
+    def __setstate__(self, state):
+        if "sum_x" in state:
+            # states saved with raw sums before the co-moments were kept
+            n = max(state["n_samples"], 1)
+            mean_x, mean_y = state["sum_x"] / n, state["sum_y"] / n
+            state = {"n_samples": state["n_samples"], "mean_x": mean_x, "mean_y": mean_y,
+                     "cxx": state["xtx"] - n * np.outer(mean_x, mean_x), "cxy": state["xty"] - n * mean_x * mean_y}
+        self.__dict__.update(state)
+
+    def update(self, X, y):
+        """Adds a batch of rows."""
+        X = X.toarray() if sparse.issparse(X) else np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        n_batch = X.shape[0]
+        if n_batch == 0:
+            return self
+        batch_mean_x, batch_mean_y = X.mean(axis=0), y.mean()
+        Xc = X - batch_mean_x
+        n = self.n_samples + n_batch
+        delta_x, delta_y = batch_mean_x - self.mean_x, batch_mean_y - self.mean_y
+        weight = self.n_samples * n_batch / n
+        self.cxx += Xc.T @ Xc + weight * np.outer(delta_x, delta_x)
+        self.cxy += Xc.T @ (y - batch_mean_y) + weight * delta_x * delta_y
+        self.mean_x += delta_x * n_batch / n
+        self.mean_y += delta_y * n_batch / n
+        self.n_samples = n
+        return self
+
+    def insert_features(self, index, count):
+        """Inserts all-zero features, e.g. new one-hot columns, at a position."""
+        self.mean_x = np.insert(self.mean_x, index, np.zeros(count))
+        self.cxy = np.insert(self.cxy, index, np.zeros(count))
+        self.cxx = np.insert(np.insert(self.cxx, index, np.zeros((count, 1)), axis=0), index, 0.0, axis=1)
+        return self
+
+    def centered(self, fit_intercept=True):
+        """Returns the Gram matrix, X'y and the means the solvers work on, centered with ``fit_intercept``."""
+        if fit_intercept:
+            return self.cxx, self.cxy, self.mean_x, self.mean_y
+        n = self.n_samples
+        xtx = self.cxx + n * np.outer(self.mean_x, self.mean_x)
+        xty = self.cxy + n * self.mean_x * self.mean_y
+        return xtx, xty, np.zeros(len(xty)), 0.0
+
+    def solve_ridge(self, alpha=1.0, fit_intercept=True):
+        """Solves the ridge problem.
+
+        Return
+        ------
+            coef: np.array
+                coefficients
+            intercept: float
+                intercept
+        """
+        xtx, xty, mean_x, mean_y = self.centered(fit_intercept)
+        coef = np.linalg.solve(xtx + alpha * np.eye(len(xty)), xty)
+        return coef, mean_y - mean_x @ coef
+
+    def solve_lasso(self, alpha=1.0, fit_intercept=True, coef=None, max_iter=1000, tol=1e-4):
+        """Solves the lasso problem by coordinate descent on the covariance.
+
+        Parameters
+        ----------
+            coef: np.array, default None
+                warm start coefficients
+
+        Return
+        ------
+            coef: np.array
+                coefficients
+            intercept: float
+                intercept
+        """
+        xtx, xty, mean_x, mean_y = self.centered(fit_intercept)
+        gram, corr = xtx / self.n_samples, xty / self.n_samples
+        coef = np.zeros(len(corr)) if coef is None else np.array(coef, dtype=np.float64)
+        diag = np.diag(gram)
+        for _ in range(max_iter):
+            max_step = 0.0
+            for j in np.nonzero(diag > 0)[0]:
+                rho = corr[j] - gram[j] @ coef + diag[j] * coef[j]
+                new = np.sign(rho) * max(abs(rho) - alpha, 0.0) / diag[j]
+                max_step = max(max_step, abs(new - coef[j]))
+                coef[j] = new
+            if max_step <= tol * max(np.abs(coef).max(), 1e-12):
+                break
+        return coef, mean_y - mean_x @ coef
+
+
+def _encoder(pl):
+    ct = pl.named_steps["label_endcode"]
+    return ct.named_transformers_["label_endcoder"], list(ct.transformers_[0][2])
+
+
+def update_pipeline(pl, X, extend_vocabulary=True):
+    """Updates a fitted pipeline with a new batch of raw data.
+
+    The imputer fill values are updated from its running aggregates. New
+    categories are appended to the vocabulary when ``extend_vocabulary`` is
+    set; otherwise they are encoded as all zeros, or -1 for ordinal codes.
+
+    Parameters
+    ----------
+        pl: sklearn.pipeline.Pipeline
+            fitted pipeline from ``prepare_model_data``
+        X: pd.DataFrame
+            new batch of raw data
+        extend_vocabulary: bool, default True
+            add unseen categories to the vocabulary
+
+    Return
+    ------
+        inserted: list
+            (output column index, number of columns) for each block of new one-hot columns
+    """
+    imputer = pl.named_steps["imputer"]
+    imputer.partial_fit(X)
+    ohe, cat_cols = _encoder(pl)
+    X_imputed = imputer.transform(X)
+    new_categories = []
+    for col, cats in zip(cat_cols, ohe.categories_):
+        new = sorted(set(X_imputed[col].dropna().unique()) - set(cats))
+        new_categories.append(new)
+        if new:
+            logger.info("new categories in {}: {}".format(col, new))
+    if not any(new_categories):
+        return []
+    if not extend_vocabulary:
+        ohe.handle_unknown = "ignore"
+        return []
+
+    inserted = []
+    offset = 0
+    categories = []
+    for cats, new in zip(ohe.categories_, new_categories):
+        offset += len(cats)
+        if new:
+            inserted.append((offset, len(new)))
+        categories.append(list(cats) + new)
+    ohe.set_params(categories=categories)
+    ohe.fit(pd.DataFrame({col: [cats[0]] for col, cats in zip(cat_cols, categories)}))
+    if getattr(ohe, "mode", "onehot") == "ordinal":
+        # new codes are appended after the existing ones, the output width does not change
+        return []
+    # shift the insert positions by the columns inserted before them
+    return [(index + sum(count for _, count in inserted[:ix]), count) for ix, (index, count) in enumerate(inserted)]
+
+
+def init_state(cfg, X, y):
+    """Creates and saves the incremental state after a full training run.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration
+        X: pd.DataFrame
+            preprocessed train data
+        y: pd.Series
+            target
+
+    Return
+    ------
+        state: dict
+            incremental training state
+    """
+    state = {"algo": cfg["algo"], "n_samples": len(X)}
+    if cfg["algo"] in ("linear-ridge", "linear-lasso"):
+        state["stats"] = LinearStats(X.shape[1]).update(X, y)
+    ar.save_artifact(state, state_path(cfg))
+    return state
+
+
+def incremental_fit(cfg, X, y):
+    """Updates the saved pipeline and model with a new batch of raw data.
+
+    Linear models are re-solved from updated sufficient statistics, random
+    forests grow ``incremental_n_estimators`` new trees on the batch with
+    ``warm_start``. The one-hot vocabulary is extended for linear models;
+    forests keep the width their trees were trained on and encode unseen
+    categories as zeros. Decision trees can not be updated incrementally.
+
+    The statistics of earlier batches keep the rows as they were imputed
+    then. When a batch moves the fill values, e.g. the mean of
+    ``total_bedrooms``, rows with missing values of earlier batches are not
+    re-imputed, so the solution is close to but not exactly a refit on all
+    rows; the derived ratio features of imputed columns rule out an exact
+    correction. Refit from scratch when many values are missing.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration
+        X: pd.DataFrame
+            new batch of raw data
+        y: pd.Series
+            target of the new batch
+
+    Return
+    ------
+        model: object
+            updated model
+    """
+    model_path, pipeline_path = rg.artifact_paths(dict(cfg, flat_inference=False))
+    model = ar.load_artifact(model_path)
+    pl = ar.load_artifact(pipeline_path)
+    state = ar.load_artifact(state_path(cfg))
+    logger.info("incremental training of {} on {} new rows".format(state["algo"], len(X)))
+
+    linear = isinstance(model, (Ridge, Lasso))
+    if not linear and not isinstance(model, RandomForestRegressor):
+        raise ValueError("{} can not be trained incrementally".format(type(model).__name__))
+    inserted = update_pipeline(pl, X, extend_vocabulary=linear)
+    X_new = pl.transform(X).astype(np.float64)
+    if linear:
+        stats = state["stats"]
+        coef = model.coef_
+        for index, count in inserted:
+            stats.insert_features(index, count)
+            coef = np.insert(coef, index, np.zeros(count))
+        stats.update(X_new, y)
+        if isinstance(model, Ridge):
+            model.coef_, model.intercept_ = stats.solve_ridge(model.alpha, model.fit_intercept)
+        else:
+            model.coef_, model.intercept_ = stats.solve_lasso(model.alpha, model.fit_intercept, coef,
+                                                              model.max_iter, model.tol)
+        model.n_features_in_ = X_new.shape[1]
+        if hasattr(model, "feature_names_in_"):
+            model.feature_names_in_ = np.array(du.get_feature_names(pl), dtype=object)
+    else:
+        model.set_params(warm_start=True, n_estimators=model.n_estimators + cfg.get("incremental_n_estimators", 50))
+        model.fit(X_new, y)
+    state["n_samples"] += len(X)
+
+    compress = cfg.get("artifact_compress", 0)
+    ar.save_artifact(model, model_path, compress)
+    ar.save_artifact(pl, pipeline_path, compress)
+    ar.save_artifact(state, state_path(cfg))
+    if not linear and cfg.get("export_flat_model", False):
+        tr.export_flat_model(cfg, model)
+    if cfg.get("export_lite_model", False):
+        lt.export_lite_model(cfg, model, pl)
+    return model
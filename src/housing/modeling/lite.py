@@ -0,0 +1,162 @@
+import logging
+import os
+import pickle as pkl
+import threading
+
+import numpy as np
+from housing.modeling import compiled as cp
+from housing.modeling import trees as tr
+
+logger = logging.getLogger(__name__)
+
+
+class LinearPredictor:
+    """Prediction of a fitted linear model from its coefficients.
+
+    Parameters
+    ----------
+        coef: np.array
+            coefficients
+        intercept: float
+            intercept
+    """
+
+    def __init__(self, coef, intercept):
+        self.coef_ = np.asarray(coef, dtype=np.float64)
+        self.intercept_ = float(intercept)
+
+    def predict(self, X):
+        return np.asarray(X, dtype=np.float64) @ self.coef_ + self.intercept_
+
+
+class LiteModel:
+    """A compiled preprocessing plan and a numpy predictor in one artifact.
+
+    Loading and scoring only imports numpy and the numpy only modules of
+    the package, not pandas, scipy, sklearn or joblib, so short lived
+    scoring jobs start in a fraction of the time of the full pipeline.
+
+    Parameters
+    ----------
+        plan: CompiledPipeline
+            compiled preprocessing plan
+        predictor: LinearPredictor or FlatTreeEnsemble
+            numpy predictor
+        version: str
+            model version
+    """
+
+    def __init__(self, plan, predictor, version):
+        self.plan = plan
+        self.predictor = predictor
+        self.version = version
+
+    def predict(self, X):
+        """Scores raw observations given as a dict, list of dicts or 2-D array."""
+        return self.predictor.predict(self.plan.transform(X))
+
+
+def lite_path(cfg):
+    """Returns the lite model path of a config."""
+    return os.path.join(cfg["models_path"], "lite_{version}.pkl".format(**cfg))
+
+
+def to_predictor(model):
+    """Converts a fitted model to a numpy predictor.
+
+    Parameters
+    ----------
+        model: object
+            fitted Ridge, Lasso, decision tree, random forest or ``FlatTreeEnsemble``
+
+    Return
+    ------
+        predictor: LinearPredictor or FlatTreeEnsemble
+            numpy predictor
+    """
+    if isinstance(model, tr.FlatTreeEnsemble):
+        return model
+    if hasattr(model, "coef_") and hasattr(model, "intercept_"):
+        if np.ndim(model.coef_) != 1:
+            raise ValueError("only single output linear models are supported")
+        return LinearPredictor(model.coef_, model.intercept_)
+    return tr.flatten(model)
+
+
+def export_lite_model(cfg, model, pipeline):
+    """Saves the lite model of a fitted model and pipeline.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration dict with ``models_path`` and ``version``
+        model: object
+            fitted model, see ``to_predictor``
+        pipeline: sklearn.pipeline.Pipeline
+            fitted pipeline from ``prepare_model_data``
+
+    Return
+    ------
+        path: str
+            lite model path
+    """
+    plan = cp.compile_pipeline(pipeline)
+    if plan.neighborhood_ is not None:
+        raise ValueError("neighborhood features query a sklearn tree and can not be exported to a lite model")
+    lite = LiteModel(plan, to_predictor(model), str(cfg["version"]))
+    path = lite_path(cfg)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fp:
+        pkl.dump(lite, fp, protocol=pkl.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    logger.info("saved lite model {}".format(path))
+    return path
+
+
+_models = {}
+_lock = threading.Lock()
+
+
+def load_lite_model(cfg):
+    """Returns the lite model of a config, loaded once per process and reloaded when the file changes.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration dict with ``models_path`` and ``version``
+
+    Return
+    ------
+        lite: LiteModel
+            loaded lite model
+    """
+    path = os.path.abspath(lite_path(cfg))
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        cached = _models.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        with open(path, "rb") as fp:
+            lite = pkl.load(fp)
+        _models[path] = (stamp, lite)
+    logger.info("loaded lite model {}".format(path))
+    return lite
+
+
+def score(cfg, X):
+    """Scores raw observations with the lite model of the config.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration dict
+        X: dict, list of dict or np.array
+            raw observations
+
+    Return
+    ------
+        y_hat: np.array
+            predictions
+    """
+    return load_lite_model(cfg).predict(X)
@@ -0,0 +1,191 @@
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(value):
+    """Returns a hashable canonical form of a feature value.
+
+    Numbers compare as floats, so 1, 1.0 and np.float32(1) share a key, and
+    NaN is the same as None. Strings are kept as they are since the
+    pipeline treats them as given.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    return None if value != value else value
+
+
+def observation_key(observation, features):
+    """Returns the cache key part of an observation.
+
+    Parameters
+    ----------
+        observation: dict
+            feature name to value, other keys are ignored
+        features: list
+            input features of the pipeline
+
+    Return
+    ------
+        key: tuple
+            normalized feature values in ``features`` order
+    """
+    return tuple(_normalize(observation.get(feature)) for feature in features)
+
+
+class PredictionCache:
+    """Thread-safe LRU cache of single observation predictions.
+
+    Entries are keyed by the model key (models path, version, flat
+    inference) and the normalized observation. The entries of a model key
+    are dropped when the registry loads a different model or pipeline for
+    it, so a new version never serves predictions of the previous one.
+    Entries are tracked by weak reference, so the cache never keeps an
+    evicted model and pipeline in memory.
+
+    Parameters
+    ----------
+        max_size: int, default 100000
+            maximum number of cached predictions
+        ttl: float, default None
+            seconds a prediction is served from the cache, None for no expiry
+    """
+
+    def __init__(self, max_size=100000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def sync(self, model_key, entry):
+        """Drops the predictions of ``model_key`` if ``entry`` is not the registry entry they were made with."""
+        with self._lock:
+            loaded = self._loaded.get(model_key)
+            if loaded is not None and loaded() is entry:
+                return
+            self._loaded[model_key] = weakref.ref(entry)
+            if loaded is None:
+                return
+            stale = [key for key in self._entries if key[0] == model_key]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += 1
+        logger.info("dropped {} cached predictions of reloaded {}".format(len(stale), model_key))
+
+    def get(self, key, count_miss=True):
+        """Returns the cached prediction or None.
+
+        Parameters
+        ----------
+            key: tuple
+                model key and observation key
+            count_miss: bool, default True
+                count a miss, off for lookups that are followed by a counted one
+        """
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[1] is not None and item[1] < time.monotonic():
+                del self._entries[key]
+                self.expired += 1
+                item = None
+            if item is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            value = item[0]
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Caches a prediction, evicting the least recently used ones beyond ``max_size``."""
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drops all entries and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._loaded.clear()
+            self.hits = self.misses = self.expired = self.evictions = self.invalidations = 0
+
+    def stats(self):
+        """Returns the cache counters.
+
+        Return
+        ------
+            stats: dict
+                hits, misses, hit rate, expired, evictions, invalidations and entries
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+            }
+
+    def prometheus(self, prefix="housing"):
+        """Returns the counters in the Prometheus text exposition format."""
+        stats = self.stats()
+        metrics = [
+            ("prediction_cache_hits_total", "counter", "hits"),
+            ("prediction_cache_misses_total", "counter", "misses"),
+            ("prediction_cache_expired_total", "counter", "expired"),
+            ("prediction_cache_evictions_total", "counter", "evictions"),
+            ("prediction_cache_invalidations_total", "counter", "invalidations"),
+            ("prediction_cache_entries", "gauge", "entries"),
+        ]
+        lines = []
+        for name, kind, key in metrics:
+            lines += ["# TYPE {}_{} {}".format(prefix, name, kind), "{}_{} {}".format(prefix, name, stats[key])]
+        return "\n".join(lines) + "\n"
+
+
+_cache = PredictionCache()
+
+
+def get_prediction_cache():
+    """Returns the process wide prediction cache."""
+    return _cache
+
+
+def configure_prediction_cache(max_size=100000, ttl=None, **kwargs):
+    """Configures the process wide prediction cache and drops its entries.
+
+    Parameters
+    ----------
+        max_size: int, default 100000
+            maximum number of cached predictions
+        ttl: float, default None
+            seconds a prediction is served from the cache, None for no expiry
+    """
+    _cache.max_size = max_size
+    _cache.ttl = ttl
+    _cache.clear()
@@ -0,0 +1,270 @@
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+from housing.modeling import artifacts as ar
+from housing.preparation import utils as ut
+
+logger = logging.getLogger(__name__)
+
+
+def artifact_paths(cfg):
+    """Returns the model and pipeline artifact paths for a config.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration dict with ``models_path`` and ``version``; with
+            ``flat_inference`` set the model is the exported flat tree model
+
+    Return
+    ------
+        paths: tuple
+            (model path, pipeline path)
+    """
+    model_file = "flat_model_{version}.pkl" if cfg.get("flat_inference", False) else "model_{version}.pkl"
+    model_path = os.path.join(cfg["models_path"], model_file.format(**cfg))
+    pipeline_path = os.path.join(cfg["models_path"], "pipeline_{version}.pkl".format(**cfg))
+    return model_path, pipeline_path
+
+
+def loaded_nbytes(obj):
+    """Estimates the memory held by a loaded artifact.
+
+    Walks the object graph and adds up the ``nbytes`` of the arrays and
+    the size of the other objects, so a compressed artifact counts with
+    its loaded and not its on-disk size. Objects without a ``__dict__``,
+    such as the Cython trees of sklearn, are walked through their pickled
+    state. Arrays sharing a base are counted once.
+
+    Parameters
+    ----------
+        obj: object
+            loaded model or pipeline
+
+    Return
+    ------
+        nbytes: int
+            estimated bytes
+    """
+    seen, stack, nbytes = set(), [obj], 0
+    while stack:
+        obj = stack.pop()
+        if hasattr(obj, "nbytes") and hasattr(obj, "dtype"):
+            while getattr(obj, "base", None) is not None and hasattr(obj.base, "nbytes"):
+                obj = obj.base
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                nbytes += int(obj.nbytes)
+                if obj.dtype == object:
+                    stack.extend(obj.ravel().tolist())
+            continue
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        nbytes += sys.getsizeof(obj)
+        if isinstance(obj, (str, bytes, int, float, bool, type(None), type)) or callable(obj):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, "__dict__"):
+            stack.append(vars(obj))
+        else:
+            try:
+                stack.append(obj.__getstate__())
+            except Exception:
+                pass
+    return nbytes
+
+
+class _Entry:
+    """A loaded (model, pipeline) pair and the file state it was loaded from."""
+
+    def __init__(self, model, pipeline, stamps, checksums, nbytes):
+        self.model = model
+        self.pipeline = pipeline
+        self.stamps = stamps
+        self.checksums = checksums
+        self.nbytes = nbytes
+        self.extras = {}
+
+
+class ArtifactRegistry:
+    """In-process cache of the (model, pipeline) artifacts used for scoring.
+
+    Each pair is loaded once and keyed by ``(models_path, version,
+    flat_inference)``. On every lookup the artifact files are stat-ed; the
+    pair is reloaded only when the mtime or size changed (and, with
+    ``verify_checksum``, only when the content checksum changed too). Entries
+    are evicted least-recently-used first once the estimated memory of the
+    loaded artifacts, see ``loaded_nbytes``, exceeds ``max_bytes``.
+
+    Parameters
+    ----------
+        max_bytes: int, default None
+            memory budget for loaded artifacts, None for no limit
+        verify_checksum: bool, default False
+            compare SHA-256 checksums before reloading a touched file
+        mmap_mode: str, default None
+            memory-map the numpy arrays of the artifacts, see ``artifacts.load_artifact``
+    """
+
+    def __init__(self, max_bytes=None, verify_checksum=False, mmap_mode=None):
+        self.max_bytes = max_bytes
+        self.verify_checksum = verify_checksum
+        self.mmap_mode = mmap_mode
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key(cfg):
+        return (os.path.abspath(cfg["models_path"]), str(cfg["version"]), bool(cfg.get("flat_inference", False)))
+
+    @property
+    def nbytes(self):
+        return sum(entry.nbytes for entry in self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, cfg):
+        return self.key(cfg) in self._entries
+
+    def get(self, cfg):
+        """Returns the model and pipeline for the config, loading them if needed.
+
+        Parameters
+        ----------
+            cfg: dict
+                configuration dict
+
+        Return
+        ------
+            model: object
+                fitted model
+            pipeline: object
+                fitted preprocessing pipeline
+        """
+        entry = self.entry(cfg)
+        return entry.model, entry.pipeline
+
+    def entry(self, cfg):
+        """Returns the registry entry for the config, loading it if needed."""
+        key = self.key(cfg)
+        paths = artifact_paths(cfg)
+        with self._lock:
+            stamps = tuple(self._stamp(path) for path in paths)
+            entry = self._entries.get(key)
+            if entry is not None and (entry.stamps == stamps or self._same_content(entry, paths, stamps)):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is None:
+                self.misses += 1
+            else:
+                self.reloads += 1
+                logger.info("artifacts for {} changed on disk, reloading".format(cfg["version"]))
+            entry = self._load(paths, stamps)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._evict(keep=key)
+            return entry
+
+    def evict(self, cfg):
+        """Drops the entry for the config if present."""
+        with self._lock:
+            self._entries.pop(self.key(cfg), None)
+
+    def clear(self):
+        """Drops all entries and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.reloads = 0
+
+    def stats(self):
+        """Returns the registry counters.
+
+        Return
+        ------
+            stats: dict
+                hits, misses, reloads, entries and loaded bytes
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "reloads": self.reloads,
+                "entries": len(self._entries),
+                "nbytes": self.nbytes,
+            }
+
+    @staticmethod
+    def _stamp(path):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _same_content(self, entry, paths, stamps):
+        if not self.verify_checksum:
+            return False
+        checksums = tuple(ut.sha256_file(path) for path in paths)
+        if checksums != entry.checksums:
+            return False
+        entry.stamps = stamps
+        return True
+
+    def _load(self, paths, stamps):
+        model_path, pipeline_path = paths
+        logger.info("loading artifacts {} and {}".format(model_path, pipeline_path))
+        model = ar.load_artifact(model_path, self.mmap_mode)
+        pipeline = ar.load_artifact(pipeline_path, self.mmap_mode)
+        checksums = tuple(ut.sha256_file(path) for path in paths) if self.verify_checksum else None
+        if tuple(self._stamp(path) for path in paths) != stamps:
+            # replaced while loading: keep the old stamps so the next lookup reloads
+            logger.warning("artifacts {} changed while loading".format(model_path))
+        nbytes = loaded_nbytes(model) + loaded_nbytes(pipeline)
+        return _Entry(model, pipeline, stamps, checksums, nbytes)
+
+    def _evict(self, keep):
+        if self.max_bytes is None:
+            return
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            if key == keep:
+                break
+            self._entries.popitem(last=False)
+            logger.info("evicted artifacts {} from registry".format(key))
+
+
+_registry = ArtifactRegistry()
+
+
+def get_registry():
+    """Returns the process wide artifact registry."""
+    return _registry
+
+
+def configure_registry(max_mb=None, verify_checksum=False, mmap_mode=None, **kwargs):
+    """Configures the process wide artifact registry.
+
+    Parameters
+    ----------
+        max_mb: float, default None
+            memory budget in MB, None for no limit
+        verify_checksum: bool, default False
+            compare SHA-256 checksums before reloading a touched file
+        mmap_mode: str, default None
+            memory-map the numpy arrays of the artifacts, applies to entries loaded afterwards
+    """
+    _registry.max_bytes = None if max_mb is None else int(max_mb * (1 << 20))
+    _registry.verify_checksum = verify_checksum
+    _registry.mmap_mode = mmap_mode
+    with _registry._lock:
+        _registry._evict(keep=None)
@@ -1,20 +1,36 @@
 import logging
 import os
-import pickle as pkl
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-import pandas as pd
+import numpy as np
+from housing.modeling import compiled as cp
+from housing.modeling import lite as lt
+from housing.modeling import prediction_cache as pc
+from housing.modeling import registry as rg
+from housing.preparation import instrumentation as im
 
 logger = logging.getLogger(__name__)
 
 
+# scored once per request when serving, log it at debug level; the stats and metrics still count every call
+@im.instrumented("score", rows="X", log_level=logging.DEBUG)
 def score(cfg, X, preproc=False):
     """Based on the input from config the data will be scored.
 
+    With ``compiled_inference`` set in the config the raw input is transformed
+    by the compiled NumPy plan of the pipeline instead of the pipeline itself.
+    With ``prediction_cache`` set, observations given as a dict or list of
+    dicts are looked up in the process wide prediction cache first and only
+    the misses are scored. With ``lite_inference`` raw observations are
+    scored by the numpy only lite model, see ``lite.score``.
+
     Parameters
     ----------
         cfg: dict
             configuration dict
-        X: pd.DataFrame
+        X: pd.DataFrame, dict or list of dict
             input data
         preproc: bool
             to do preprocessing
@@ -23,13 +39,240 @@ def score(cfg, X, preproc=False):
         y_hat: np.array
             predictions
     """
-    if type(X) == dict:
+    if cfg.get("lite_inference", False) and not preproc:
+        return lt.score(cfg, X)
+    entry = rg.get_registry().entry(cfg)
+    if cfg.get("prediction_cache", False) and not preproc and type(X) in (dict, list):
+        return _score_cached(cfg, entry, X)
+    return _predict(cfg, entry, X, preproc)
+
+
+def _predict(cfg, entry, X, preproc=False):
+    compiled = cfg.get("compiled_inference", False) and not preproc
+    if not compiled:
+        # pandas is only needed when the sklearn pipeline transforms the input
+        import pandas as pd
+    if compiled:
+        X = cp.get_compiled(entry).transform(X)
+    elif type(X) == dict:
         X = pd.DataFrame.from_dict(X, orient="index").T
-    logger.info("no of obeservation in data {}".format(X.shape[0]))
-    logger.info("scoring with {}".format(cfg["version"]))
-    model = pkl.load(open(os.path.join(cfg["models_path"], "model_{version}.pkl".format(**cfg)), "rb"))
-    pl = pkl.load(open(os.path.join(cfg["models_path"], "pipeline_{version}.pkl".format(**cfg)), "rb"))
-    if not preproc:
-        X = pl.transform(X)
-    y_hat = model.predict(X)
+    elif type(X) == list:
+        X = pd.DataFrame(X)
+    logger.debug("scoring {} observations with {}".format(X.shape[0], cfg["version"]))
+    if not preproc and not compiled:
+        X = entry.pipeline.transform(X)
+    y_hat = entry.model.predict(X)
+    return y_hat
+
+
+def _cache_keys(cfg, entry, observations):
+    """Returns the prediction cache keys of raw observations, dropping predictions of a replaced entry."""
+    model_key = rg.ArtifactRegistry.key(cfg)
+    pc.get_prediction_cache().sync(model_key, entry)
+    features = entry.extras.get("input_features")
+    if features is None:
+        features = list(entry.pipeline.named_steps["imputer"].dtype_dict_.index)
+        entry.extras["input_features"] = features
+    return [(model_key, pc.observation_key(observation, features)) for observation in observations]
+
+
+def _score_cached(cfg, entry, X):
+    """Scores raw observations, serving repeats from the prediction cache."""
+    cache = pc.get_prediction_cache()
+    observations = [X] if type(X) == dict else X
+    keys = _cache_keys(cfg, entry, observations)
+    y_hat = np.empty(len(observations), dtype=np.float64)
+    missing = []
+    for ix, key in enumerate(keys):
+        value = cache.get(key)
+        if value is None:
+            missing.append(ix)
+        else:
+            y_hat[ix] = value
+    if missing:
+        y_missing = _predict(cfg, entry, [observations[ix] for ix in missing])
+        for ix, value in zip(missing, y_missing):
+            y_hat[ix] = value
+            cache.put(keys[ix], float(value))
     return y_hat
+
+
+def cached_prediction(cfg, observation):
+    """Returns the cached prediction of a raw observation.
+
+    Lets a server answer repeated observations without queueing them for
+    scoring; misses are not counted, ``score`` counts them when it scores
+    the observation.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration dict
+        observation: dict
+            raw observation
+
+    Return
+    ------
+        y_hat: float
+            cached prediction, None when not cached, ``prediction_cache`` is off or ``lite_inference`` is on
+    """
+    if not cfg.get("prediction_cache", False) or cfg.get("lite_inference", False):
+        return None
+    entry = rg.get_registry().entry(cfg)
+    return pc.get_prediction_cache().get(_cache_keys(cfg, entry, [observation])[0], count_miss=False)
+
+
+def preload(cfg):
+    """Loads the model and pipeline of the config, and compiles the pipeline with ``compiled_inference``.
+
+    With ``lite_inference`` the lite model is loaded instead.
+
+    Called before a server forks its workers, so they share the loaded
+    artifacts copy-on-write instead of loading them on their first request.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration dict
+
+    Return
+    ------
+        entry: registry entry or LiteModel
+            loaded model and pipeline
+    """
+    if cfg.get("lite_inference", False):
+        entry = lt.load_lite_model(cfg)
+        logger.info("preloaded lite model {} from {}".format(cfg["version"], cfg["models_path"]))
+        return entry
+    entry = rg.get_registry().entry(cfg)
+    if cfg.get("compiled_inference", False):
+        cp.get_compiled(entry)
+    logger.info("preloaded {} from {}".format(cfg["version"], cfg["models_path"]))
+    return entry
+
+
+_worker_state = {}
+
+
+def _init_worker(cfg, preproc):
+    """Loads the artifacts once per worker process."""
+    entry = rg.get_registry().entry(cfg)
+    if hasattr(entry.model, "n_jobs"):
+        entry.model.n_jobs = 1
+    _worker_state["cfg"] = cfg
+    _worker_state["preproc"] = preproc
+
+
+def _score_chunk(chunk):
+    return score(_worker_state["cfg"], chunk, preproc=_worker_state["preproc"])
+
+
+def _iter_predictions(cfg, chunks, preproc=False, n_workers=1):
+    """Yields (chunk, y_hat) in input order, scoring up to ``n_workers`` chunks in parallel."""
+    if n_workers <= 1:
+        for chunk in chunks:
+            yield chunk, score(cfg, chunk, preproc=preproc)
+        return
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(cfg, preproc)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, pool.submit(_score_chunk, chunk)))
+            if len(pending) >= 2 * n_workers:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+        while pending:
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
+
+
+def score_parallel(cfg, X, chunk_size=100000, n_workers=None, preproc=False):
+    """Scores a data frame in chunks across a pool of worker processes.
+
+    Every worker loads the model and pipeline once and scores the chunks it
+    is given; predictions are returned in the original row order.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration dict
+        X: pd.DataFrame
+            input data
+        chunk_size: int, default 100000
+            number of rows per chunk
+        n_workers: int, default None
+            number of worker processes, None for all cores
+        preproc: bool
+            to do preprocessing
+    Return
+    ------
+        y_hat: np.array
+            predictions
+    """
+    n_workers = n_workers or os.cpu_count()
+    chunks = (X.iloc[start:start + chunk_size] for start in range(0, len(X), chunk_size))
+    y_hat = [pred for _, pred in _iter_predictions(cfg, chunks, preproc=preproc, n_workers=n_workers)]
+    return np.concatenate(y_hat) if y_hat else np.empty(0)
+
+
+def score_stream(cfg, input_path, output_path, chunk_size=100000, preproc=False, target="median_house_value",
+                 n_workers=1):
+    """Scores a CSV file chunk by chunk and writes the predictions incrementally.
+
+    Only a bounded number of chunks and their predictions are held in memory
+    at a time, so peak memory depends on ``chunk_size`` (and ``n_workers``) and
+    not on the size of the input file.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration dict
+        input_path: str
+            CSV file to score
+        output_path: str
+            .csv or .parquet file to write the predictions to
+        chunk_size: int, default 100000
+            number of rows scored at a time
+        preproc: bool
+            to do preprocessing
+        target: str, default median_house_value
+            target column, dropped before scoring and written next to the predictions if present
+        n_workers: int, default 1
+            number of worker processes, None for all cores
+    Return
+    ------
+        summary: dict
+            number of rows, chunks and seconds taken
+    """
+    import pandas as pd
+    from housing.preparation import storage as st
+
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    n_workers = n_workers or os.cpu_count()
+    writer = st.get_writer(output_path)
+    rows, chunks = 0, 0
+    start = time.perf_counter()
+    targets = deque()
+
+    def features():
+        for chunk in pd.read_csv(input_path, chunksize=chunk_size):
+            targets.append(chunk.pop(target) if target in chunk.columns else None)
+            yield chunk
+
+    try:
+        for chunk, y_hat in _iter_predictions(cfg, features(), preproc=preproc, n_workers=n_workers):
+            y = targets.popleft()
+            out = pd.DataFrame({"y_hat": y_hat})
+            if y is not None:
+                out[target] = y.to_numpy()
+            writer.write(out)
+            rows += len(chunk)
+            chunks += 1
+            elapsed = time.perf_counter() - start
+            logger.info("scored {} rows in {} chunks, {:.0f} rows/s".format(rows, chunks, rows / max(elapsed, 1e-9)))
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    logger.info("wrote predictions for {} rows to {} in {:.2f}s".format(rows, output_path, elapsed))
+    return {"rows": rows, "chunks": chunks, "seconds": elapsed}
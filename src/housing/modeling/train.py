@@ -1,7 +1,11 @@
 import logging
-import os
-import pickle as pkl
 
+import numpy as np
+from housing.modeling import artifacts as ar
+from housing.modeling import lite as lt
+from housing.modeling import registry as rg
+from housing.modeling import trees as tr
+from housing.preparation import instrumentation as im
 from sklearn import linear_model
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.tree import DecisionTreeRegressor
@@ -9,6 +13,39 @@ from sklearn.tree import DecisionTreeRegressor
 logger = logging.getLogger(__name__)
 
 
+ALGOS = {
+    "linear-ridge": linear_model.Ridge,
+    "linear-lasso": linear_model.Lasso,
+    "decision_tree": DecisionTreeRegressor,
+    "random_forest": RandomForestRegressor,
+}
+
+
+def get_model(algo, params, seed=None):
+    """Creates an unfitted model.
+
+    Parameters
+    ----------
+        algo: str
+            linear-ridge, linear-lasso, decision_tree or random_forest
+        params: dict
+            model parameters
+        seed: int, default None
+            random state
+
+    Return
+    ------
+        model: object
+            sklearn model object
+    """
+    if algo not in ALGOS:
+        raise ValueError("unknown algo {}, expected one of {}".format(algo, list(ALGOS)))
+    model_cfg = dict(params)
+    model_cfg["random_state"] = seed
+    return ALGOS[algo](**model_cfg)
+
+
+@im.instrumented("model_selection_fit", rows="X")
 def model_selection_fit(cfg, X, y):
     """Based on the input from config the model will be selected
 
@@ -24,22 +61,40 @@ def model_selection_fit(cfg, X, y):
     """
     logger.info("no of obeservation in data {}".format(X.shape[0]))
     logger.info("training {}".format(cfg["algo"]))
-    if cfg["algo"] == "linear-ridge":
-        model_cfg = cfg["linear-ridge"]
-        model_cfg["random_state"] = cfg["seed"]
-        model = linear_model.Ridge(**model_cfg)
-    elif cfg["algo"] == "linear-lasso":
-        model_cfg = cfg["linear-lasso"]
-        model_cfg["random_state"] = cfg["seed"]
-        model = linear_model.Lasso(**model_cfg)
-    elif cfg["algo"] == "decision_tree":
-        model_cfg = cfg["decision_tree"]
-        model_cfg["random_state"] = cfg["seed"]
-        model = DecisionTreeRegressor(**model_cfg)
-    elif cfg["algo"] == "random_forest":
-        model_cfg = cfg["random_forest"]
-        model_cfg["random_state"] = cfg["seed"]
-        model = RandomForestRegressor(**model_cfg)
+    model = get_model(cfg["algo"], cfg[cfg["algo"]], cfg["seed"])
     model.fit(X, y)
-    pkl.dump(model, open(os.path.join(cfg["models_path"], "model_{version}.pkl".format(**cfg)), "wb"))
+    model_path, _ = rg.artifact_paths(dict(cfg, flat_inference=False))
+    ar.save_artifact(model, model_path, cfg.get("artifact_compress", 0))
+    if cfg.get("export_flat_model", False) and isinstance(model, (DecisionTreeRegressor, RandomForestRegressor)):
+        export_flat_model(cfg, model)
+    if cfg.get("export_lite_model", False):
+        _, pipeline_path = rg.artifact_paths(cfg)
+        lt.export_lite_model(cfg, model, ar.load_artifact(pipeline_path))
     return model
+
+
+def export_flat_model(cfg, model):
+    """Exports a fitted tree model to contiguous node arrays for scoring.
+
+    The flat model is saved uncompressed next to the model artifact as
+    ``flat_model_{version}.pkl`` so it can be memory-mapped; scoring uses it
+    when ``flat_inference`` is set.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration, ``flat_model_dtype`` (float64 or float32) and
+            ``flat_model_prune`` control the export
+        model: DecisionTreeRegressor or RandomForestRegressor
+            fitted model
+
+    Return
+    ------
+        flat: housing.modeling.trees.FlatTreeEnsemble
+            flattened model
+    """
+    flat = tr.flatten(model, np.dtype(cfg.get("flat_model_dtype", "float64")), cfg.get("flat_model_prune", True))
+    model_path, _ = rg.artifact_paths(dict(cfg, flat_inference=True))
+    ar.save_artifact(flat, model_path)
+    logger.info("exported flat model to {}".format(model_path))
+    return flat
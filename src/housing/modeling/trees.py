@@ -0,0 +1,242 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_LEAF = -1
+
+
+def _tree_arrays(tree):
+    """Returns (feature, threshold, left, right, value) of a fitted sklearn tree."""
+    return (tree.feature.copy(), tree.threshold.copy(), tree.children_left.copy(), tree.children_right.copy(),
+            tree.value[:, 0, 0].copy())
+
+
+def _prune(feature, threshold, left, right, value):
+    """Turns splits whose children are leaves with the same value into leaves.
+
+    sklearn numbers children after their parent, so one reverse pass prunes
+    whole subtrees bottom up. Unreachable nodes are dropped and the rest
+    renumbered in depth-first order.
+    """
+    left, right = left.tolist(), right.tolist()
+    values = value.tolist()
+    for node in range(len(left) - 1, -1, -1):
+        lo, hi = left[node], right[node]
+        if lo != _LEAF and left[lo] == _LEAF and left[hi] == _LEAF and values[lo] == values[hi]:
+            left[node] = right[node] = _LEAF
+            values[node] = values[lo]
+
+    order, stack = [], [0]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        if left[node] != _LEAF:
+            stack += [right[node], left[node]]
+    order = np.array(order, dtype=np.intp)
+    new_ix = np.full(len(left), _LEAF, dtype=np.intp)
+    new_ix[order] = np.arange(len(order))
+    left, right = np.array(left)[order], np.array(right)[order]
+    is_leaf = left == _LEAF
+    left = np.where(is_leaf, _LEAF, new_ix[left])
+    right = np.where(is_leaf, _LEAF, new_ix[right])
+    return feature[order], threshold[order], left, right, np.array(values)[order]
+
+
+def _depth(left, right):
+    depth = np.zeros(len(left), dtype=np.intp)
+    for node in range(len(left)):
+        if left[node] != _LEAF:
+            depth[left[node]] = depth[right[node]] = depth[node] + 1
+    return int(depth.max())
+
+
+def _round_down_float32(threshold):
+    """Largest float32 values not above the float64 thresholds.
+
+    For float32 inputs ``x <= t`` and ``x <= t32`` then agree, so float32
+    storage keeps the splits exact.
+    """
+    t32 = threshold.astype(np.float32)
+    above = t32.astype(np.float64) > threshold
+    t32[above] = np.nextafter(t32[above], np.float32(-np.inf))
+    return t32
+
+
+class FlatTreeEnsemble:
+    """A fitted decision tree or random forest in contiguous node arrays.
+
+    Only needs numpy to load and predict, sklearn is imported by ``flatten``.
+
+    All trees are stored one after another in ``feature``, ``threshold``,
+    ``children`` and ``value``, with the root of every tree in ``roots``.
+    The children of node ``i`` are ``children[2 * i]`` (``x <= threshold``)
+    and ``children[2 * i + 1]``; leaves point to themselves. ``predict``
+    advances every (row, tree) pair one level per step with array indexing,
+    dropping pairs that reached a leaf, so a batch costs a few dozen NumPy
+    calls instead of one sklearn call per tree. Inputs are cast to float32
+    like sklearn trees do, so the predictions match ``model.predict``.
+
+    Parameters
+    ----------
+        feature: np.array
+            split feature per node
+        threshold: np.array
+            split threshold per node
+        children: np.array
+            left and right child per node, interleaved
+        value: np.array
+            leaf value per node
+        roots: np.array
+            root node per tree
+        max_depth: int
+            depth of the deepest tree
+        n_features_in: int
+            number of input features
+    """
+
+    def __init__(self, feature, threshold, children, value, roots, max_depth, n_features_in):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.value = value
+        self.roots = roots
+        self.max_depth = max_depth
+        self.n_features_in_ = n_features_in
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in [self.feature, self.threshold, self.children, self.value, self.roots])
+
+    def apply(self, X):
+        """Returns the leaf of every tree for every row.
+
+        Parameters
+        ----------
+            X: np.array
+                float32 input of shape (n_rows, n_features)
+
+        Return
+        ------
+            leaves: np.array
+                node indices of shape (n_rows, n_trees)
+        """
+        n_rows, n_features = X.shape
+        is_leaf = self.children[0::2] == np.arange(self.n_nodes)
+        flat_X = X.ravel()
+        nodes = np.tile(self.roots.astype(np.intp), n_rows)
+        row_start = np.repeat(np.arange(n_rows, dtype=np.intp) * n_features, self.n_trees)
+        pairs = np.arange(n_rows * self.n_trees)
+        leaves = np.empty(n_rows * self.n_trees, dtype=np.intp)
+        while len(pairs):
+            done = np.take(is_leaf, nodes)
+            if done.any():
+                leaves[pairs[done]] = nodes[done]
+                active = ~done
+                pairs, nodes, row_start = pairs[active], nodes[active], row_start[active]
+            go_right = np.take(flat_X, row_start + np.take(self.feature, nodes)) > np.take(self.threshold, nodes)
+            nodes = np.take(self.children, 2 * nodes + go_right)
+        return leaves.reshape(n_rows, self.n_trees)
+
+    def predict(self, X, batch_size=None):
+        """Predicts the mean leaf value over the trees.
+
+        Parameters
+        ----------
+            X: np.array, pd.DataFrame or sparse matrix
+                preprocessed input
+            batch_size: int, default None
+                rows traversed at a time, bounding the (rows, trees) work arrays to about 1M entries
+
+        Return
+        ------
+            y_hat: np.array
+                predictions
+        """
+        # scipy sparse input, checked without importing scipy for numpy only scoring
+        if hasattr(X, "toarray"):
+            X = X.toarray()
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError("expected {} features, got array of shape {}".format(self.n_features_in_, X.shape))
+        batch_size = batch_size or max(1, (1 << 20) // self.n_trees)
+        y_hat = np.empty(X.shape[0], dtype=np.float64)
+        for start in range(0, X.shape[0], batch_size):
+            leaves = np.take(self.value, self.apply(np.ascontiguousarray(X[start:start + batch_size])))
+            # sum tree by tree like sklearn accumulates the forest predictions
+            total = np.zeros(leaves.shape[0], dtype=np.float64)
+            for tree_ix in range(self.n_trees):
+                total += leaves[:, tree_ix]
+            y_hat[start:start + batch_size] = total / self.n_trees
+        return y_hat
+
+
+def flatten(model, dtype=np.float64, prune=True):
+    """Exports a fitted decision tree or random forest regressor to a ``FlatTreeEnsemble``.
+
+    Parameters
+    ----------
+        model: DecisionTreeRegressor or RandomForestRegressor
+            fitted model
+        dtype: np.dtype, default np.float64
+            storage dtype of the thresholds and leaf values; with float32 the
+            thresholds are rounded down so the splits stay exact, the leaf
+            values are rounded
+        prune: bool, default True
+            collapse splits that do not change the prediction
+
+    Return
+    ------
+        flat: FlatTreeEnsemble
+            flattened model
+    """
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.tree import DecisionTreeRegressor
+
+    if isinstance(model, RandomForestRegressor):
+        estimators = model.estimators_
+    elif isinstance(model, DecisionTreeRegressor):
+        estimators = [model]
+    else:
+        raise ValueError("{} can not be flattened".format(type(model).__name__))
+    if model.n_outputs_ != 1:
+        raise ValueError("only single output models can be flattened")
+
+    parts, roots, offset, max_depth = [], [], 0, 0
+    for estimator in estimators:
+        feature, threshold, left, right, value = _tree_arrays(estimator.tree_)
+        # prune on the stored values, leaves that only differ below float32 precision merge too
+        value = value.astype(dtype)
+        if prune:
+            feature, threshold, left, right, value = _prune(feature, threshold, left, right, value)
+        max_depth = max(max_depth, _depth(left, right))
+        nodes = np.arange(len(left)) + offset
+        is_leaf = left == _LEAF
+        # leaves loop back to themselves
+        feature = np.where(is_leaf, 0, feature)
+        threshold = np.where(is_leaf, np.inf, threshold)
+        children = np.stack([np.where(is_leaf, nodes, left + offset), np.where(is_leaf, nodes, right + offset)], axis=1)
+        parts.append((feature, threshold, children.ravel(), value))
+        roots.append(offset)
+        offset += len(nodes)
+
+    feature, threshold, children, value = (np.concatenate(arrays) for arrays in zip(*parts))
+    index_dtype = np.int32 if 2 * offset < np.iinfo(np.int32).max else np.int64
+    if np.dtype(dtype) == np.float32:
+        threshold = _round_down_float32(threshold)
+    flat = FlatTreeEnsemble(
+        feature.astype(np.int32), threshold.astype(dtype, copy=False), children.astype(index_dtype),
+        value, np.array(roots, dtype=index_dtype), max_depth, model.n_features_in_)
+    n_nodes = sum(estimator.tree_.node_count for estimator in estimators)
+    logger.info("flattened {} trees from {} to {} nodes, {:.1f} MB".format(
+        len(estimators), n_nodes, flat.n_nodes, flat.nbytes / 2 ** 20))
+    return flat
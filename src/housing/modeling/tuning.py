@@ -0,0 +1,276 @@
+import logging
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from housing.modeling import eval as ev
+from housing.modeling import train as tr
+from scipy import sparse, stats
+from sklearn.base import clone
+from sklearn.model_selection import KFold, ParameterGrid, ParameterSampler
+
+logger = logging.getLogger(__name__)
+
+# metrics where higher is better, everything else is ranked ascending
+_GREATER_IS_BETTER = {"r2_score"}
+
+_worker_folds = []
+
+
+def _distribution(spec):
+    """Turns a ``{dist: ..., low: ..., high: ...}`` config entry into a scipy distribution."""
+    if spec["dist"] == "uniform":
+        return stats.uniform(spec["low"], spec["high"] - spec["low"])
+    elif spec["dist"] == "loguniform":
+        return stats.loguniform(spec["low"], spec["high"])
+    elif spec["dist"] == "randint":
+        return stats.randint(spec["low"], spec["high"])
+    raise ValueError("unknown distribution {}".format(spec["dist"]))
+
+
+def get_candidates(space, method="grid", n_iter=10, seed=None):
+    """Creates the parameter candidates of a search space.
+
+    Parameters
+    ----------
+        space: dict
+            parameter name to a list of values, or to a ``{dist, low, high}``
+            distribution for random search
+        method: str, default grid
+            grid, random or halving; halving starts from the grid, or from
+            ``n_iter`` random candidates when the space has distributions
+        n_iter: int, default 10
+            number of random candidates
+        seed: int, default None
+            random seed
+
+    Return
+    ------
+        candidates: list
+            list of parameter dicts
+    """
+    space = {key: _distribution(value) if isinstance(value, dict) else value for key, value in space.items()}
+    has_dist = any(not isinstance(value, list) for value in space.values())
+    if method == "grid" or (method == "halving" and not has_dist):
+        return list(ParameterGrid(space))
+    elif method in ("random", "halving"):
+        return list(ParameterSampler(space, n_iter=n_iter, random_state=seed))
+    raise ValueError("unknown search method {}, expected grid, random or halving".format(method))
+
+
+def _as_matrix(X):
+    """Float array of the data, CSR for sparse matrices and sparse frames."""
+    if isinstance(X, pd.DataFrame) and all(isinstance(dtype, pd.SparseDtype) for dtype in X.dtypes):
+        X = X.sparse.to_coo()
+    if sparse.issparse(X):
+        return X.tocsr().astype(np.float64)
+    return np.asarray(X, dtype=np.float64)
+
+
+def make_folds(X, y, cv=5, seed=None, pipeline=None):
+    """Splits the data into cross validation folds.
+
+    When a pipeline is given it is cloned and fitted once per fold on the
+    fold's train part, so every fold is transformed exactly once and the
+    transformed arrays are shared by all candidates.
+
+    Parameters
+    ----------
+        X: pd.DataFrame
+            input data
+        y: pd.Series
+            target
+        cv: int, default 5
+            number of folds
+        seed: int, default None
+            random seed
+        pipeline: sklearn.pipeline.Pipeline, default None
+            unfitted preprocessing pipeline
+
+    Return
+    ------
+        folds: list
+            (X_train, y_train, X_valid, y_valid, order) per fold, where order
+            is a random permutation of the train rows used for subsampling
+    """
+    rng = np.random.RandomState(seed)
+    y = np.asarray(y, dtype=np.float64)
+    folds = []
+    for train_ix, valid_ix in KFold(n_splits=cv, shuffle=True, random_state=seed).split(X):
+        X_train, X_valid = X.iloc[train_ix], X.iloc[valid_ix]
+        if pipeline is not None:
+            pl = clone(pipeline)
+            X_train = pl.fit_transform(X_train, y[train_ix])
+            X_valid = pl.transform(X_valid)
+        X_train, X_valid = _as_matrix(X_train), _as_matrix(X_valid)
+        folds.append((X_train, y[train_ix], X_valid, y[valid_ix], rng.permutation(len(train_ix))))
+    return folds
+
+
+def _init_worker(folds):
+    _worker_folds[:] = folds
+
+
+def _evaluate(task):
+    """Fits one candidate on one fold and returns its validation metrics."""
+    algo, params, seed, fold_ix, n_resources = task
+    X_train, y_train, X_valid, y_valid, order = _worker_folds[fold_ix]
+    if n_resources is not None and n_resources < len(order):
+        rows = order[:n_resources]
+        X_train, y_train = X_train[rows], y_train[rows]
+    model = tr.get_model(algo, params, seed)
+    if hasattr(model, "n_jobs"):
+        model.n_jobs = 1
+    model.fit(X_train, y_train)
+    return ev.get_performance(y_valid, model.predict(X_valid))
+
+
+def _valid_params(algo, params):
+    """Drops config keys the estimator does not accept."""
+    accepted = tr.ALGOS[algo]().get_params()
+    ignored = [key for key in params if key not in accepted]
+    if ignored:
+        logger.info("ignoring unknown {} parameters {}".format(algo, ignored))
+    return {key: value for key, value in params.items() if key in accepted}
+
+
+class _Runner:
+    """Runs (candidate, fold) evaluations serially or on a process pool."""
+
+    def __init__(self, folds, n_jobs=1):
+        self.folds = folds
+        self.n_jobs = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+        self.pool = None
+
+    def __enter__(self):
+        if self.n_jobs > 1:
+            self.pool = ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker,
+                                            initargs=(self.folds,))
+        else:
+            _init_worker(self.folds)
+        return self
+
+    def __exit__(self, *exc):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def run(self, candidates, seed, n_resources=None):
+        tasks = [(algo, params, seed, fold_ix, n_resources)
+                 for algo, params in candidates for fold_ix in range(len(self.folds))]
+        if self.pool is None:
+            results = [_evaluate(task) for task in tasks]
+        else:
+            results = list(self.pool.map(_evaluate, tasks))
+        n_folds = len(self.folds)
+        return [results[ix * n_folds:(ix + 1) * n_folds] for ix in range(len(candidates))]
+
+
+def _summarize(candidates, fold_metrics, n_resources, round_ix):
+    rows = []
+    for (algo, params), metrics in zip(candidates, fold_metrics):
+        row = {"algo": algo, "params": params, "n_resources": n_resources, "round": round_ix}
+        for name in metrics[0]:
+            values = [fold[name] for fold in metrics]
+            row[name] = float(np.mean(values))
+            row[name + "_std"] = float(np.std(values))
+        rows.append(row)
+    return rows
+
+
+def _rank(rows, scoring):
+    return sorted(rows, key=lambda row: -row[scoring] if scoring in _GREATER_IS_BETTER else row[scoring])
+
+
+def tune(cfg, X, y, pipeline=None):
+    """Searches the hyperparameters of the configured algos with k-fold cross validation.
+
+    The ``tuning`` config section holds the search ``method`` (grid, random
+    or halving), ``cv``, ``n_iter``, ``n_jobs``, ``scoring`` (any
+    ``get_performance`` metric), the halving ``factor`` and ``min_resources``
+    and the search ``spaces`` per algo. Candidate parameters are applied on
+    top of the algo config. The leaderboard is written to
+    ``models_path/leaderboard_{version}.csv``.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration
+        X: pd.DataFrame
+            input data, raw when a pipeline is given, otherwise preprocessed
+        y: pd.Series
+            target
+        pipeline: sklearn.pipeline.Pipeline, default None
+            unfitted preprocessing pipeline fitted once per fold
+
+    Return
+    ------
+        leaderboard: pd.DataFrame
+            candidates ranked by the scoring metric
+    """
+    tcfg = cfg["tuning"]
+    method = tcfg.get("method", "grid")
+    scoring = tcfg.get("scoring", "RMSE")
+    seed = cfg["seed"]
+    candidates = []
+    for algo, space in tcfg["spaces"].items():
+        base = _valid_params(algo, cfg.get(algo) or {})
+        for params in get_candidates(space, method, tcfg.get("n_iter", 10), seed):
+            candidates.append((algo, dict(base, **params)))
+    logger.info("tuning {} candidates with {} search".format(len(candidates), method))
+
+    folds = make_folds(X, y, tcfg.get("cv", 5), seed, pipeline)
+    n_train = len(folds[0][0])
+    with _Runner(folds, tcfg.get("n_jobs", 1)) as runner:
+        if method != "halving":
+            rows = _summarize(candidates, runner.run(candidates, seed), n_train, 0)
+        else:
+            factor = tcfg.get("factor", 3)
+            n_resources = min(tcfg.get("min_resources", max(n_train // factor ** 3, 1)), n_train)
+            finished = []
+            round_ix = 0
+            while True:
+                logger.info("halving round {}: {} candidates on {} rows".format(
+                    round_ix, len(candidates), n_resources))
+                rows = _rank(_summarize(candidates, runner.run(candidates, seed, n_resources), n_resources,
+                                        round_ix), scoring)
+                if len(rows) == 1 or n_resources >= n_train:
+                    break
+                n_keep = max(int(math.ceil(len(rows) / factor)), 1)
+                finished += rows[n_keep:]
+                candidates = [(row["algo"], row["params"]) for row in rows[:n_keep]]
+                n_resources = min(n_resources * factor, n_train)
+                round_ix += 1
+            rows += finished
+
+    leaderboard = pd.DataFrame(_rank(rows, scoring))
+    leaderboard = leaderboard.sort_values("round", ascending=False, kind="mergesort").reset_index(drop=True)
+    leaderboard.insert(0, "rank", np.arange(1, len(leaderboard) + 1))
+    out_path = os.path.join(cfg["models_path"], "leaderboard_{version}.csv".format(**cfg))
+    leaderboard.to_csv(out_path, index=False)
+    logger.info("best candidate {} {} with {} {:.4f}".format(
+        leaderboard["algo"][0], leaderboard["params"][0], scoring, leaderboard[scoring][0]))
+    return leaderboard
+
+
+def best_config(cfg, leaderboard):
+    """Returns a copy of the config with the algo and parameters of the best candidate.
+
+    Parameters
+    ----------
+        cfg: dict
+            configuration
+        leaderboard: pd.DataFrame
+            leaderboard from ``tune``
+
+    Return
+    ------
+        cfg: dict
+            configuration to pass to ``model_selection_fit``
+    """
+    best = leaderboard.iloc[0]
+    cfg = dict(cfg)
+    cfg["algo"] = best["algo"]
+    cfg[best["algo"]] = dict(best["params"])
+    return cfg
@@ -0,0 +1,18 @@
+"""Data fetching, splitting, storage and pipeline preparation.
+
+Submodules are imported on first attribute access, so ``import housing.preparation``
+does not load sklearn or pandas.
+"""
+import importlib
+
+_SUBMODULES = {"cache", "data_utils", "fetch", "instrumentation", "split", "storage", "utils"}
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | _SUBMODULES)
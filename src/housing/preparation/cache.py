@@ -0,0 +1,288 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from housing.modeling import artifacts as ar
+from housing.preparation import storage as st
+from housing.preparation import utils as ut
+
+logger = logging.getLogger(__name__)
+
+# config keys that change the prepared model data or the fitted pipeline
+PREP_CONFIG_KEYS = [
+    "compact_dtypes",
+    "raw_data_columns",
+    "sampling_method",
+    "seed",
+    "test_size",
+    "num_impute",
+    "num_constant",
+    "cat_impute",
+    "cat_constant",
+    "add_bedrooms_per_room",
+    "extra_features",
+    "encoding",
+    "neighborhood_features",
+    "neighborhood_k",
+    "neighborhood_columns",
+    "neighborhood_target",
+    "neighborhood_folds",
+    "neighborhood_metric",
+    "model_data_format",
+]
+
+_fingerprints = {}
+
+
+def data_fingerprint(path, block_size=1 << 20):
+    """Computes the SHA-256 fingerprint of a raw data file.
+
+    The digest is memoized per process on the file path, mtime and size.
+
+    Parameters
+    ----------
+        path: str
+            raw data file
+        block_size: int, default 1MB
+            read block size
+
+    Return
+    ------
+        fingerprint: str
+            hex digest
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if memo_key not in _fingerprints:
+        _fingerprints[memo_key] = ut.sha256_file(path, block_size)
+    return _fingerprints[memo_key]
+
+
+def cache_key(cfg, fingerprint):
+    """Computes the cache key of the prepared data for a config.
+
+    Parameters
+    ----------
+        cfg: dict
+            Configurations dict
+        fingerprint: str
+            raw data fingerprint
+
+    Return
+    ------
+        key: str
+            hex digest of the fingerprint and the preprocessing config
+    """
+    payload = {"data": fingerprint, "config": {key: cfg.get(key) for key in PREP_CONFIG_KEYS}}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:20]
+
+
+class ModelDataCache:
+    """Content-addressed store of prepared train/test data and fitted pipelines.
+
+    Every entry lives in ``cache_dir/<key>`` where the key is computed by
+    ``cache_key`` from the raw data fingerprint and the preprocessing config,
+    so a changed input or config never reuses stale data. Entries are never
+    dropped on their own, ``prune`` removes the least recently used ones.
+
+    Parameters
+    ----------
+        cache_dir: str
+            cache directory
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def contains(self, key, fmt="csv"):
+        entry_dir = self.entry_dir(key)
+        return (
+            st.frame_exists(os.path.join(entry_dir, "train"), fmt)
+            and st.frame_exists(os.path.join(entry_dir, "test"), fmt)
+            and os.path.exists(os.path.join(entry_dir, "pipeline.pkl"))
+        )
+
+    def load(self, key, fmt="csv", mmap=False):
+        """Loads an entry.
+
+        Parameters
+        ----------
+            key: str
+                cache key
+            fmt: str, default csv
+                storage format
+            mmap: bool, default False
+                memory-map npy data
+
+        Return
+        ------
+            entry: tuple or None
+                (train, test, pipeline path), None on a miss
+        """
+        if not self.contains(key, fmt):
+            self.misses += 1
+            logger.info("model data cache miss {}".format(key))
+            return None
+        self.hits += 1
+        logger.info("model data cache hit {}".format(key))
+        entry_dir = self.entry_dir(key)
+        # the entry directory mtime is the last use, see prune
+        os.utime(entry_dir)
+        train = st.load_frame(os.path.join(entry_dir, "train"), fmt, mmap=mmap)
+        test = st.load_frame(os.path.join(entry_dir, "test"), fmt, mmap=mmap)
+        return train, test, os.path.join(entry_dir, "pipeline.pkl")
+
+    def save(self, key, train, test, pl, fmt="csv", meta=None, compress=0):
+        """Stores an entry.
+
+        The pipeline is saved last with ``artifacts.save_artifact``, which
+        replaces it atomically, so an entry interrupted by a crash has no
+        pipeline and is never taken for a hit.
+
+        Parameters
+        ----------
+            key: str
+                cache key
+            train: pd.DataFrame
+                prepared train data
+            test: pd.DataFrame
+                prepared test data
+            pl: sklearn.pipeline.Pipeline
+                fitted pipeline
+            fmt: str, default csv
+                storage format
+            meta: dict, default None
+                extra information written to meta.json
+            compress: int or str, default 0
+                joblib compression of the pipeline, see ``artifacts.save_artifact``
+
+        Return
+        ------
+            entry_dir: str
+                entry directory
+        """
+        entry_dir = self.entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        st.save_frame(train, os.path.join(entry_dir, "train"), fmt)
+        st.save_frame(test, os.path.join(entry_dir, "test"), fmt)
+        with open(os.path.join(entry_dir, "meta.json"), "w") as fp:
+            json.dump(meta or {}, fp, default=str)
+        ar.save_artifact(pl, os.path.join(entry_dir, "pipeline.pkl"), compress)
+        return entry_dir
+
+    def entries(self):
+        """Returns the entries, least recently used first.
+
+        Return
+        ------
+            entries: list
+                (key, last use timestamp, bytes) per entry
+        """
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self.entry_dir(key)
+            if not os.path.isdir(entry_dir):
+                continue
+            nbytes = sum(os.path.getsize(os.path.join(root, name))
+                         for root, _, names in os.walk(entry_dir) for name in names)
+            entries.append((key, os.stat(entry_dir).st_mtime, nbytes))
+        return sorted(entries, key=lambda entry: entry[1])
+
+    def prune(self, max_bytes=None, max_age_days=None, keep=None):
+        """Removes old entries and then the least recently used ones until the cache fits.
+
+        The versioned data and pipeline copied from an entry are separate
+        files or hard links, removing the entry does not affect them.
+
+        Parameters
+        ----------
+            max_bytes: int, default None
+                size budget of the cache, None for no limit
+            max_age_days: float, default None
+                days since the last use after which an entry is removed, None for no limit
+            keep: str, default None
+                key never removed, e.g. the entry just used
+
+        Return
+        ------
+            removed: list
+                keys of the removed entries
+        """
+        entries = self.entries()
+        total = sum(nbytes for _, _, nbytes in entries)
+        removed = []
+        for key, used, nbytes in entries:
+            if key == keep:
+                continue
+            expired = max_age_days is not None and time.time() - used > max_age_days * 86400
+            if not expired and (max_bytes is None or total <= max_bytes):
+                continue
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= nbytes
+            removed.append(key)
+        if removed:
+            logger.info("pruned {} model data cache entries, {:.1f} MB left".format(len(removed), total / 2 ** 20))
+        return removed
+
+    def stats(self):
+        """Returns the hit and miss counters."""
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+_caches = {}
+
+
+def get_cache(cache_dir):
+    """Returns the process wide cache for a directory."""
+    cache_dir = os.path.abspath(cache_dir)
+    if cache_dir not in _caches:
+        _caches[cache_dir] = ModelDataCache(cache_dir)
+    return _caches[cache_dir]
+
+
+def _link_artifact(src, dst):
+    """Hard links an artifact to ``dst``, copying it across file systems, and replaces ``dst`` atomically.
+
+    Artifacts are only ever replaced, never written in place, so sharing the
+    file with the cache entry is safe.
+    """
+    tmp_path = dst + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def copy_entry(entry_dir, train_path, test_path, pipeline_path, fmt="csv"):
+    """Copies a cache entry to the versioned model data and pipeline paths.
+
+    Parameters
+    ----------
+        entry_dir: str
+            entry directory
+        train_path: str
+            versioned train path without extension
+        test_path: str
+            versioned test path without extension
+        pipeline_path: str
+            versioned pipeline path
+        fmt: str, default csv
+            storage format
+    """
+    st.copy_frame(os.path.join(entry_dir, "train"), train_path, fmt)
+    st.copy_frame(os.path.join(entry_dir, "test"), test_path, fmt)
+    _link_artifact(os.path.join(entry_dir, "pipeline.pkl"), pipeline_path)
@@ -1,15 +1,11 @@
+import logging
 import os
-import pickle as pkl
-import tarfile
+import sys
 
 import numpy as np
-import pandas as pd
-from housing.processing import processing as pr
-from six.moves import urllib
-from sklearn.compose import ColumnTransformer
-from sklearn.model_selection import StratifiedShuffleSplit, train_test_split
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import OneHotEncoder
+from housing.preparation import instrumentation as im
+
+logger = logging.getLogger(__name__)
 
 
 def is_data_exists(housing_path):
@@ -29,42 +25,136 @@ def is_data_exists(housing_path):
     return data_exists
 
 
-def fetch_housing_data(housing_url, housing_path, over_write_raw_data=False, **kwargs):
+def raw_data_path(housing_path, raw_data_format="csv"):
+    """Returns the path of the raw housing data file.
+
+    Parameters
+    ----------
+        housing_path: str
+            raw data directory
+        raw_data_format: str, default csv
+            csv or parquet
+
+    Return
+    ------
+        path: str
+            housing.csv or housing.parquet in the raw data directory
+    """
+    from housing.preparation import storage as st
+
+    return os.path.join(housing_path, "housing" + st.FORMATS[raw_data_format])
+
+
+def fetch_housing_data(housing_url, housing_path, over_write_raw_data=False, housing_sha256=None,
+                       raw_data_format="csv", fetch_cache_dir=None, fetch_retries=3, **kwargs):
     """This function is used to download the data.
 
+    The tarball is fetched with ``fetch.download``, from a ``file://`` mirror
+    or into ``fetch_cache_dir``, verified against ``housing_sha256`` and
+    streamed straight into the raw data file.
+
     Parameters
     ----------
         housing_url : str
-            The URL path to download the data from.
+            The URL path to download the data from, http(s) or file://.
         housing_path : str
             Path to download the data to.
         over_write_raw_data : bool, default True
             To over_write the existing data
+        housing_sha256 : str, default None
+            expected SHA-256 of the tarball
+        raw_data_format : str, default csv
+            write the raw data as csv or parquet
+        fetch_cache_dir : str, default None
+            download cache directory, housing_path when not given
+        fetch_retries : int, default 3
+            number of download retries
     """
-    create_data = ((not is_data_exists(housing_path)) or (over_write_raw_data))
-    if create_data:
-        os.makedirs(housing_path, exist_ok=True)
-        tgz_path = os.path.join(housing_path, "housing.tgz")
-        urllib.request.urlretrieve(housing_url, tgz_path)
-        housing_tgz = tarfile.open(tgz_path)
-        housing_tgz.extractall(path=housing_path)
-        housing_tgz.close()
+    path = raw_data_path(housing_path, raw_data_format)
+    if os.path.exists(path) and not over_write_raw_data:
+        return
+    from housing.preparation import fetch as fe
+
+    os.makedirs(housing_path, exist_ok=True)
+    tgz_path = fe.download(housing_url, fetch_cache_dir or housing_path, sha256=housing_sha256,
+                           retries=fetch_retries, force=over_write_raw_data)
+    fe.extract_member(tgz_path, "housing.csv", path, fmt=raw_data_format)
+
+
+# compact dtypes of the raw housing.csv columns; float32 holds the rounded
+# coordinates, counts and incomes of the dataset
+HOUSING_SCHEMA = {
+    "longitude": "float32",
+    "latitude": "float32",
+    "housing_median_age": "float32",
+    "total_rooms": "float32",
+    "total_bedrooms": "float32",
+    "population": "float32",
+    "households": "float32",
+    "median_income": "float32",
+    "median_house_value": "float32",
+    "ocean_proximity": "category",
+}
+
 
+def _default_nbytes(data):
+    """Memory the data would take with the default float64 and object dtypes."""
+    import pandas as pd
 
-def load_housing_data(housing_path):
+    nbytes = 0
+    for col, dtype in data.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            counts = data[col].value_counts()
+            nbytes += sum(count * (8 + sys.getsizeof(cat)) for cat, count in counts.items())
+            nbytes += 8 * int(data[col].isna().sum())
+        elif col in HOUSING_SCHEMA:
+            nbytes += 8 * len(data)
+        else:
+            nbytes += data[col].memory_usage(index=False, deep=True)
+    return nbytes
+
+
+def load_housing_data(housing_path, compact_dtypes=True, usecols=None, engine=None, fmt="csv"):
     """This function is used to read the data.
 
     Parameters
     ----------
         housing_path : str
             file path.
+        compact_dtypes : bool, default True
+            read the columns with the ``HOUSING_SCHEMA`` dtypes instead of the
+            inferred float64 and object dtypes
+        usecols : list, default None
+            columns to read, all columns when not given
+        engine : str, default None
+            csv parser engine, e.g. 'c' or 'pyarrow'
+        fmt : str, default csv
+            raw data format, csv or parquet
 
     Return
     ------
         data: pd.DataFrame, data
     """
-    csv_path = os.path.join(housing_path, "housing.csv")
-    return pd.read_csv(csv_path)
+    import pandas as pd
+
+    path = raw_data_path(housing_path, fmt)
+    columns = usecols or list(HOUSING_SCHEMA)
+    dtypes = {col: HOUSING_SCHEMA[col] for col in columns if col in HOUSING_SCHEMA} if compact_dtypes else None
+    if fmt == "parquet":
+        data = pd.read_parquet(path, columns=usecols)
+        if dtypes:
+            data = data.astype({col: dtype for col, dtype in dtypes.items() if col in data.columns})
+    else:
+        kwargs = {"usecols": usecols, "dtype": dtypes}
+        if engine is not None:
+            kwargs["engine"] = engine
+        data = pd.read_csv(path, **kwargs)
+    if compact_dtypes:
+        nbytes = data.memory_usage(index=False, deep=True).sum()
+        default = _default_nbytes(data)
+        logger.info("loaded {} rows in {:.1f} MB, {:.1f} MB saved by compact dtypes".format(
+            len(data), nbytes / 2 ** 20, (default - nbytes) / 2 ** 20))
+    return data
 
 
 def get_train_test_split(data, sampling_method="stratified", seed=42, test_size=0.2):
@@ -73,9 +163,10 @@ def get_train_test_split(data, sampling_method="stratified", seed=42, test_size=
     Parameters
     ----------
         data: pd.DataFrame
-            input data
+            input data, not modified
         sampling_method: str, default stratified
-            stratified or random
+            stratified, random or hash; hash is the seed-keyed row hash
+            assignment of ``split.split_csv``, stratified on the income bins
         seed: int, default 43
             random seed
         test_size: float, default 0.2
@@ -88,22 +179,29 @@ def get_train_test_split(data, sampling_method="stratified", seed=42, test_size=
         test: pd.DataFrame
             test data set
     """
+    # sklearn and the transformers are imported where they are used, so
+    # loading and splitting raw data does not pay for them at import
+    from housing.preparation import split as sp
+    from sklearn.model_selection import StratifiedShuffleSplit, train_test_split
+
     if sampling_method == "stratified":
-        data["income_cat"] = pd.cut(
-            data["median_income"], bins=[0.0, 1.5, 3.0, 4.5, 6.0, np.inf], labels=[1, 2, 3, 4, 5]
-        )
+        income_cat = sp.income_category(data["median_income"])
         split = StratifiedShuffleSplit(n_splits=1, test_size=test_size, random_state=seed)
-        for train_index, test_index in split.split(data, data["income_cat"]):
-            train = data.loc[train_index]
-            test = data.loc[test_index]
-        train.drop("income_cat", axis=1, inplace=True)
-        test.drop("income_cat", axis=1, inplace=True)
+        train_index, test_index = next(split.split(data, income_cat))
+        train = data.iloc[train_index]
+        test = data.iloc[test_index]
     elif sampling_method == "random":
         train, test = train_test_split(data, test_size=test_size, random_state=seed)
+    elif sampling_method == "hash":
+        is_test = sp.StratifiedHashSplitter(seed, test_size).assign(data)
+        train = data[~is_test]
+        test = data[is_test]
+    else:
+        raise ValueError("unknown sampling method {}, expected stratified, random or hash".format(sampling_method))
     return train.reset_index(drop=True), test.reset_index(drop=True)
 
 
-def prepare_test_data(data, imputer):
+def prepare_test_data(data, imputer, encoder=None):
     """This function creates the test data.
 
     Parameters
@@ -112,55 +210,191 @@ def prepare_test_data(data, imputer):
             test data set
         imputer: object
             imputer object to impute missing values
+        encoder: CategoricalEncoder, default None
+            encoder fitted on the train data; its frozen vocabulary keeps the
+            encoded columns the same as in training. ``pd.get_dummies`` is
+            used when not given
 
     Return
     ------
         data: pd.DataFrame
             processed test data
     """
+    import pandas as pd
+    from housing.processing import processing as pr
+    from scipy import sparse
+
     data = pr.impute_transform(data, imputer)
     data = pr.generate_features(data)
-    data = pd.get_dummies(data)
-    return data
+    if encoder is None:
+        return pd.get_dummies(data)
+    cat_cols = list(data.select_dtypes(exclude=np.number).columns)
+    encoded = encoder.transform(data[cat_cols])
+    columns = encoder.get_feature_names(cat_cols)
+    if sparse.issparse(encoded):
+        encoded = pd.DataFrame.sparse.from_spmatrix(encoded, index=data.index, columns=columns)
+    else:
+        encoded = pd.DataFrame(encoded, index=data.index, columns=columns)
+    return pd.concat([data.drop(cat_cols, axis=1), encoded], axis=1)
+
+
+def build_pipeline(cfg, cat_cols):
+    """This function creates the preprocessing pipeline.
+
+    The ``encoding`` config key selects the categorical encoding: ``onehot``
+    (dense, default), ``sparse`` (CSR output for estimators that accept it)
+    or ``ordinal`` (integer codes for the tree models). With
+    ``neighborhood_features`` a ``NeighborhoodFeatures`` step adds the
+    nearest training district aggregates; the pipeline then needs the target
+    in ``fit``.
 
+    Parameters
+    ----------
+        cfg: dict
+            Configurations dict
+        cat_cols: list
+            categorical columns to encode
 
+    Return
+    ------
+        pl: sklearn.pipeline.Pipeline
+            unfitted preprocessing pipeline
+    """
+    from housing.processing import processing as pr
+    from sklearn.compose import ColumnTransformer
+    from sklearn.pipeline import Pipeline
+
+    encoding = cfg.get("encoding", "onehot")
+    steps = [
+        ('imputer', pr.Imputer(num_impute=cfg["num_impute"], cat_impute=cfg["cat_impute"],
+                               num_constant=cfg["num_constant"], cat_constant=cfg["cat_constant"])),
+        ('attribs_adder', pr.CombinedAttributesAdder(add_bedrooms_per_room=cfg["add_bedrooms_per_room"],
+                                                     extra_features=cfg.get("extra_features"))),
+    ]
+    if cfg.get("neighborhood_features", False):
+        steps.append(('neighborhood', pr.NeighborhoodFeatures(
+            n_neighbors=cfg.get("neighborhood_k", 10), columns=cfg.get("neighborhood_columns", ["median_income"]),
+            target=cfg.get("neighborhood_target", True), n_folds=cfg.get("neighborhood_folds", 5),
+            metric=cfg.get("neighborhood_metric", "euclidean"), random_state=cfg.get("seed"))))
+    steps.append(('label_endcode', ColumnTransformer(transformers=[
+                    ("label_endcoder", pr.CategoricalEncoder(mode=encoding), cat_cols)
+                ], remainder="passthrough", sparse_threshold=1.0 if encoding == "sparse" else 0.0)))
+    pl = Pipeline(steps)
+    return pl
+
+
+def get_feature_names(pl):
+    """This function returns the output column names of a fitted pipeline.
+
+    Parameters
+    ----------
+        pl: sklearn.pipeline.Pipeline
+            fitted pipeline from ``build_pipeline``
+
+    Return
+    ------
+        names: list
+            output column names
+    """
+    # columns of the data frame entering the encoder
+    adder_cols = pl.steps[-2][1]._cols
+    names = []
+    for name, transformer, cols in pl.named_steps["label_endcode"].transformers_:
+        if transformer == "drop":
+            continue
+        elif transformer == "passthrough":
+            names += [adder_cols[ix] for ix in cols]
+        elif getattr(transformer, "mode", "onehot") == "ordinal":
+            names += list(cols)
+        else:
+            for col, cats in zip(cols, transformer.categories_):
+                names += ["{}_{}".format(col, cat) for cat in cats]
+    return names
+
+
+def _model_frame(X, columns):
+    """Wraps transformed data in a float frame, keeping sparse output sparse."""
+    import pandas as pd
+    from scipy import sparse
+
+    if sparse.issparse(X):
+        return pd.DataFrame.sparse.from_spmatrix(X.astype(np.float64), columns=columns)
+    return pd.DataFrame(X, columns=columns, dtype=np.float64)
+
+
+def model_data(X, y, columns):
+    """Returns the model data of transformed features and the target.
+
+    Parameters
+    ----------
+        X: np.array or scipy.sparse matrix
+            transformed features
+        y: pd.Series
+            target, indexed like the untransformed data
+        columns: list
+            feature names, see ``get_feature_names``
+
+    Return
+    ------
+        data: pd.DataFrame
+            float feature columns and the target column
+    """
+    import pandas as pd
+
+    return pd.concat([_model_frame(X, columns), y], axis=1)
+
+
+@im.instrumented("prepare_model_data")
 def prepare_model_data(cfg):
     """This function creates the train and test model data.
 
+    The prepared data and the fitted pipeline are cached under a key computed
+    from the raw data fingerprint and the preprocessing config keys, and
+    reused on a hit unless ``over_write_model_data`` is set. Afterwards the
+    cache is pruned to ``model_data_cache_max_mb`` and
+    ``model_data_cache_max_age_days`` when they are set.
+
     Parameters
     ----------
         cfg: dict
             Configurations dict
     """
-    create_data = (
-        (not is_data_exists(os.path.join(cfg["model_data_path"], "train_{version}.csv".format(**cfg))))
-        or (cfg["over_write_model_data"])
-        )
+    from housing.preparation import cache as ch
+
+    fmt = cfg.get("model_data_format", "csv")
+    mmap = cfg.get("model_data_mmap", False)
+    train_path = os.path.join(cfg["model_data_path"], "train_{version}".format(**cfg))
+    test_path = os.path.join(cfg["model_data_path"], "test_{version}".format(**cfg))
+    pipeline_path = os.path.join(cfg["models_path"], "pipeline_{version}.pkl".format(**cfg))
     fetch_housing_data(**cfg)
-    data = load_housing_data(cfg["housing_path"])
-    if create_data:
+    cache = ch.get_cache(cfg.get("model_data_cache_path", os.path.join(cfg["model_data_path"], "cache")))
+    raw_format = cfg.get("raw_data_format", "csv")
+    key = ch.cache_key(cfg, ch.data_fingerprint(raw_data_path(cfg["housing_path"], raw_format)))
+    cached = None if cfg["over_write_model_data"] else cache.load(key, fmt, mmap=mmap)
+    if cached is not None:
+        train, test, _ = cached
+        ch.copy_entry(cache.entry_dir(key), train_path, test_path, pipeline_path, fmt)
+    else:
+        data = load_housing_data(cfg["housing_path"], cfg.get("compact_dtypes", True), cfg.get("raw_data_columns"),
+                                 cfg.get("raw_data_engine"), raw_format)
         train, test = get_train_test_split(data, cfg["sampling_method"], cfg["seed"], cfg["test_size"])
         train_x = train.drop("median_house_value", axis=1)
         test_x = test.drop("median_house_value", axis=1)
-        train_y = train["median_house_value"]
-        test_y = test["median_house_value"]
+        train_y = train["median_house_value"].astype(np.float64)
+        test_y = test["median_house_value"].astype(np.float64)
         cat_cols = list(train_x.select_dtypes(exclude=np.number).columns)
-        pl = Pipeline([
-            ('imputer', pr.Imputer(num_impute=cfg["num_impute"], cat_impute=cfg["cat_impute"],
-                                   num_constant=cfg["num_constant"], cat_constant=cfg["cat_constant"])),
-            ('attribs_adder', pr.CombinedAttributesAdder(add_bedrooms_per_room=cfg["add_bedrooms_per_room"])),
-            ('label_endcode', ColumnTransformer(transformers=[
-                        ("label_endcoder", OneHotEncoder(sparse=False), cat_cols)
-                    ], remainder="passthrough"))
-        ])
-        train_x = pl.fit_transform(train_x)
-        test_x = pl.transform(test_x)
-        train = pd.concat([pd.DataFrame(train_x), train_y], axis=1)
-        test = pd.concat([pd.DataFrame(test_x), test_y], axis=1)
-        train.to_csv(os.path.join(cfg["model_data_path"], "train_{version}.csv".format(**cfg)), index=False)
-        test.to_csv(os.path.join(cfg["model_data_path"], "test_{version}.csv".format(**cfg)), index=False)
-        pkl.dump(pl, open(os.path.join(cfg["models_path"], "pipeline_{version}.pkl".format(**cfg)), "wb"))
-    else:
-        train = pd.read_csv(os.path.join(cfg["model_data_path"], "train_{version}.csv".format(**cfg)))
-        test = pd.read_csv(os.path.join(cfg["model_data_path"], "test_{version}.csv".format(**cfg)))
+        pl = build_pipeline(cfg, cat_cols)
+        train_x = im.fit_transform_steps(pl, train_x, train_y)
+        test_x = im.transform_steps(pl, test_x)
+        columns = get_feature_names(pl)
+        train = model_data(train_x, train_y, columns)
+        test = model_data(test_x, test_y, columns)
+        entry_dir = cache.save(key, train, test, pl, fmt, meta={name: cfg.get(name) for name in ch.PREP_CONFIG_KEYS},
+                               compress=cfg.get("artifact_compress", 0))
+        ch.copy_entry(entry_dir, train_path, test_path, pipeline_path, fmt)
+    max_mb = cfg.get("model_data_cache_max_mb")
+    max_age_days = cfg.get("model_data_cache_max_age_days")
+    if max_mb is not None or max_age_days is not None:
+        cache.prune(None if max_mb is None else int(max_mb * (1 << 20)), max_age_days, keep=key)
+    logger.info("model data cache stats {}".format(cache.stats()))
     return train, test
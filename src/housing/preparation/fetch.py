@@ -0,0 +1,180 @@
+import logging
+import os
+import shutil
+import tarfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import pandas as pd
+from housing.preparation import storage as st
+from housing.preparation import utils as ut
+
+logger = logging.getLogger(__name__)
+
+
+def verify_checksum(path, sha256=None):
+    """Raises a ValueError when the SHA-256 digest of a file does not match.
+
+    Parameters
+    ----------
+        path: str
+            file to check
+        sha256: str, default None
+            expected hex digest, nothing is checked when not given
+    """
+    if sha256 is None:
+        return
+    digest = ut.sha256_file(path)
+    if digest != sha256.lower():
+        raise ValueError("checksum mismatch for {}: expected {}, got {}".format(path, sha256, digest))
+
+
+def _local_path(url):
+    """Returns the file path of a file:// url or plain path, None for remote urls."""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "file":
+        return urllib.request.url2pathname(parsed.path)
+    elif parsed.scheme == "":
+        return url
+    return None
+
+
+def _download_part(url, part_path, timeout=60, block_size=1 << 20):
+    """Downloads a url into a partial file, resuming with an HTTP Range request if it exists."""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+    except urllib.error.HTTPError as err:
+        # the partial file already holds the whole content
+        if err.code == 416 and offset:
+            return
+        raise
+    with response:
+        resumed = offset and response.getcode() == 206
+        if resumed:
+            logger.info("resuming download of {} at byte {}".format(url, offset))
+        elif offset:
+            logger.info("server ignored the range request, restarting the download of {}".format(url))
+        with open(part_path, "ab" if resumed else "wb") as fp:
+            shutil.copyfileobj(response, fp, block_size)
+
+
+def download(url, cache_dir, sha256=None, retries=3, backoff=1.0, timeout=60, force=False):
+    """Downloads a file into a cache directory.
+
+    ``file://`` urls and plain paths are local mirrors and are used in place.
+    A cached file is reused when it matches ``sha256``, or when no checksum
+    is given and ``force`` is not set. Interrupted downloads are kept as
+    ``.part`` files and resumed with HTTP Range requests; connection errors
+    and server errors are retried with exponential backoff.
+
+    Parameters
+    ----------
+        url: str
+            http(s) or file:// url, or a local path
+        cache_dir: str
+            download directory
+        sha256: str, default None
+            expected hex digest, verified before the file is used
+        retries: int, default 3
+            number of retries
+        backoff: float, default 1.0
+            seconds to wait before the first retry, doubled on every retry
+        timeout: float, default 60
+            socket timeout in seconds
+        force: bool, default False
+            download again even if a cached file exists and no checksum is given
+
+    Return
+    ------
+        path: str
+            path of the verified file
+    """
+    local_path = _local_path(url)
+    if local_path is not None:
+        verify_checksum(local_path, sha256)
+        logger.info("using local mirror {}".format(local_path))
+        return local_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, os.path.basename(urllib.parse.urlparse(url).path) or "download")
+    if os.path.exists(path):
+        if sha256 is not None and ut.sha256_file(path) == sha256.lower():
+            logger.info("using cached {}".format(path))
+            return path
+        elif sha256 is None and not force:
+            logger.info("using cached {}".format(path))
+            return path
+        os.remove(path)
+
+    part_path = path + ".part"
+    if force and sha256 is None and os.path.exists(part_path):
+        os.remove(part_path)
+    for attempt in range(retries + 1):
+        try:
+            _download_part(url, part_path, timeout)
+            break
+        except (urllib.error.URLError, OSError) as err:
+            if isinstance(err, urllib.error.HTTPError) and err.code < 500:
+                raise
+            if attempt == retries:
+                raise
+            wait = backoff * 2 ** attempt
+            logger.warning("download of {} failed ({}), retrying in {:.1f}s".format(url, err, wait))
+            time.sleep(wait)
+    try:
+        verify_checksum(part_path, sha256)
+    except ValueError:
+        os.remove(part_path)
+        raise
+    os.replace(part_path, path)
+    logger.info("downloaded {} to {}".format(url, path))
+    return path
+
+
+def extract_member(tgz_path, member, out_path, fmt="csv", chunk_size=1000000):
+    """Streams one csv member of a tarball into a csv or parquet file.
+
+    The member is decompressed as it is read and never extracted to a
+    temporary file; parquet output is written one row group per chunk.
+
+    Parameters
+    ----------
+        tgz_path: str
+            gzipped tarball
+        member: str
+            file name of the csv member
+        out_path: str
+            output file
+        fmt: str, default csv
+            csv or parquet
+        chunk_size: int, default 1000000
+            rows per parquet row group
+
+    Return
+    ------
+        out_path: str
+            output file
+    """
+    tmp_path = out_path + ".tmp"
+    with tarfile.open(tgz_path, "r:gz") as tar:
+        for info in tar:
+            if not info.isfile() or os.path.basename(info.name) != member:
+                continue
+            source = tar.extractfile(info)
+            if fmt == "csv":
+                with open(tmp_path, "wb") as fp:
+                    shutil.copyfileobj(source, fp, 1 << 20)
+            else:
+                writer = st.get_writer(tmp_path, fmt)
+                try:
+                    for chunk in pd.read_csv(source, chunksize=chunk_size):
+                        writer.write(chunk)
+                finally:
+                    writer.close()
+            os.replace(tmp_path, out_path)
+            return out_path
+    raise ValueError("{} not found in {}".format(member, tgz_path))
@@ -0,0 +1,393 @@
+import cProfile
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def n_rows(obj):
+    """Returns the number of rows of a frame, array, list of observations or tuple of those.
+
+    A single observation dict counts as one row.
+    """
+    if obj is None:
+        return 0
+    if isinstance(obj, dict):
+        return 1
+    if isinstance(obj, tuple):
+        return sum(n_rows(item) for item in obj)
+    if hasattr(obj, "shape") and len(obj.shape):
+        return int(obj.shape[0])
+    if isinstance(obj, list):
+        return len(obj)
+    return 0
+
+
+def _process_peak_rss_bytes():
+    """Peak resident set size of the process since it started, not of a single stage."""
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Instrumentation:
+    """Records wall time, rows per second and peak memory of named stages.
+
+    Every finished stage is logged, as a JSON line when ``json_logs`` is
+    set, and aggregated per stage name for ``stats`` and ``prometheus``.
+    With ``trace_memory`` the peak traced allocation of the stage is
+    measured with tracemalloc, which slows down allocation heavy code; the
+    peak RSS of the process so far is always recorded, it only grows and is
+    not the memory of the stage itself. Stages listed in ``profile_stages``
+    are run under cProfile and their stats dumped to ``profile_dir``.
+
+    Parameters
+    ----------
+        enabled: bool, default True
+            record stages
+        trace_memory: bool, default False
+            measure the peak traced memory of every stage
+        json_logs: bool, default False
+            log stage records as JSON lines
+        profile_stages: list, default None
+            stage names to profile
+        profile_dir: str, default None
+            directory of the .prof files, the working directory when not given
+    """
+
+    def __init__(self, enabled=True, trace_memory=False, json_logs=False, profile_stages=None, profile_dir=None):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.json_logs = json_logs
+        self.profile_stages = set(profile_stages or [])
+        self.profile_dir = profile_dir
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiling = False
+        self._n_profiles = 0
+
+    @contextmanager
+    def stage(self, name, rows=None, log_level=logging.INFO):
+        """Records a stage.
+
+        Parameters
+        ----------
+            name: str
+                stage name
+            rows: int, default None
+                rows processed, can also be set on the yielded record
+            log_level: int, default logging.INFO
+                level of the stage log line, e.g. DEBUG for per request stages
+
+        Return
+        ------
+            record: dict
+                stage record, filled in when the stage finishes
+        """
+        record = {"stage": name, "rows": rows}
+        if not self.enabled:
+            yield record
+            return
+        frames = self._frames()
+        frame = self._enter_memory() if self.trace_memory and tracemalloc.is_tracing() else None
+        frames.append(frame)
+        profiler = self._start_profile(name)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stop_profile(name, profiler)
+            frames.pop()
+            record["seconds"] = elapsed
+            record["rows_per_s"] = record["rows"] / max(elapsed, 1e-9) if record["rows"] else None
+            record["peak_bytes"] = self._exit_memory(frame, frames) if frame is not None else None
+            record["process_peak_rss_bytes"] = _process_peak_rss_bytes()
+            self._add(record)
+            self._log(record, log_level)
+
+    def _frames(self):
+        if not hasattr(self._local, "frames"):
+            self._local.frames = []
+        return self._local.frames
+
+    @staticmethod
+    def _enter_memory():
+        current, peak = tracemalloc.get_traced_memory()
+        frame = {"start": current, "peak_before": peak, "child_peak": 0}
+        # reset_peak is new in python 3.9, before that the peak is the one since tracing started
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        return frame
+
+    @staticmethod
+    def _exit_memory(frame, frames):
+        _, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, frame["child_peak"])
+        # the peak counter was reset for this stage, hand the enclosing stage its own peak back
+        parent = next((parent for parent in reversed(frames) if parent is not None), None)
+        if parent is not None:
+            parent["child_peak"] = max(parent["child_peak"], frame["peak_before"], peak)
+        return max(peak - frame["start"], 0)
+
+    def _start_profile(self, name):
+        if name not in self.profile_stages:
+            return None
+        with self._lock:
+            # only one profiler can be active at a time
+            if self._profiling:
+                return None
+            self._profiling = True
+            self._n_profiles += 1
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _stop_profile(self, name, profiler):
+        if profiler is None:
+            return
+        profiler.disable()
+        profile_dir = self.profile_dir or "."
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, "{}-{}-{}.prof".format(name, os.getpid(), self._n_profiles))
+        profiler.dump_stats(path)
+        with self._lock:
+            self._profiling = False
+        logger.info("wrote profile of {} to {}".format(name, path))
+
+    def _add(self, record):
+        with self._lock:
+            stats = self._stats.setdefault(record["stage"], {
+                "calls": 0, "seconds": 0.0, "rows": 0, "last_seconds": 0.0, "peak_bytes": None,
+                "process_peak_rss_bytes": None})
+            stats["calls"] += 1
+            stats["seconds"] += record["seconds"]
+            stats["rows"] += record["rows"] or 0
+            stats["last_seconds"] = record["seconds"]
+            for key in ["peak_bytes", "process_peak_rss_bytes"]:
+                if record[key] is not None:
+                    stats[key] = max(stats[key] or 0, record[key])
+
+    def _log(self, record, level=logging.INFO):
+        if not logger.isEnabledFor(level):
+            return
+        if self.json_logs:
+            logger.log(level, json.dumps(record), extra={"stage": record})
+            return
+        message = "stage {} took {:.3f}s".format(record["stage"], record["seconds"])
+        if record["rows_per_s"] is not None:
+            message += " for {} rows, {:.0f} rows/s".format(record["rows"], record["rows_per_s"])
+        if record["peak_bytes"] is not None:
+            message += ", peak {:.1f} MB".format(record["peak_bytes"] / 2 ** 20)
+        logger.log(level, message, extra={"stage": record})
+
+    def stats(self):
+        """Returns the aggregated stage records.
+
+        Return
+        ------
+            stats: dict
+                per stage name the calls, total seconds and rows, last seconds and the peak memory
+        """
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def reset(self):
+        """Drops the aggregated stage records."""
+        with self._lock:
+            self._stats.clear()
+
+    def prometheus(self, prefix="housing"):
+        """Returns the aggregated stage records in the Prometheus text exposition format.
+
+        Parameters
+        ----------
+            prefix: str, default housing
+                metric name prefix
+
+        Return
+        ------
+            text: str
+                metrics page
+        """
+        metrics = [
+            ("stage_calls_total", "counter", "Finished stages.", "calls"),
+            ("stage_seconds_total", "counter", "Wall time spent in the stage.", "seconds"),
+            ("stage_rows_total", "counter", "Rows processed by the stage.", "rows"),
+            ("stage_last_seconds", "gauge", "Wall time of the last run of the stage.", "last_seconds"),
+            ("stage_peak_bytes", "gauge", "Largest traced memory peak of the stage.", "peak_bytes"),
+        ]
+        stats = self.stats()
+        lines = []
+        for name, kind, help_text, key in metrics:
+            samples = [(stage, values[key]) for stage, values in sorted(stats.items()) if values[key] is not None]
+            if not samples:
+                continue
+            lines += ["# HELP {}_{} {}".format(prefix, name, help_text), "# TYPE {}_{} {}".format(prefix, name, kind)]
+            lines += ['{}_{}{{stage="{}"}} {}'.format(prefix, name, stage.replace('"', '\\"'), value)
+                      for stage, value in samples]
+        rss = _process_peak_rss_bytes()
+        if rss is not None:
+            lines += ["# HELP {}_process_peak_rss_bytes Peak resident set size of the process since it started."
+                      .format(prefix), "# TYPE {}_process_peak_rss_bytes gauge".format(prefix),
+                      "{}_process_peak_rss_bytes {}".format(prefix, rss)]
+        return "\n".join(lines) + "\n"
+
+
+_instrumentation = Instrumentation()
+
+
+def get_instrumentation():
+    """Returns the process wide instrumentation."""
+    return _instrumentation
+
+
+def configure_instrumentation(enabled=True, trace_memory=False, json_logs=False, profile_stages=None,
+                              profile_dir=None, **kwargs):
+    """Configures the process wide instrumentation.
+
+    Parameters
+    ----------
+        enabled: bool, default True
+            record stages
+        trace_memory: bool, default False
+            measure the peak traced memory of every stage, starts tracemalloc
+        json_logs: bool, default False
+            log stage records as JSON lines
+        profile_stages: list, default None
+            stage names to run under cProfile
+        profile_dir: str, default None
+            directory of the .prof files
+    """
+    _instrumentation.enabled = enabled
+    _instrumentation.trace_memory = trace_memory
+    _instrumentation.json_logs = json_logs
+    _instrumentation.profile_stages = set(profile_stages or [])
+    _instrumentation.profile_dir = profile_dir
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def stage(name, rows=None, log_level=logging.INFO):
+    """Records a stage with the process wide instrumentation, see ``Instrumentation.stage``."""
+    return _instrumentation.stage(name, rows, log_level)
+
+
+def instrumented(name=None, rows=None, log_level=logging.INFO):
+    """Decorator recording every call of a function as a stage.
+
+    Parameters
+    ----------
+        name: str, default None
+            stage name, the function name when not given
+        rows: str, default None
+            argument whose rows are counted, the rows of the result when not given
+        log_level: int, default logging.INFO
+            level of the stage log lines
+    """
+
+    def decorator(func):
+        stage_name = name or func.__name__
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _instrumentation.enabled:
+                return func(*args, **kwargs)
+            with _instrumentation.stage(stage_name, log_level=log_level) as record:
+                if rows is not None:
+                    record["rows"] = n_rows(signature.bind(*args, **kwargs).arguments.get(rows))
+                result = func(*args, **kwargs)
+                if rows is None:
+                    record["rows"] = n_rows(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def _steps(pl):
+    return [(name, step) for name, step in pl.steps if step is not None and step != "passthrough"]
+
+
+def fit_transform_steps(pl, X, y=None, prefix="pipeline"):
+    """Fits a transformer pipeline step by step, recording every step as a stage.
+
+    Equivalent to ``pl.fit_transform(X, y)`` for pipelines of transformers.
+
+    Parameters
+    ----------
+        pl: sklearn.pipeline.Pipeline
+            unfitted pipeline
+        X: pd.DataFrame
+            input data
+        y: pd.Series, default None
+            target, passed to every step
+        prefix: str, default pipeline
+            stage name prefix
+
+    Return
+    ------
+        X: np.array, sparse matrix or pd.DataFrame
+            transformed data
+    """
+    for name, step in _steps(pl):
+        with stage("{}.fit_transform.{}".format(prefix, name), n_rows(X)):
+            X = step.fit_transform(X, y)
+    return X
+
+
+def transform_steps(pl, X, prefix="pipeline"):
+    """Transforms with a fitted pipeline step by step, recording every step as a stage.
+
+    Parameters
+    ----------
+        pl: sklearn.pipeline.Pipeline
+            fitted pipeline
+        X: pd.DataFrame
+            input data
+        prefix: str, default pipeline
+            stage name prefix
+
+    Return
+    ------
+        X: np.array, sparse matrix or pd.DataFrame
+            transformed data
+    """
+    for name, step in _steps(pl):
+        with stage("{}.transform.{}".format(prefix, name), n_rows(X)):
+            X = step.transform(X)
+    return X
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as JSON lines, with the stage record of instrumentation logs as fields.
+
+    Use it as the formatter class in log.conf.
+    """
+
+    def format(self, record):
+        line = {"time": self.formatTime(record), "name": record.name, "level": record.levelname}
+        stage_record = getattr(record, "stage", None)
+        if stage_record is not None:
+            line.update(stage_record)
+        else:
+            line["message"] = record.getMessage()
+        if record.exc_info:
+            line["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(line)
@@ -0,0 +1,199 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from housing.preparation import storage as st
+
+logger = logging.getLogger(__name__)
+
+# median_income bins of the stratified split
+INCOME_BINS = [0.0, 1.5, 3.0, 4.5, 6.0, np.inf]
+INCOME_LABELS = [1, 2, 3, 4, 5]
+
+
+def income_category(income):
+    """Returns the income bin label (1-5) of every row, 0 when missing or out of range.
+
+    Parameters
+    ----------
+        income: pd.Series
+            median_income values
+
+    Return
+    ------
+        income_cat: np.array
+            int bin labels
+    """
+    return pd.cut(income, bins=INCOME_BINS, labels=False).fillna(-1).to_numpy(dtype=np.int64) + 1
+
+
+def row_hash(data, seed=42):
+    """Returns a deterministic uniform value in [0, 1) per row, keyed by the seed.
+
+    The value only depends on the row contents and the seed, not on the
+    position of the row in the file or on how it was read: numeric columns
+    are hashed as float32, so the compact dtypes of ``load_housing_data``
+    and a plain ``pd.read_csv`` give the same values, and categorical
+    columns hash like their string values.
+
+    Parameters
+    ----------
+        data: pd.DataFrame
+            rows to hash
+        seed: int, default 42
+            hash key
+
+    Return
+    ------
+        u: np.array
+            float values in [0, 1)
+    """
+    numeric = data.select_dtypes(include=np.number).columns
+    data = data.astype({col: np.float32 for col in numeric}) if len(numeric) else data
+    hashes = pd.util.hash_pandas_object(data, index=False, hash_key="{:016d}".format(seed % 10 ** 16))
+    return (hashes.to_numpy() >> np.uint64(11)) * (1.0 / (1 << 53))
+
+
+class StratifiedHashSplitter:
+    """Streaming stratified train/test assignment.
+
+    A row goes to test when its seed-keyed row hash is below ``test_size``,
+    so the assignment of a row only depends on its contents and the seed:
+    it is the same for any chunk size and for the in-memory ``hash``
+    sampling of ``get_train_test_split``. The hash is uniform, so every
+    ``median_income`` bin gets a test share close to ``test_size``; the two
+    counters per bin only feed ``stats``.
+
+    Parameters
+    ----------
+        seed: int, default 42
+            hash key
+        test_size: float, default 0.2
+            test share
+    """
+
+    def __init__(self, seed=42, test_size=0.2):
+        self.seed = seed
+        self.test_size = test_size
+        self.n_seen = np.zeros(len(INCOME_LABELS) + 1, dtype=np.int64)
+        self.n_test = np.zeros(len(INCOME_LABELS) + 1, dtype=np.int64)
+
+    def assign(self, chunk):
+        """Assigns a chunk.
+
+        Parameters
+        ----------
+            chunk: pd.DataFrame
+                raw rows with a median_income column
+
+        Return
+        ------
+            is_test: np.array
+                boolean test mask
+        """
+        u = row_hash(chunk, self.seed)
+        income_cat = income_category(chunk["median_income"])
+        is_test = u < self.test_size
+        self.n_seen += np.bincount(income_cat, minlength=len(self.n_seen))
+        self.n_test += np.bincount(income_cat[is_test], minlength=len(self.n_test))
+        return is_test
+
+    def stats(self):
+        """Returns the test share of every income bin."""
+        return {int(label): float(self.n_test[label] / self.n_seen[label])
+                for label in range(len(self.n_seen)) if self.n_seen[label]}
+
+
+class Partition:
+    """Lazy handle on a split partition written to disk.
+
+    Parameters
+    ----------
+        path: str
+            partition directory holding part files
+        fmt: str
+            storage format of the part files
+        n_rows: int
+            number of rows
+    """
+
+    def __init__(self, path, fmt, n_rows):
+        self.path = path
+        self.fmt = fmt
+        self.n_rows = n_rows
+
+    def __len__(self):
+        return self.n_rows
+
+    def __repr__(self):
+        return "Partition({!r}, fmt={!r}, n_rows={})".format(self.path, self.fmt, self.n_rows)
+
+    def files(self):
+        suffix = st.FORMATS[self.fmt]
+        return sorted(os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(suffix))
+
+    def iter_chunks(self):
+        """Yields the part files one at a time as data frames."""
+        for path in self.files():
+            yield st.load_frame(os.path.splitext(path)[0], self.fmt)
+
+    def read(self):
+        """Reads the whole partition into memory."""
+        parts = list(self.iter_chunks())
+        if not parts:
+            return pd.DataFrame()
+        data = pd.concat(parts, ignore_index=True)
+        # part files have their own categories, concat falls back to object
+        cat_cols = [col for col, dtype in parts[0].dtypes.items() if isinstance(dtype, pd.CategoricalDtype)]
+        return data.astype({col: "category" for col in cat_cols}) if cat_cols else data
+
+
+def split_csv(csv_path, out_dir, seed=42, test_size=0.2, chunk_size=1000000, fmt="parquet", **read_kwargs):
+    """Splits a csv file into stratified train and test partitions without loading it.
+
+    The file is read ``chunk_size`` rows at a time; every chunk is assigned
+    by ``StratifiedHashSplitter`` and written as one part file to
+    ``out_dir/train`` and ``out_dir/test``, so memory use only depends on
+    the chunk size.
+
+    Parameters
+    ----------
+        csv_path: str
+            raw csv file
+        out_dir: str
+            output directory
+        seed: int, default 42
+            hash key
+        test_size: float, default 0.2
+            test share
+        chunk_size: int, default 1000000
+            rows per chunk
+        fmt: str, default parquet
+            storage format of the part files
+        read_kwargs:
+            extra ``pd.read_csv`` arguments, e.g. dtype or usecols
+
+    Return
+    ------
+        train: Partition
+            train partition
+        test: Partition
+            test partition
+    """
+    splitter = StratifiedHashSplitter(seed, test_size)
+    counts = {"train": 0, "test": 0}
+    for name in counts:
+        os.makedirs(os.path.join(out_dir, name), exist_ok=True)
+        for path in Partition(os.path.join(out_dir, name), fmt, 0).files():
+            os.remove(path)
+    for ix, chunk in enumerate(pd.read_csv(csv_path, chunksize=chunk_size, **read_kwargs)):
+        is_test = splitter.assign(chunk)
+        for name, rows in [("train", chunk[~is_test]), ("test", chunk[is_test])]:
+            if len(rows):
+                st.save_frame(rows, os.path.join(out_dir, name, "part-{:05d}".format(ix)), fmt)
+                counts[name] += len(rows)
+    logger.info("split {} into {} train and {} test rows, test share per income bin {}".format(
+        csv_path, counts["train"], counts["test"], splitter.stats()))
+    return (Partition(os.path.join(out_dir, "train"), fmt, counts["train"]),
+            Partition(os.path.join(out_dir, "test"), fmt, counts["test"]))
@@ -0,0 +1,221 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+FORMATS = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "feather": ".feather",
+    "npy": ".npy",
+    "npz": ".npz",
+}
+
+
+def frame_path(path, fmt="csv"):
+    """Returns the file path of a stored frame.
+
+    Parameters
+    ----------
+        path: str
+            file path without extension
+        fmt: str, default csv
+            storage format {'csv', 'parquet', 'feather', 'npy', 'npz'}
+
+    Return
+    ------
+        path: str
+            file path with the extension of the format
+    """
+    if fmt not in FORMATS:
+        raise ValueError("unsupported storage format {}, expected one of {}".format(fmt, list(FORMATS)))
+    return path + FORMATS[fmt]
+
+
+def _meta_path(path):
+    return os.path.splitext(path)[0] + ".json"
+
+
+def _densify(data):
+    """Converts the sparse columns of a frame to dense ones."""
+    dtypes = {col: dtype.subtype for col, dtype in data.dtypes.items() if isinstance(dtype, pd.SparseDtype)}
+    return data.astype(dtypes) if dtypes else data
+
+
+def save_frame(data, path, fmt="csv"):
+    """Saves a data frame.
+
+    The ``npy`` format stores the values as one 2-D array, which can be
+    memory-mapped on load, and keeps the column names and dtypes in a
+    json file next to it. The ``npz`` format stores a CSR matrix and loads
+    back as a sparse frame; the other formats densify sparse columns.
+
+    Parameters
+    ----------
+        data: pd.DataFrame
+            data to save
+        path: str
+            file path without extension
+        fmt: str, default csv
+            storage format {'csv', 'parquet', 'feather', 'npy', 'npz'}
+
+    Return
+    ------
+        path: str
+            saved file path
+    """
+    path = frame_path(path, fmt)
+    if fmt == "npz":
+        values = data.astype(pd.SparseDtype(np.float64, 0.0)).sparse.to_coo().tocsr()
+        sparse.save_npz(path, values)
+        with open(_meta_path(path), "w") as fp:
+            json.dump({"columns": list(map(str, data.columns))}, fp)
+        return path
+    data = _densify(data)
+    if fmt == "csv":
+        data.to_csv(path, index=False)
+    elif fmt == "parquet":
+        data.to_parquet(path, index=False)
+    elif fmt == "feather":
+        data.reset_index(drop=True).to_feather(path)
+    elif fmt == "npy":
+        values = data.to_numpy(dtype=np.result_type(*data.dtypes))
+        np.save(path, values, allow_pickle=False)
+        meta = {"columns": list(map(str, data.columns)), "dtypes": [str(dtype) for dtype in data.dtypes]}
+        with open(_meta_path(path), "w") as fp:
+            json.dump(meta, fp)
+    return path
+
+
+def load_frame(path, fmt="csv", mmap=False):
+    """Loads a data frame saved by ``save_frame``.
+
+    Parameters
+    ----------
+        path: str
+            file path without extension
+        fmt: str, default csv
+            storage format {'csv', 'parquet', 'feather', 'npy', 'npz'}
+        mmap: bool, default False
+            memory-map the ``npy`` values instead of reading them
+
+    Return
+    ------
+        data: pd.DataFrame
+            loaded data
+    """
+    path = frame_path(path, fmt)
+    if fmt == "csv":
+        return pd.read_csv(path)
+    elif fmt == "parquet":
+        return pd.read_parquet(path)
+    elif fmt == "feather":
+        return pd.read_feather(path)
+    elif fmt == "npz":
+        with open(_meta_path(path), "r") as fp:
+            meta = json.load(fp)
+        return pd.DataFrame.sparse.from_spmatrix(sparse.load_npz(path), columns=meta["columns"])
+    values = np.load(path, mmap_mode="r" if mmap else None, allow_pickle=False)
+    with open(_meta_path(path), "r") as fp:
+        meta = json.load(fp)
+    data = pd.DataFrame(values, columns=meta["columns"], copy=False)
+    dtypes = {col: dtype for col, dtype in zip(meta["columns"], meta["dtypes"]) if dtype != str(values.dtype)}
+    if dtypes:
+        data = data.astype(dtypes)
+    return data
+
+
+def frame_exists(path, fmt="csv"):
+    """Checks if a frame was saved in the given format."""
+    return os.path.exists(frame_path(path, fmt))
+
+
+def copy_frame(src, dst, fmt="csv"):
+    """Copies a saved frame, including the npy and npz metadata.
+
+    Parameters
+    ----------
+        src: str
+            source path without extension
+        dst: str
+            destination path without extension
+        fmt: str, default csv
+            storage format
+    """
+    shutil.copyfile(frame_path(src, fmt), frame_path(dst, fmt))
+    if fmt in ("npy", "npz"):
+        shutil.copyfile(_meta_path(frame_path(src, fmt)), _meta_path(frame_path(dst, fmt)))
+
+
+class CsvWriter:
+    """Writes data frames one after another to a csv file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.header = True
+
+    def write(self, df):
+        df.to_csv(self.path, mode="w" if self.header else "a", header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        pass
+
+
+class ParquetWriter:
+    """Writes data frames one after another as row groups of a parquet file.
+
+    Later frames are cast to the schema of the first one, so chunks with
+    differently inferred dtypes end up in one file.
+    """
+
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("pyarrow is required to write parquet output")
+        self.pa = pa
+        self.pq = pq
+        self.path = path
+        self.writer = None
+
+    def write(self, df):
+        table = self.pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, table.schema)
+        elif table.schema != self.writer.schema:
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def get_writer(path, fmt=None):
+    """Returns a chunked writer for a csv or parquet file.
+
+    Parameters
+    ----------
+        path: str
+            output file
+        fmt: str, default None
+            csv or parquet, taken from the file extension when not given
+
+    Return
+    ------
+        writer: CsvWriter or ParquetWriter
+            writer with ``write(df)`` and ``close()``
+    """
+    if fmt is None:
+        ext = os.path.splitext(path)[1].lower()
+        fmt = {".parquet": "parquet", ".pq": "parquet", ".csv": "csv"}.get(ext, ext)
+    if fmt == "parquet":
+        return ParquetWriter(path)
+    elif fmt == "csv":
+        return CsvWriter(path)
+    raise ValueError("unsupported output format {}, use csv or parquet".format(fmt))
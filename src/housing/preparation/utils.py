@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import logging.config
 
@@ -23,6 +24,28 @@ def read_config(path):
     return cfg
 
 
+def sha256_file(path, block_size=1 << 20):
+    """Computes the SHA-256 digest of a file, reading it block by block.
+
+    Parameters
+    ----------
+        path: str
+            file path
+        block_size: int, default 1MB
+            read block size
+
+    Return
+    ------
+        digest: str
+            hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def configure_logger(log_conf="./config/log.conf", lvl="INFO"):
     """This function is to configure the logger.
 
@@ -0,0 +1,18 @@
+"""Feature engineering transformers.
+
+Submodules are imported on first attribute access, so ``import housing.processing``
+does not load sklearn.
+"""
+import importlib
+
+_SUBMODULES = {"features", "processing"}
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | _SUBMODULES)
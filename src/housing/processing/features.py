@@ -0,0 +1,87 @@
+import numpy as np
+
+# derived features added by CombinedAttributesAdder and generate_features, in output order
+RATIO_FEATURES = [
+    ("rooms_per_household", "ratio", "total_rooms", "households"),
+    ("population_per_household", "ratio", "population", "households"),
+    ("bedrooms_per_room", "ratio", "total_bedrooms", "total_rooms"),
+]
+
+FEATURE_OPS = ("ratio", "product")
+
+
+def feature_specs(add_bedrooms_per_room=True, extra_features=None):
+    """Returns the derived feature specs.
+
+    Parameters
+    ----------
+        add_bedrooms_per_room: bool, default True
+            add the bedrooms_per_room ratio
+        extra_features: list, default None
+            user declared features as dicts with a ``name``, an ``op``
+            ('ratio' or 'product') and the two input ``columns``
+
+    Return
+    ------
+        specs: list
+            (name, op, left column, right column) per derived feature
+    """
+    specs = RATIO_FEATURES if add_bedrooms_per_room else RATIO_FEATURES[:2]
+    specs = list(specs)
+    for feature in extra_features or []:
+        if feature.get("op", "ratio") not in FEATURE_OPS:
+            raise ValueError("unknown feature op {}, expected one of {}".format(feature["op"], FEATURE_OPS))
+        left, right = feature["columns"]
+        specs.append((feature["name"], feature.get("op", "ratio"), left, right))
+    return specs
+
+
+def compute_features(columns, specs, out=None):
+    """Computes derived features into one float block.
+
+    Every feature is written straight into its column of ``out``. Ratios
+    with a zero denominator are 0, a NaN would reach the estimator after the
+    imputer already ran and the linear models do not accept it. The nonzero
+    mask of a denominator is only built when it has zeros, once per column.
+
+    Parameters
+    ----------
+        columns: mapping
+            column name to 1-D numeric values, e.g. a DataFrame
+        specs: list
+            feature specs from ``feature_specs``
+        out: np.array, default None
+            preallocated float64 block of shape (n_rows, len(specs))
+
+    Return
+    ------
+        out: np.array
+            derived features
+    """
+    arrays, nonzero = {}, {}
+
+    def column(name):
+        if name not in arrays:
+            arrays[name] = np.asarray(columns[name], dtype=np.float64)
+        return arrays[name]
+
+    def nonzero_mask(name):
+        # all() reduces without a temporary, most denominators have no zeros
+        if name not in nonzero:
+            nonzero[name] = None if column(name).all() else column(name) != 0
+        return nonzero[name]
+
+    if out is None:
+        n_rows = len(column(specs[0][2])) if specs else 0
+        out = np.empty((n_rows, len(specs)), dtype=np.float64)
+    for ix, (_, op, left, right) in enumerate(specs):
+        if op == "ratio":
+            mask = nonzero_mask(right)
+            if mask is None:
+                np.divide(column(left), column(right), out=out[:, ix])
+            else:
+                out[:, ix] = 0.0
+                np.divide(column(left), column(right), out=out[:, ix], where=mask)
+        else:
+            np.multiply(column(left), column(right), out=out[:, ix])
+    return out
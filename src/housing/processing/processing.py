@@ -2,6 +2,8 @@ import logging
 
 import numpy as np
 import pandas as pd
+from housing.processing.features import FEATURE_OPS, RATIO_FEATURES, compute_features, feature_specs  # noqa: F401
+from scipy import sparse
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.compose import ColumnTransformer
 from sklearn.impute import SimpleImputer
@@ -26,15 +28,18 @@ class Imputer(_BaseImputer, TransformerMixin):
             numerical constant to use when the num_imputer is constant
         cat_constant: str
             categorical constant to use when the cat_imputer is constant
+        copy: bool, default True
+            if False, transform fills the missing values of the input frame in place
     """
     def __init__(self, num_impute="mean", cat_impute="most_frequent", num_constant=None,
-                 cat_constant=None, missing_values=np.nan, add_indicator=False):
+                 cat_constant=None, missing_values=np.nan, add_indicator=False, copy=True):
         super().__init__(missing_values=missing_values, add_indicator=add_indicator)
         self.num_impute = num_impute
         self.cat_impute = cat_impute
         self.num_constant = num_constant
         self.cat_impute = cat_impute
         self.cat_constant = cat_constant
+        self.copy = copy
 
     def fit(self, X, y=None):
         check_array(X, accept_large_sparse=False, dtype=object, force_all_finite="allow-nan")
@@ -57,20 +62,142 @@ class Imputer(_BaseImputer, TransformerMixin):
             ]
         )
         self.imputer_.fit(X)
+        self._init_aggregates(X)
         self.is_fitted_ = True
         return self
 
-    def transform(self, X, y=None):
+    def _init_aggregates(self, X):
+        """Running aggregates needed to update the fill values with partial_fit."""
+        self.n_samples_seen_ = len(X)
+        self.num_count_ = X[self.num_cols_].notnull().sum().to_numpy(dtype=np.float64)
+        self.num_sum_ = X[self.num_cols_].sum().to_numpy(dtype=np.float64)
+        # value counts are only needed, and kept, for most frequent imputation
+        self.value_counts_ = {}
+        if self.num_impute == "most_frequent":
+            self.value_counts_.update({col: _value_counts(X[col]) for col in self.num_cols_})
+        if self.cat_impute == "most_frequent":
+            self.value_counts_.update({col: _value_counts(X[col]) for col in self.cat_cols_})
+
+    def partial_fit(self, X, y=None):
+        """Updates the fill values with a new batch of data.
+
+        The mean and most frequent values are updated from running sums,
+        counts and value counts, so the result equals fitting on all batches
+        seen so far. Median imputation can not be updated incrementally.
+
+        Parameters
+        ----------
+            X: pd.DataFrame
+                new batch of data
+        """
+        if not getattr(self, "is_fitted_", False):
+            return self.fit(X)
+        if not hasattr(self, "n_samples_seen_"):
+            raise ValueError("imputer was fitted without running aggregates, refit it before partial_fit")
+        if self.num_impute == "median":
+            raise ValueError("median imputation can not be updated incrementally")
+        self.n_samples_seen_ += len(X)
+        self.num_count_ += X[self.num_cols_].notnull().sum().to_numpy(dtype=np.float64)
+        self.num_sum_ += X[self.num_cols_].sum().to_numpy(dtype=np.float64)
+        for col, counts in self.value_counts_.items():
+            self.value_counts_[col] = _merge_counts(counts, _value_counts(X[col]))
+
+        num_imputer = self.imputer_.named_transformers_["num"]
+        if self.num_impute == "mean":
+            num_imputer.statistics_ = self.num_sum_ / self.num_count_
+        elif self.num_impute == "most_frequent":
+            num_imputer.statistics_ = np.array([_most_frequent(self.value_counts_[col]) for col in self.num_cols_])
+        if self.cat_impute == "most_frequent" and self.cat_cols_:
+            cat_imputer = self.imputer_.named_transformers_["cat"]
+            cat_imputer.statistics_ = np.array([_most_frequent(self.value_counts_[col]) for col in self.cat_cols_],
+                                               dtype=object)
+        return self
+
+    def transform(self, X, y=None, copy=None):
+        """Fills the missing values column by column.
+
+        Every column keeps its storage: numeric columns are filled with the
+        fitted statistics in their own dtype, categorical columns through
+        their category codes and object columns with ``fillna``. Only rows
+        with missing values are written. Columns are returned in the order
+        numerical then categorical. The input must have exactly the fitted
+        columns, in any order, a ValueError lists the missing and unknown ones.
+
+        Parameters
+        ----------
+            X: pd.DataFrame
+                data to impute
+            copy: bool, default None
+                overrides ``self.copy``; with False the input is filled in
+                place when its columns are already in output order
+
+        Returns
+        -------
+            X: pd.DataFrame
+                imputed data
+        """
         check_is_fitted(self, "is_fitted_")
-        X = self.imputer_.transform(X)
-        X = pd.DataFrame(X, columns=self.num_cols_ + self.cat_cols_)
-        X = X.astype(self.dtype_dict_)
+        copy = getattr(self, "copy", True) if copy is None else copy
+        cols = self.num_cols_ + self.cat_cols_
+        if list(X.columns) != cols:
+            missing = [col for col in cols if col not in X.columns]
+            unknown = [col for col in X.columns if col not in cols]
+            if missing or unknown:
+                raise ValueError("imputer input columns do not match the fitted ones, missing {}, unknown {}".format(
+                    missing, unknown))
+            X = X.reindex(columns=cols)
+        elif copy:
+            X = X.copy()
+        num_fill = self.imputer_.named_transformers_["num"].statistics_ if self.num_cols_ else []
+        cat_fill = self.imputer_.named_transformers_["cat"].statistics_ if self.cat_cols_ else []
+        for col, fill in zip(self.num_cols_, num_fill):
+            missing = X[col].isna().to_numpy()
+            if missing.any():
+                X.loc[missing, col] = np.array(fill).astype(X[col].dtype)
+            if X[col].dtype != self.dtype_dict_[col]:
+                X[col] = X[col].astype(self.dtype_dict_[col])
+        for col, fill in zip(self.cat_cols_, cat_fill):
+            values = X[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                codes = values.cat.codes.to_numpy()
+                missing = codes == -1
+                if missing.any():
+                    categories = values.cat.categories
+                    if fill not in categories:
+                        categories = categories.append(pd.Index([fill]))
+                    codes = codes.copy()
+                    codes[missing] = categories.get_loc(fill)
+                    X[col] = pd.Categorical.from_codes(codes, categories=categories, ordered=values.cat.ordered)
+            elif values.isna().any():
+                X[col] = values.fillna(fill)
         return X
 
     def _more_tags(self):
         return {"allow_nan": True, "X_types": ["2darray", "string"]}
 
 
+def _value_counts(values):
+    """Distinct non-missing values and their counts as two arrays."""
+    counts = values.value_counts(sort=False)
+    return counts.index.to_numpy(dtype=object), counts.to_numpy(dtype=np.int64)
+
+
+def _merge_counts(counts, other):
+    """Adds the value counts ``other`` to ``counts``."""
+    if isinstance(counts, dict):
+        # imputers pickled when the counts were dicts
+        counts = (np.array(list(counts), dtype=object), np.array(list(counts.values()), dtype=np.int64))
+    merged = pd.Series(np.concatenate([counts[1], other[1]]), index=np.concatenate([counts[0], other[0]]))
+    merged = merged.groupby(level=0, sort=False).sum()
+    return merged.index.to_numpy(dtype=object), merged.to_numpy(dtype=np.int64)
+
+
+def _most_frequent(counts):
+    """Most frequent value, ties broken by the smallest value like SimpleImputer."""
+    values, counts = counts
+    return min(values[counts == counts.max()])
+
+
 def impute(data, num_impute="mean", cat_impute="most_frequent", num_constant=None, cat_constant=None, **kwargs):
     """Impute data based on the method.
 
@@ -144,49 +271,262 @@ def impute_transform(data, imputer):
     return data
 
 
+ENCODINGS = ("onehot", "sparse", "ordinal")
+
+
+class CategoricalEncoder(BaseEstimator, TransformerMixin):
+    """Encodes categorical columns with a vocabulary frozen at fit time.
+
+    ``onehot`` returns a dense indicator matrix, ``sparse`` the same matrix
+    as CSR and ``ordinal`` one integer code per column, for tree models.
+    Unknown categories raise, or with ``handle_unknown='ignore'`` encode as
+    all zeros (onehot, sparse) or -1 (ordinal). Missing values are unknown.
+
+    Parameters
+    ----------
+        mode: str, default onehot
+            output encoding {'onehot', 'sparse', 'ordinal'}
+        categories: str or list, default auto
+            'auto' learns the sorted categories of every column, a list of
+            category lists freezes the vocabulary
+        handle_unknown: str, default error
+            'error' or 'ignore'
+    """
+    def __init__(self, mode="onehot", categories="auto", handle_unknown="error"):
+        self.mode = mode
+        self.categories = categories
+        self.handle_unknown = handle_unknown
+
+    def _columns(self, X):
+        if hasattr(X, "iloc"):
+            return [X.iloc[:, ix] for ix in range(X.shape[1])]
+        X = np.asarray(X, dtype=object)
+        return [X[:, ix] for ix in range(X.shape[1])]
+
+    def fit(self, X, y=None):
+        if self.mode not in ENCODINGS:
+            raise ValueError("unknown encoding {}, expected one of {}".format(self.mode, ENCODINGS))
+        columns = self._columns(X)
+        if isinstance(self.categories, str):
+            self.categories_ = [np.array(sorted(pd.Series(col).dropna().unique()), dtype=object) for col in columns]
+        else:
+            if len(self.categories) != len(columns):
+                raise ValueError("expected categories for {} columns, got {}".format(len(columns),
+                                                                                    len(self.categories)))
+            self.categories_ = [np.array(list(cats), dtype=object) for cats in self.categories]
+        offsets = np.cumsum([0] + [len(cats) for cats in self.categories_])
+        self.offsets_ = offsets[:-1]
+        self.n_onehot_ = int(offsets[-1])
+        return self
+
+    def codes(self, X):
+        """Returns the integer codes of the categories, -1 for unknown and missing values.
+
+        Parameters
+        ----------
+            X: pd.DataFrame or np.array
+                categorical columns
+
+        Return
+        ------
+            codes: np.array
+                int32 array of shape (n_rows, n_columns)
+        """
+        columns = self._columns(X)
+        names = list(X.columns) if hasattr(X, "columns") else list(range(len(columns)))
+        codes = np.empty((len(columns[0]) if columns else 0, len(columns)), dtype=np.int32)
+        for ix, (col, cats) in enumerate(zip(columns, self.categories_)):
+            codes[:, ix] = pd.Categorical(col, categories=cats).codes
+            if self.handle_unknown == "error":
+                unknown = (codes[:, ix] < 0) & pd.notnull(col)
+                if unknown.any():
+                    raise ValueError("Found unknown categories {} in column {} during transform".format(
+                        sorted(set(np.asarray(col, dtype=object)[unknown])), names[ix]))
+        return codes
+
+    def transform(self, X, y=None):
+        codes = self.codes(X)
+        if self.mode == "ordinal":
+            return codes
+        rows, cols = np.nonzero(codes >= 0)
+        indices = self.offsets_[cols] + codes[rows, cols]
+        onehot = sparse.csr_matrix((np.ones(len(rows)), (rows, indices)), shape=(codes.shape[0], self.n_onehot_))
+        return onehot if self.mode == "sparse" else onehot.toarray()
+
+    def get_feature_names(self, input_features=None):
+        """Returns the output column names, ``{col}_{category}`` for onehot and sparse."""
+        if input_features is None:
+            input_features = ["x{}".format(ix) for ix in range(len(self.categories_))]
+        if self.mode == "ordinal":
+            return list(input_features)
+        return ["{}_{}".format(col, cat) for col, cats in zip(input_features, self.categories_) for cat in cats]
+
+
 class CombinedAttributesAdder(BaseEstimator, TransformerMixin):
-    def __init__(self, add_bedrooms_per_room=True):  # no *args or **kargs
+    """Adds the derived ratio features, and the ``extra_features`` declared in config.
+
+    The input columns are passed through unchanged; only the numeric inputs
+    of the features are read.
+
+    Parameters
+    ----------
+        add_bedrooms_per_room: bool, default True
+            add the bedrooms_per_room ratio
+        extra_features: list, default None
+            user declared ratio or product features, see ``feature_specs``
+    """
+    def __init__(self, add_bedrooms_per_room=True, extra_features=None):  # no *args or **kargs
         self.add_bedrooms_per_room = add_bedrooms_per_room
+        self.extra_features = extra_features
 
     def fit(self, X, y=None):
-        self._cols = list(X.columns)
-        self._rooms_ix = self._cols.index("total_rooms")
-        self._bedrooms_ix = self._cols.index("total_bedrooms")
-        self._population_ix = self._cols.index("population")
-        self._household_ix = self._cols.index("households")
-        if self.add_bedrooms_per_room:
-            self._cols += ["rooms_per_household", "population_per_household", "bedrooms_per_room"]
-        else:
-            self._cols += ["rooms_per_household", "population_per_household"]
+        self.specs_ = feature_specs(self.add_bedrooms_per_room, getattr(self, "extra_features", None))
+        missing = {col for _, _, left, right in self.specs_ for col in (left, right)} - set(X.columns)
+        if missing:
+            raise ValueError("feature input columns {} not found".format(sorted(missing)))
+        self._cols = list(X.columns) + [name for name, _, _, _ in self.specs_]
         return self
 
     def transform(self, X, y=None):
-        X = X.values
-        rooms_per_household = X[:, self._rooms_ix] / X[:, self._household_ix]
-        population_per_household = X[:, self._population_ix] / X[:, self._household_ix]
-        if self.add_bedrooms_per_room:
-            bedrooms_per_room = X[:, self._bedrooms_ix] / X[:, self._rooms_ix]
-            return pd.DataFrame(
-                np.c_[X, rooms_per_household, population_per_household, bedrooms_per_room],
-                columns=self._cols)
-        else:
-            return pd.DataFrame(np.c_[X, rooms_per_household, population_per_household], columns=self._cols)
+        features = compute_features(X, self.specs_)
+        features = pd.DataFrame(features, columns=self._cols[len(X.columns):], index=X.index)
+        return pd.concat([X, features], axis=1)
+
+
+NEIGHBOR_METRICS = ("euclidean", "haversine")
+
+
+class NeighborhoodFeatures(BaseEstimator, TransformerMixin):
+    """Adds k-nearest-neighbor aggregates of the training districts.
+
+    ``fit`` indexes the training coordinates in a KD-tree (Euclidean on
+    degrees) or a ball tree (haversine on radians) and keeps the values of
+    ``columns`` and the target of every training district. ``transform``
+    finds the ``n_neighbors`` nearest training districts of every row with
+    one batched tree query and adds the mean of their values, so the cost
+    is O(n log n) and a single row takes one small query.
+
+    On the training data, ``fit_transform`` computes the features out of
+    fold: each of ``n_folds`` folds gets its neighbors from a tree over the
+    other folds, so no row sees its own target.
+
+    Parameters
+    ----------
+        n_neighbors: int, default 10
+            neighbors per row
+        columns: list, default ['median_income']
+            numeric columns averaged over the neighbors
+        target: bool, default True
+            add the neighbor mean of the target, needs y in fit
+        n_folds: int, default 5
+            folds of the out-of-fold training features
+        metric: str, default euclidean
+            euclidean or haversine
+        coords: list, default ['latitude', 'longitude']
+            coordinate columns in degrees
+        leaf_size: int, default 40
+            tree leaf size
+        random_state: int, default None
+            seed of the fold assignment
+    """
+    def __init__(self, n_neighbors=10, columns=("median_income",), target=True, n_folds=5, metric="euclidean",
+                 coords=("latitude", "longitude"), leaf_size=40, random_state=None):
+        self.n_neighbors = n_neighbors
+        self.columns = columns
+        self.target = target
+        self.n_folds = n_folds
+        self.metric = metric
+        self.coords = coords
+        self.leaf_size = leaf_size
+        self.random_state = random_state
+
+    def _coordinates(self, columns):
+        coords = np.column_stack([np.asarray(columns[col], dtype=np.float64) for col in self.coords])
+        return np.radians(coords) if self.metric == "haversine" else coords
+
+    def _index(self, coords):
+        # sklearn.neighbors is only imported by pipelines that use the stage
+        from sklearn.neighbors import BallTree, KDTree
+
+        if self.metric == "haversine":
+            return BallTree(coords, leaf_size=self.leaf_size, metric="haversine")
+        return KDTree(coords, leaf_size=self.leaf_size)
+
+    def _aggregate(self, tree, values, coords):
+        _, neighbors = tree.query(coords, k=min(self.n_neighbors, len(values)))
+        return values[neighbors].mean(axis=1)
+
+    def fit(self, X, y=None):
+        if self.metric not in NEIGHBOR_METRICS:
+            raise ValueError("unknown metric {}, expected one of {}".format(self.metric, NEIGHBOR_METRICS))
+        if self.target and y is None:
+            raise ValueError("the neighbor target mean needs y")
+        columns = list(self.columns or [])
+        values = [np.asarray(X[col], dtype=np.float64) for col in columns]
+        if self.target:
+            values.append(np.asarray(y, dtype=np.float64))
+        self.values_ = np.column_stack(values) if values else np.empty((len(X), 0))
+        self.tree_ = self._index(self._coordinates(X))
+        self.feature_names_ = ["neighbor_{}_mean".format(col) for col in columns]
+        if self.target:
+            self.feature_names_.append("neighbor_target_mean")
+        self._cols = list(X.columns) + self.feature_names_
+        return self
+
+    def neighbor_features(self, columns):
+        """Returns the neighbor aggregates.
+
+        Parameters
+        ----------
+            columns: mapping
+                column name to 1-D values with at least the coordinate columns
+
+        Return
+        ------
+            features: np.array
+                float block of shape (n_rows, len(feature_names_))
+        """
+        return self._aggregate(self.tree_, self.values_, self._coordinates(columns))
+
+    def transform(self, X, y=None):
+        features = pd.DataFrame(self.neighbor_features(X), columns=self.feature_names_, index=X.index)
+        return pd.concat([X, features], axis=1)
+
+    def fit_transform(self, X, y=None, **fit_params):
+        self.fit(X, y)
+        n_folds = min(self.n_folds, len(X))
+        if n_folds < 2:
+            return self.transform(X)
+        from sklearn.model_selection import KFold
+
+        coords = self._coordinates(X)
+        features = np.empty((len(X), len(self.feature_names_)), dtype=np.float64)
+        for train_ix, fold_ix in KFold(n_folds, shuffle=True, random_state=self.random_state).split(coords):
+            tree = self._index(coords[train_ix])
+            features[fold_ix] = self._aggregate(tree, self.values_[train_ix], coords[fold_ix])
+        features = pd.DataFrame(features, columns=self.feature_names_, index=X.index)
+        return pd.concat([X, features], axis=1)
 
 
-def generate_features(data):
+def generate_features(data, add_bedrooms_per_room=True, extra_features=None):
     """Generates new features.
 
     Parameters
     ----------
         data: pd.DataFrame
             input data frame
+        add_bedrooms_per_room: bool, default True
+            add the bedrooms_per_room ratio
+        extra_features: list, default None
+            user declared ratio or product features, see ``feature_specs``
 
     Returns
     -------
         data: pd.DataFrame
             data frame with new features
     """
-    data["rooms_per_household"] = data["total_rooms"] / data["households"]
-    data["bedrooms_per_room"] = data["total_bedrooms"] / data["total_rooms"]
-    data["population_per_household"] = data["population"] / data["households"]
+    specs = feature_specs(add_bedrooms_per_room, extra_features)
+    features = compute_features(data, specs)
+    for ix, (name, _, _, _) in enumerate(specs):
+        data[name] = features[:, ix]
     return data
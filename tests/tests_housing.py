@@ -1,8 +1,118 @@
+import gc
+import hashlib
+import http.server
+import json
+import logging
+import os
+import pickle as pkl
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
 import unittest
+import weakref
 
 import numpy as np
 import pandas as pd
+from housing import cli
+from housing.modeling import artifacts as ar
+from housing.modeling import batching as bt
+from housing.modeling import compiled as cp
+from housing.modeling import eval as ev
+from housing.modeling import incremental as inc
+from housing.modeling import lite as lt
+from housing.modeling import prediction_cache as pc
+from housing.modeling import registry as rg
+from housing.modeling import score as sr
+from housing.modeling import trees as tr
+from housing.modeling import tuning as tn
+from housing.preparation import cache as ch
+from housing.preparation import data_utils as du
+from housing.preparation import fetch as fe
+from housing.preparation import instrumentation as im
+from housing.preparation import split as sp
+from housing.preparation import storage as st
 from housing.processing import processing as pr
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.linear_model import Ridge
+from sklearn.pipeline import Pipeline
+
+PREP_CFG = {
+    "num_impute": "mean",
+    "num_constant": 0,
+    "cat_impute": "constant",
+    "cat_constant": "missing",
+    "add_bedrooms_per_room": True,
+}
+
+
+def _dump(obj, path):
+    with open(path, "wb") as fp:
+        pkl.dump(obj, fp)
+
+
+def _housing_data(n=500, seed=0):
+    rng = np.random.RandomState(seed)
+    data = pd.DataFrame({
+        "longitude": rng.uniform(-124, -114, n),
+        "latitude": rng.uniform(32, 42, n),
+        "housing_median_age": rng.randint(1, 52, n).astype(float),
+        "total_rooms": rng.randint(2, 20000, n).astype(float),
+        "total_bedrooms": rng.randint(1, 4000, n).astype(float),
+        "population": rng.randint(3, 30000, n).astype(float),
+        "households": rng.randint(1, 5000, n).astype(float),
+        "median_income": rng.uniform(0.5, 15, n),
+        "median_house_value": rng.uniform(15000, 500001, n),
+        "ocean_proximity": rng.choice(["<1H OCEAN", "INLAND", "ISLAND", "NEAR BAY", "NEAR OCEAN"], n),
+    })
+    data.loc[rng.rand(n) < 0.05, "total_bedrooms"] = np.nan
+    return data
+
+
+def _fitted_pipeline(data):
+    X = data.drop("median_house_value", axis=1)
+    pl = du.build_pipeline(PREP_CFG, ["ocean_proximity"])
+    pl.fit(X)
+    return pl, X
+
+
+def _model_data_cfg(tmp, **kwargs):
+    cfg = dict(PREP_CFG, housing_path=os.path.join(tmp, "raw"), model_data_path=os.path.join(tmp, "processed"),
+               models_path=os.path.join(tmp, "models"), housing_url=None, over_write_raw_data=False,
+               over_write_model_data=False, sampling_method="stratified", seed=2020, test_size=0.2,
+               version="v1")
+    cfg.update(kwargs)
+    for path in [cfg["housing_path"], cfg["model_data_path"], cfg["models_path"]]:
+        os.makedirs(path, exist_ok=True)
+    return cfg
+
+
+class _RangeHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves files with support for ``Range: bytes=N-`` requests."""
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        with open(path, "rb") as fp:
+            content = fp.read()
+        start = int(self.headers["Range"][6:-1]) if self.headers.get("Range") else 0
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+def _write_artifacts(models_path, data, version="v1"):
+    pl, X = _fitted_pipeline(data)
+    model = Ridge().fit(pl.transform(X), data["median_house_value"])
+    cfg = {"models_path": models_path, "version": version}
+    model_path, pipeline_path = rg.artifact_paths(cfg)
+    _dump(model, model_path)
+    _dump(pl, pipeline_path)
+    return cfg
 
 
 class TestHousing(unittest.TestCase):
@@ -26,3 +136,556 @@ class TestHousing(unittest.TestCase):
             assert impute_by_mode.isnull().any().sum().sum() == 0
         except AssertionError as err:
             print(err)
+
+    def test_registry(self):
+        with tempfile.TemporaryDirectory() as models_path:
+            registry = rg.ArtifactRegistry()
+            for version in ["v1", "v2"]:
+                cfg = {"models_path": models_path, "version": version}
+                for path in rg.artifact_paths(cfg):
+                    _dump({"version": version, "payload": np.zeros(1000)}, path)
+            cfg = {"models_path": models_path, "version": "v1"}
+            model, _ = registry.get(cfg)
+            self.assertIs(registry.get(cfg)[0], model)
+            self.assertEqual(registry.stats()["hits"], 1)
+
+            model_path, _ = rg.artifact_paths(cfg)
+            _dump({"version": "v1", "payload": np.ones(1000)}, model_path)
+            os.utime(model_path, ns=(0, 0))
+            self.assertEqual(registry.get(cfg)[0]["payload"][0], 1)
+            self.assertEqual(registry.stats()["reloads"], 1)
+
+            registry.max_bytes = registry.nbytes
+            registry.get({"models_path": models_path, "version": "v2"})
+            self.assertEqual(len(registry), 1)
+            self.assertNotIn(cfg, registry)
+
+            # compressed artifacts count with their loaded size
+            registry.max_bytes = None
+            for path in rg.artifact_paths(cfg):
+                ar.save_artifact({"payload": np.zeros(1 << 20)}, path, compress=3)
+            entry = registry.entry(cfg)
+            self.assertLess(sum(os.path.getsize(path) for path in rg.artifact_paths(cfg)), 1 << 20)
+            self.assertGreaterEqual(entry.nbytes, 2 * 8 * (1 << 20))
+
+    def test_artifacts_mmap(self):
+        with tempfile.TemporaryDirectory() as models_path:
+            data = _housing_data()
+            cfg = _write_artifacts(models_path, data)
+            model_path, _ = rg.artifact_paths(cfg)
+            model = ar.load_artifact(model_path)
+            ar.save_artifact(model, model_path)
+            registry = rg.ArtifactRegistry(mmap_mode="r")
+            mapped, pipeline = registry.get(cfg)
+            self.assertIsInstance(mapped.coef_, np.memmap)
+            X = pipeline.transform(data.drop("median_house_value", axis=1))
+            np.testing.assert_allclose(mapped.predict(X), model.predict(X))
+            ar.save_artifact(model, model_path, compress=3)
+            np.testing.assert_allclose(ar.load_artifact(model_path).coef_, model.coef_)
+
+    def test_flat_trees(self):
+        pl, X = _fitted_pipeline(_housing_data(300))
+        X = pl.transform(X).astype(float)
+        y = np.random.RandomState(0).rand(len(X))
+        forest = RandomForestRegressor(n_estimators=5, min_samples_leaf=3, random_state=0).fit(X, y)
+        flat = tr.flatten(forest)
+        self.assertEqual(flat.n_trees, 5)
+        np.testing.assert_array_equal(flat.predict(X), forest.predict(X))
+        np.testing.assert_array_equal(flat.predict(X, batch_size=7), forest.predict(X))
+        flat32 = tr.flatten(forest.estimators_[0], dtype=np.float32)
+        np.testing.assert_allclose(flat32.predict(X), forest.estimators_[0].predict(X), rtol=1e-6)
+        with self.assertRaises(ValueError):
+            flat.predict(X[:, :-1])
+
+    def test_instrumentation(self):
+        instrumentation = im.Instrumentation(trace_memory=True)
+        tracing = im.tracemalloc.is_tracing()
+        im.tracemalloc.start()
+        try:
+            with instrumentation.stage("outer", rows=10):
+                with instrumentation.stage("inner") as record:
+                    block = np.ones(1 << 18)
+                    record["rows"] = len(block)
+                del block
+        finally:
+            if not tracing:
+                im.tracemalloc.stop()
+        stats = instrumentation.stats()
+        self.assertEqual(stats["inner"]["rows"], 1 << 18)
+        self.assertGreaterEqual(stats["inner"]["peak_bytes"], 8 << 18)
+        self.assertGreaterEqual(stats["outer"]["peak_bytes"], stats["inner"]["peak_bytes"])
+        self.assertIn('housing_stage_calls_total{stage="outer"} 1', instrumentation.prometheus())
+        with self.assertLogs(im.logger, level="DEBUG") as logs:
+            with instrumentation.stage("request", rows=1, log_level=logging.DEBUG):
+                pass
+        self.assertEqual([record.levelname for record in logs.records], ["DEBUG"])
+        self.assertGreater(instrumentation.stats()["request"]["process_peak_rss_bytes"], 0)
+
+        with tempfile.TemporaryDirectory() as profile_dir:
+            im.configure_instrumentation(profile_stages=["get_performance"], profile_dir=profile_dir)
+            try:
+                im.get_instrumentation().reset()
+                ev.get_performance(np.arange(1.0, 6.0), np.arange(1.0, 6.0))
+                self.assertEqual(im.get_instrumentation().stats()["get_performance"]["rows"], 5)
+                self.assertEqual(len([name for name in os.listdir(profile_dir) if name.endswith(".prof")]), 1)
+            finally:
+                im.configure_instrumentation()
+
+    def test_prediction_cache(self):
+        with tempfile.TemporaryDirectory() as models_path:
+            data = _housing_data()
+            cfg = dict(_write_artifacts(models_path, data), prediction_cache=True)
+            observations = data.drop("median_house_value", axis=1).head(5).to_dict("records")
+            expected = sr.score(dict(cfg, prediction_cache=False), observations)
+            pc.configure_prediction_cache(max_size=4)
+            try:
+                np.testing.assert_allclose(sr.score(cfg, observations[:3]), expected[:3])
+                self.assertIsNone(sr.cached_prediction(cfg, observations[3]))
+                cached = sr.cached_prediction(cfg, dict(observations[0], extra="ignored"))
+                self.assertAlmostEqual(cached, expected[0], 6)
+                np.testing.assert_allclose(sr.score(cfg, observations), expected)
+                stats = pc.get_prediction_cache().stats()
+                self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (4, 5, 1))
+
+                model_path, _ = rg.artifact_paths(cfg)
+                model = ar.load_artifact(model_path)
+                model.intercept_ += 1000.0
+                ar.save_artifact(model, model_path)
+                np.testing.assert_allclose(sr.score(cfg, observations[4]), expected[4:] + 1000.0)
+                self.assertEqual(pc.get_prediction_cache().stats()["invalidations"], 1)
+                entry = weakref.ref(rg.get_registry().entry(cfg))
+                rg.get_registry().evict(cfg)
+                gc.collect()
+                self.assertIsNone(entry())
+            finally:
+                pc.configure_prediction_cache()
+
+    def test_lite_model(self):
+        with tempfile.TemporaryDirectory() as models_path:
+            data = _housing_data()
+            cfg = _write_artifacts(models_path, data)
+            model, pipeline = rg.ArtifactRegistry().get(cfg)
+            path = lt.export_lite_model(cfg, model, pipeline)
+            observations = data.drop("median_house_value", axis=1).head(20).to_dict("records")
+            expected = sr.score(cfg, observations)
+            np.testing.assert_allclose(sr.score(dict(cfg, lite_inference=True), observations), expected)
+
+            script = ("import pickle, sys\n"
+                      "from housing.modeling import lite\n"
+                      "lite.score({{'models_path': {!r}, 'version': 'v1'}}, pickle.loads({!r}))\n"
+                      "print(sorted(m for m in ('pandas', 'sklearn', 'scipy', 'joblib') if m in sys.modules))")
+            src = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(lt.__file__))))
+            script = script.format(models_path, pkl.dumps(observations))
+            output = subprocess.check_output([sys.executable, "-c", script], env=dict(os.environ, PYTHONPATH=src),
+                                             universal_newlines=True)
+            self.assertEqual(output.strip(), "[]")
+            self.assertTrue(os.path.exists(path))
+
+    def test_micro_batcher(self):
+        batch_sizes = []
+
+        def score_fn(observations):
+            batch_sizes.append(len(observations))
+            return [obs["x"] * 2 for obs in observations]
+
+        batcher = bt.MicroBatcher(score_fn, max_batch_size=8, max_wait_ms=50)
+        futures = [batcher.submit({"x": x}) for x in range(20)]
+        self.assertEqual([future.result(timeout=5) for future in futures], [x * 2 for x in range(20)])
+        self.assertLess(len(batch_sizes), 20)
+        self.assertLessEqual(max(batch_sizes), 8)
+        batcher.close()
+
+        batcher = bt.MicroBatcher(lambda observations: [0.0], max_batch_size=8, max_wait_ms=50)
+        futures = [batcher.submit({"x": x}) for x in range(4)]
+        for future in futures:
+            self.assertIsInstance(future.exception(timeout=5), RuntimeError)
+        batcher.close()
+
+    def test_compiled_pipeline(self):
+        pl, X = _fitted_pipeline(_housing_data())
+        plan = cp.compile_pipeline(pl)
+        expected = pl.transform(X).astype(float)
+        np.testing.assert_allclose(plan.transform(X), expected)
+        np.testing.assert_allclose(plan.transform(X.head(5).to_dict("records")), expected[:5])
+        np.testing.assert_allclose(plan.transform(X.iloc[0].to_dict()), expected[:1])
+        with self.assertRaises(ValueError):
+            plan.transform(dict(X.iloc[0].to_dict(), ocean_proximity="MARS"))
+
+    def test_extra_features(self):
+        data = _housing_data(200)
+        data.loc[:4, "households"] = 0.0
+        X = data.drop("median_house_value", axis=1)
+        extra = [{"name": "income_per_room", "op": "ratio", "columns": ["median_income", "total_rooms"]},
+                 {"name": "rooms_x_age", "op": "product", "columns": ["total_rooms", "housing_median_age"]}]
+        pl = du.build_pipeline(dict(PREP_CFG, extra_features=extra), ["ocean_proximity"]).fit(X)
+        names = du.get_feature_names(pl)
+        out = pd.DataFrame(pl.transform(X).astype(float), columns=names)
+        self.assertEqual(names[-2:], ["income_per_room", "rooms_x_age"])
+        for name in ["rooms_per_household", "population_per_household"]:
+            self.assertEqual(out[name][:5].tolist(), [0.0] * 5)
+        np.testing.assert_allclose(out["rooms_per_household"][5:], X["total_rooms"][5:] / X["households"][5:])
+        np.testing.assert_allclose(out["rooms_x_age"], X["total_rooms"] * X["housing_median_age"])
+        np.testing.assert_allclose(cp.compile_pipeline(pl).transform(X), out.to_numpy())
+        generated = pr.generate_features(X.copy(), extra_features=extra)
+        np.testing.assert_allclose(generated["income_per_room"], X["median_income"] / X["total_rooms"])
+        self.assertEqual(generated["population_per_household"][:5].tolist(), [0.0] * 5)
+
+    def test_zero_households(self):
+        data = _housing_data(300)
+        data.loc[:9, "households"] = 0.0
+        with tempfile.TemporaryDirectory() as models_path:
+            cfg = _write_artifacts(models_path, data)
+            observations = data.drop("median_house_value", axis=1).head(20).to_dict("records")
+            expected = sr.score(cfg, observations)
+            self.assertTrue(np.isfinite(expected).all())
+            np.testing.assert_allclose(sr.score(dict(cfg, compiled_inference=True), observations), expected)
+            model, pipeline = rg.get_registry().get(cfg)
+            lt.export_lite_model(cfg, model, pipeline)
+            np.testing.assert_allclose(sr.score(dict(cfg, lite_inference=True), observations), expected)
+
+    def test_neighborhood_features(self):
+        data = _housing_data(300)
+        X, y = data.drop("median_house_value", axis=1), data["median_house_value"]
+        cfg = dict(PREP_CFG, neighborhood_features=True, neighborhood_k=5, seed=0)
+        pl = du.build_pipeline(cfg, ["ocean_proximity"])
+        names = du.get_feature_names(pl.fit(X, y))
+        self.assertEqual(names[-2:], ["neighbor_median_income_mean", "neighbor_target_mean"])
+        with self.assertRaises(ValueError):
+            du.build_pipeline(cfg, ["ocean_proximity"]).fit(X)
+
+        # out of fold on the train data: no row averages its own target
+        out = pd.DataFrame(du.build_pipeline(cfg, ["ocean_proximity"]).fit_transform(X, y), columns=names)
+        coords = X[["latitude", "longitude"]].to_numpy()
+        nearest = np.argsort(((coords[:, None, :] - coords[None, :, :]) ** 2).sum(axis=2), axis=1)[:, :5]
+        self.assertFalse(np.allclose(out["neighbor_target_mean"], y.to_numpy()[nearest].mean(axis=1)))
+
+        # new rows average their nearest training districts, compiled plan included
+        test = X.head(7)
+        test_out = pd.DataFrame(pl.transform(test).astype(float), columns=names)
+        np.testing.assert_allclose(test_out["neighbor_target_mean"], y.to_numpy()[nearest[:7]].mean(axis=1))
+        np.testing.assert_allclose(cp.compile_pipeline(pl).transform(test.iloc[0].to_dict()),
+                                   test_out.to_numpy()[:1])
+
+    def test_categorical_encoder(self):
+        train = pd.DataFrame({"ocean_proximity": ["INLAND", "NEAR BAY", "INLAND", "ISLAND"]})
+        test = pd.DataFrame({"ocean_proximity": ["ISLAND", "INLAND"]})
+        onehot = pr.CategoricalEncoder().fit(train)
+        np.testing.assert_array_equal(onehot.transform(test), [[0, 1, 0], [1, 0, 0]])
+        sparse_out = pr.CategoricalEncoder(mode="sparse").fit(train).transform(test)
+        np.testing.assert_array_equal(sparse_out.toarray(), onehot.transform(test))
+        ordinal = pr.CategoricalEncoder(mode="ordinal", handle_unknown="ignore").fit(train)
+        np.testing.assert_array_equal(ordinal.transform(pd.DataFrame({"ocean_proximity": ["MARS", "ISLAND"]})),
+                                      [[-1], [1]])
+        with self.assertRaises(ValueError):
+            onehot.transform(pd.DataFrame({"ocean_proximity": ["MARS"]}))
+
+        data = _housing_data(300)
+        X = data.drop("median_house_value", axis=1)
+        pl = du.build_pipeline(dict(PREP_CFG, encoding="sparse"), ["ocean_proximity"]).fit(X)
+        out = pl.transform(X)
+        self.assertEqual(out.format, "csr")
+        np.testing.assert_allclose(cp.compile_pipeline(pl).transform(X), out.toarray())
+        encoder = pl.named_steps["label_endcode"].named_transformers_["label_endcoder"]
+        test = du.prepare_test_data(X[X["ocean_proximity"] != "ISLAND"].copy(),
+                                    pl.named_steps["imputer"].imputer_, encoder)
+        self.assertEqual(list(test.columns[-5:]), encoder.get_feature_names(["ocean_proximity"]))
+
+    def test_score_stream(self):
+        data = _housing_data()
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = _write_artifacts(tmp, data)
+            input_path = os.path.join(tmp, "score.csv")
+            data.to_csv(input_path, index=False)
+            expected = sr.score(cfg, data.drop("median_house_value", axis=1))
+            for ext in [".csv", ".parquet"]:
+                output_path = os.path.join(tmp, "out", "predictions" + ext)
+                summary = sr.score_stream(cfg, input_path, output_path, chunk_size=64)
+                self.assertEqual(summary["chunks"], 8)
+                out = pd.read_csv(output_path) if ext == ".csv" else pd.read_parquet(output_path)
+                np.testing.assert_allclose(out["y_hat"], expected)
+                np.testing.assert_allclose(out["median_house_value"], data["median_house_value"])
+
+            output_path = os.path.join(tmp, "parallel.csv")
+            sr.score_stream(cfg, input_path, output_path, chunk_size=50, n_workers=2)
+            np.testing.assert_allclose(pd.read_csv(output_path)["y_hat"], expected)
+            X = data.drop("median_house_value", axis=1)
+            np.testing.assert_allclose(sr.score_parallel(cfg, X, chunk_size=70, n_workers=3), expected)
+
+    def test_storage_formats(self):
+        data = pd.DataFrame({"a": np.arange(10, dtype=np.float64), "b": np.arange(10, dtype=np.int32)})
+        with tempfile.TemporaryDirectory() as tmp:
+            for fmt in ["parquet", "feather", "npy"]:
+                path = os.path.join(tmp, "train_" + fmt)
+                st.save_frame(data, path, fmt)
+                pd.testing.assert_frame_equal(st.load_frame(path, fmt, mmap=True), data)
+
+    def test_feature_names(self):
+        pl, X = _fitted_pipeline(_housing_data())
+        names = du.get_feature_names(pl)
+        self.assertEqual(len(names), pl.transform(X).shape[1])
+        self.assertEqual(names[0], "ocean_proximity_<1H OCEAN")
+        self.assertEqual(names[-1], "bedrooms_per_room")
+
+    def test_load_housing_data(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            _housing_data(100).to_csv(os.path.join(tmp, "housing.csv"), index=False)
+            data = du.load_housing_data(tmp)
+            self.assertEqual(data["total_rooms"].dtype, np.float32)
+            self.assertEqual(data["ocean_proximity"].dtype.name, "category")
+            self.assertLess(data.memory_usage(deep=True).sum(), du._default_nbytes(data))
+            data = du.load_housing_data(tmp, usecols=["median_income", "ocean_proximity"])
+            self.assertEqual(list(data.columns), ["median_income", "ocean_proximity"])
+            self.assertEqual(du.load_housing_data(tmp, compact_dtypes=False)["total_rooms"].dtype, np.float64)
+
+    def test_split_csv(self):
+        data = _housing_data(1000)
+        original = data.copy()
+        train, test = du.get_train_test_split(data, "stratified", 7, 0.2)
+        pd.testing.assert_frame_equal(data, original)
+        with tempfile.TemporaryDirectory() as tmp:
+            data.to_csv(os.path.join(tmp, "housing.csv"), index=False)
+            train, test = sp.split_csv(os.path.join(tmp, "housing.csv"), os.path.join(tmp, "split"), seed=7,
+                                       chunk_size=250, fmt="csv")
+            self.assertEqual(len(train) + len(test), 1000)
+            self.assertAlmostEqual(len(test), 200, delta=40)
+            first = test.read()
+            _, again = sp.split_csv(os.path.join(tmp, "housing.csv"), os.path.join(tmp, "split"), seed=7,
+                                    chunk_size=250, fmt="csv")
+            pd.testing.assert_frame_equal(again.read(), first)
+            self.assertEqual(len(pd.concat([train.read(), first]).drop_duplicates()), 1000)
+            # a row's assignment does not depend on the chunk size or on reading the file at once
+            _, whole = sp.split_csv(os.path.join(tmp, "housing.csv"), os.path.join(tmp, "split"), seed=7,
+                                    chunk_size=1000, fmt="csv")
+            pd.testing.assert_frame_equal(whole.read(), first)
+            _, in_memory = du.get_train_test_split(du.load_housing_data(tmp), "hash", 7, 0.2)
+            pd.testing.assert_frame_equal(in_memory.astype(first.dtypes.to_dict()), first, check_exact=False)
+        # rows are assigned independently, the bin shares converge to test_size
+        splitter = sp.StratifiedHashSplitter(7, 0.2)
+        splitter.assign(_housing_data(20000))
+        for share in splitter.stats().values():
+            self.assertAlmostEqual(share, 0.2, delta=0.03)
+
+    def test_fetch(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            data = _housing_data(100)
+            data.to_csv(os.path.join(tmp, "housing.csv"), index=False)
+            tgz_path = os.path.join(tmp, "housing.tgz")
+            with tarfile.open(tgz_path, "w:gz") as tar:
+                tar.add(os.path.join(tmp, "housing.csv"), arcname="housing.csv")
+            with open(tgz_path, "rb") as fp:
+                content = fp.read()
+            sha256 = hashlib.sha256(content).hexdigest()
+
+            raw_path = os.path.join(tmp, "raw")
+            du.fetch_housing_data("file://" + tgz_path, raw_path, housing_sha256=sha256, raw_data_format="parquet")
+            pd.testing.assert_frame_equal(du.load_housing_data(raw_path, compact_dtypes=False, fmt="parquet"), data)
+            with self.assertRaises(ValueError):
+                fe.download("file://" + tgz_path, tmp, sha256="0" * 64)
+
+            server = http.server.HTTPServer(("127.0.0.1", 0), lambda *args: _RangeHandler(*args, directory=tmp))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                cache_dir = os.path.join(tmp, "cache")
+                os.makedirs(cache_dir)
+                with open(os.path.join(cache_dir, "housing.tgz.part"), "wb") as fp:
+                    fp.write(content[:100])
+                url = "http://127.0.0.1:{}/housing.tgz".format(server.server_port)
+                path = fe.download(url, cache_dir, sha256=sha256)
+                with open(path, "rb") as fp:
+                    self.assertEqual(fp.read(), content)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def test_model_data_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = _model_data_cfg(tmp)
+            _housing_data().to_csv(os.path.join(cfg["housing_path"], "housing.csv"), index=False)
+            cache = ch.get_cache(os.path.join(cfg["model_data_path"], "cache"))
+            train, _ = du.prepare_model_data(cfg)
+            cached_train, _ = du.prepare_model_data(cfg)
+            self.assertEqual(cache.stats()["hits"], 1)
+            pd.testing.assert_frame_equal(train, cached_train)
+            du.prepare_model_data(dict(cfg, seed=1))
+            self.assertEqual(cache.stats()["misses"], 2)
+            pipeline_path = os.path.join(cfg["models_path"], "pipeline_v1.pkl")
+            self.assertIsInstance(ar.load_artifact(pipeline_path), Pipeline)
+            self.assertFalse(os.path.exists(pipeline_path + ".tmp"))
+
+            self.assertEqual(len(cache.entries()), 2)
+            used_key = cache.entries()[-1][0]
+            du.prepare_model_data(dict(cfg, seed=1, model_data_cache_max_mb=0))
+            self.assertEqual([key for key, _, _ in cache.entries()], [used_key])
+            self.assertIsInstance(ar.load_artifact(pipeline_path), Pipeline)
+            self.assertEqual(cache.prune(max_age_days=0), [used_key])
+
+    def test_cli_pipeline(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = _model_data_cfg(tmp, algo="linear-ridge", decision_tree={"max_depth": 3},
+                                  **{"linear-ridge": {"alpha": 1.0}})
+            _housing_data().to_csv(os.path.join(cfg["housing_path"], "housing.csv"), index=False)
+            algos = ["linear-ridge", "decision_tree"]
+            status = cli.run_pipeline(cfg, algos)
+            self.assertEqual(set(status.values()), {"ran"})
+            self.assertEqual(set(cli.run_pipeline(cfg, algos).values()), {"up to date"})
+
+            cfg["linear-ridge"] = {"alpha": 10.0}
+            ran = {name for name, value in cli.run_pipeline(cfg, algos).items() if value == "ran"}
+            self.assertEqual(ran, {"train_linear-ridge", "score_linear-ridge", "evaluate"})
+            os.remove(os.path.join(cfg["model_data_path"], "test_v1.csv"))
+            status = cli.run_pipeline(cfg, algos, dry_run=True)
+            self.assertEqual(status["transform_test"], "would run: output changed: test")
+            self.assertEqual(status["score_decision_tree"], "would run: input changed: test")
+            self.assertEqual(status["train_decision_tree"], "up to date")
+            cli.run_pipeline(cfg, algos)
+            with open(os.path.join(cfg["model_data_path"], "pipeline", "metrics_v1.json")) as fp:
+                metrics = json.load(fp)
+            self.assertEqual(metrics["decision_tree"]["version"], "v1_decision_tree")
+            y_hat = sr.score(cfg, pd.read_csv(os.path.join(cfg["model_data_path"], "test_v1.csv"))
+                             .drop("median_house_value", axis=1), preproc=True)
+            y = pd.read_csv(os.path.join(cfg["model_data_path"], "test_v1.csv"))["median_house_value"]
+            self.assertAlmostEqual(metrics["linear-ridge"]["test"]["RMSE"], ev.get_performance(y, y_hat)["RMSE"])
+
+    def test_cli_pipeline_tune_parallel(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tuning = {"method": "grid", "cv": 2, "n_jobs": 1,
+                      "spaces": {"linear-ridge": {"alpha": [0.1, 10.0]}, "decision_tree": {"max_depth": [2, 3]}}}
+            cfg = _model_data_cfg(tmp, algo="linear-ridge", tune=True, tuning=tuning, export_lite_model=True,
+                                  export_flat_model=True, decision_tree={}, **{"linear-ridge": {}})
+            _housing_data().to_csv(os.path.join(cfg["housing_path"], "housing.csv"), index=False)
+            status = cli.run_pipeline(cfg, ["decision_tree"], jobs=2)
+            self.assertEqual(set(status), {"fetch", "load", "split", "fit_pipeline", "transform_test", "tune",
+                                           "train_best", "score_best", "train_decision_tree",
+                                           "score_decision_tree", "evaluate"})
+            self.assertEqual(set(status.values()), {"ran"})
+            with open(os.path.join(cfg["model_data_path"], "pipeline", "tuned_v1.json")) as fp:
+                best = json.load(fp)
+            model = ar.load_artifact(os.path.join(cfg["models_path"], "model_v1.pkl"))
+            self.assertEqual(model.get_params()["random_state"], cfg["seed"])
+            self.assertIsInstance(model, tn.tr.ALGOS[best["algo"]])
+            self.assertTrue(os.path.exists(os.path.join(cfg["models_path"], "leaderboard_v1.csv")))
+            self.assertEqual(set(cli.run_pipeline(cfg, ["decision_tree"], jobs=2).values()), {"up to date"})
+
+            os.remove(os.path.join(cfg["models_path"], "incremental_v1.pkl"))
+            os.remove(os.path.join(cfg["models_path"], "lite_v1.pkl"))
+            status = cli.run_pipeline(cfg, ["decision_tree"], jobs=2)
+            self.assertEqual(status["train_best"], "ran")
+            self.assertEqual(status["tune"], "up to date")
+            self.assertTrue(os.path.exists(os.path.join(cfg["models_path"], "lite_v1.pkl")))
+            cfg["tuning"] = dict(tuning, cv=3)
+            status = cli.run_pipeline(cfg, ["decision_tree"], dry_run=True)
+            self.assertEqual(status["tune"], "would run: config changed: tuning")
+            self.assertEqual(status["train_decision_tree"], "up to date")
+
+    def test_tune(self):
+        data = _housing_data()
+        X = data.drop("median_house_value", axis=1)
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = {"seed": 1, "models_path": tmp, "version": "v1", "decision_tree": {"min_samples_leaf": 5},
+                   "tuning": {"method": "halving", "cv": 3, "n_jobs": 1, "min_resources": 50, "factor": 2,
+                              "spaces": {"linear-ridge": {"alpha": [0.1, 10.0]},
+                                         "decision_tree": {"max_depth": [2, 4]}}}}
+            pipeline = du.build_pipeline(PREP_CFG, ["ocean_proximity"])
+            leaderboard = tn.tune(cfg, X, data["median_house_value"], pipeline=pipeline)
+            self.assertEqual(len(leaderboard), 4)
+            self.assertTrue(os.path.exists(os.path.join(tmp, "leaderboard_v1.csv")))
+            best = tn.best_config(cfg, leaderboard)
+            self.assertEqual(best[best["algo"]], leaderboard["params"][0])
+            self.assertEqual(leaderboard["round"][0], leaderboard["round"].max())
+
+    def test_incremental_fit(self):
+        history = _housing_data(400).dropna()
+        batch = _housing_data(100, seed=1).dropna()
+        batch.loc[batch.index[:10], "ocean_proximity"] = "LAKE"
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = dict(_write_artifacts(tmp, history), algo="linear-ridge")
+            pl, _ = _fitted_pipeline(history)
+            inc.init_state(cfg, pl.transform(history.drop("median_house_value", axis=1)),
+                           history["median_house_value"])
+            model = inc.incremental_fit(cfg, batch.drop("median_house_value", axis=1), batch["median_house_value"])
+
+            pl = ar.load_artifact(rg.artifact_paths(cfg)[1])
+            full = pd.concat([history, batch])
+            expected = Ridge().fit(pl.transform(full.drop("median_house_value", axis=1)), full["median_house_value"])
+            self.assertEqual(len(model.coef_), len(expected.coef_))
+            np.testing.assert_allclose(model.coef_, expected.coef_, rtol=1e-6, atol=1e-6)
+            self.assertAlmostEqual(model.intercept_, expected.intercept_, places=4)
+
+    def test_linear_stats_precision(self):
+        rng = np.random.RandomState(0)
+        X = 1e7 + rng.normal(0, 1, (200000, 3))
+        y = X @ np.array([1.0, 2.0, 3.0]) + rng.normal(0, 1, len(X))
+        stats = inc.LinearStats(3)
+        for batch in np.array_split(np.arange(len(X)), 20):
+            stats.update(X[batch], y[batch])
+        coef, intercept = stats.solve_ridge(1.0)
+        expected = Ridge(alpha=1.0).fit(X, y)
+        np.testing.assert_allclose(coef, expected.coef_, rtol=1e-7)
+        self.assertAlmostEqual(intercept / expected.intercept_, 1.0, places=7)
+
+    def test_imputer_partial_fit(self):
+        data = _housing_data(1000)
+        data["housing_median_age"] = data["housing_median_age"] % 7
+        for num_impute in ["mean", "most_frequent"]:
+            imputer = pr.Imputer(num_impute=num_impute, cat_impute="most_frequent")
+            imputer.fit(data.iloc[:300]).partial_fit(data.iloc[300:])
+            expected = pr.Imputer(num_impute=num_impute, cat_impute="most_frequent").fit(data)
+            np.testing.assert_allclose(imputer.imputer_.named_transformers_["num"].statistics_,
+                                       expected.imputer_.named_transformers_["num"].statistics_)
+            self.assertEqual(list(imputer.imputer_.named_transformers_["cat"].statistics_),
+                             list(expected.imputer_.named_transformers_["cat"].statistics_))
+            self.assertEqual("housing_median_age" in imputer.value_counts_, num_impute == "most_frequent")
+            self.assertIsInstance(imputer.value_counts_["ocean_proximity"][1], np.ndarray)
+
+    def test_imputer_transform_inplace(self):
+        data = _housing_data(200)
+        data["ocean_proximity"] = data["ocean_proximity"].astype("category")
+        data.loc[:9, "ocean_proximity"] = np.nan
+        imputer = pr.Imputer(num_impute="median", cat_impute="most_frequent").fit(data)
+        out = imputer.transform(data)
+        self.assertFalse(out.isna().any().any())
+        self.assertEqual(out["total_bedrooms"].dtype, np.float64)
+        self.assertEqual(out["ocean_proximity"].dtype.name, "category")
+        self.assertTrue(data["total_bedrooms"].isna().any())
+        same = imputer.transform(data, copy=False)
+        self.assertIs(same, data)
+        self.assertFalse(data["total_bedrooms"].isna().any())
+        reordered = imputer.transform(data[data.columns[::-1]])
+        self.assertEqual(list(reordered.columns), list(out.columns))
+        with self.assertRaisesRegex(ValueError, "missing \\['median_income'\\]"):
+            imputer.transform(data.drop("median_income", axis=1))
+        with self.assertRaisesRegex(ValueError, "unknown \\['extra'\\]"):
+            imputer.transform(data.assign(extra=1.0))
+
+    def test_performance(self):
+        rng = np.random.RandomState(0)
+        y = rng.uniform(1e4, 5e5, 10001)
+        y_hat = y + rng.normal(0, 5e4, len(y))
+        performance = ev.get_performance(y, y_hat)
+        self.assertAlmostEqual(performance["RMSE"], np.sqrt(np.mean((y - y_hat) ** 2)))
+        self.assertAlmostEqual(performance["MAD"], np.median(np.abs(y - y_hat)))
+        self.assertAlmostEqual(performance["r2_score"], 1 - np.sum((y - y_hat) ** 2) / np.sum((y - y.mean()) ** 2))
+
+        acc = ev.RegressionMetrics()
+        for start in range(0, len(y), 3000):
+            acc.merge(ev.RegressionMetrics().update(y[start:start + 3000], y_hat[start:start + 3000]))
+        streamed = acc.result()
+        for name in ["r2_score", "MAPE", "WMAPE", "RMSE"]:
+            self.assertAlmostEqual(streamed[name], performance[name])
+        self.assertAlmostEqual(streamed["MAD"] / performance["MAD"], 1, places=2)
+
+        groups = rng.choice(["INLAND", "NEAR BAY"], len(y))
+        by_group = ev.get_performance_by_group(y, y_hat, groups)
+        inland = groups == "INLAND"
+        expected = ev.get_performance(y[inland], y_hat[inland])
+        for name in expected:
+            self.assertAlmostEqual(by_group["INLAND"][name], expected[name])
+
+        groups = groups.astype(object)
+        groups[:100] = None
+        by_group = ev.get_performance_by_group(y, y_hat, groups)
+        expected = ev.get_performance(y[:100], y_hat[:100])
+        self.assertEqual(sorted(by_group), sorted(["INLAND", "NEAR BAY", ev.MISSING_GROUP]))
+        self.assertAlmostEqual(by_group[ev.MISSING_GROUP]["RMSE"], expected["RMSE"])
+        streamed = ev.GroupedRegressionMetrics().update(y, y_hat, groups).result()
+        self.assertAlmostEqual(streamed[ev.MISSING_GROUP]["RMSE"], expected["RMSE"])